@@ -6,26 +6,39 @@ import coloredlogs
 import sys
 
 from awsh_server import start_server
+from awsh_req_resp_server import DEFAULT_WORKERS, DEFAULT_MAX_QUEUED_REQUESTS
 from awsh_utils import get_entry_at_index
-from awsh_client import get_current_state
+from awsh_client import lookup_instance, lookup_instance_in_saved_state
 from awsh_cli import configure_cli_arguments
 
-def parse_client_arguments(args):
+import json
 
-    instance_id = None
-    if args.instance_ix:
-        entry = get_entry_at_index(args.instance_ix)
-        if entry is None:
-            # print error
-            return
+def parse_client_arguments(args):
 
-    if instance_id is None:
+    if args.instance_ix is None:
         print("Please provide an instance identifier")
         return
 
-    regions = get_current_state()
+    entry = get_entry_at_index(args.instance_ix)
+    if entry is None:
+        print(f"No saved login at index {args.instance_ix}")
+        return
+
+    # the server resolves the address, no need to fetch every region
+    address = entry['server'].rpartition('@')[2]
+    try:
+        region, instance = lookup_instance(address)
+    except OSError as e:
+        print(f"awsh server isn't running ({e}), using the last saved state")
+        region, instance = lookup_instance_in_saved_state(address)
+
+    if instance is None:
+        print(f"Instance {address} isn't known")
+        return
 
-    pass
+    if args.print_info:
+        print(f"region: {region}")
+        print(json.dumps(instance, indent=4))
 
 
 def main():
@@ -49,6 +62,16 @@ def main():
         help='Run AWS helper in background (queries AWS state continuously')
 
     server_mode.set_defaults(tool=start_server)
+    server_mode.add_argument(
+        '--workers',
+        help='Number of threads executing client requests',
+        type=int,
+        default=DEFAULT_WORKERS)
+    server_mode.add_argument(
+        '--max-queued-requests',
+        help='Number of requests waiting for a worker before new ones are rejected',
+        type=int,
+        default=DEFAULT_MAX_QUEUED_REQUESTS)
 
     # awsh cli [command]
     cli_mode = subparsers.add_parser(
@@ -1,62 +1,504 @@
 import fcntl, os
 import os.path as path
 from threading import Lock
-from datetime import datetime
+from fnmatch import fnmatchcase
+import hashlib
 import json
+import tempfile
 from typing import Union
 
 cache_dir = path.expanduser('~/') + ".cache/awsh"
+# single file cache used by older versions. Migrated into the store on read
 cache_file = cache_dir + "/info"
 
+# The cache is stored as a file per region (regions_dir/<region>) and a file
+# holding everything which isn't region specific (meta_file). Files are
+# replaced atomically, and only the regions which changed are written
+store_dir = cache_dir + "/store"
+regions_dir = store_dir + "/regions"
+meta_file = store_dir + "/meta"
+# the highest version which may have been given to a region snapshot. Written
+# ahead of publishing, since snapshots can reach clients before they're stored
+version_file = store_dir + "/version"
+lock_file = cache_dir + "/lock"
+
+# the cache fields which are stored in meta_file
+META_FIELDS = [ 'ts_dict', 'amis' ]
+
+# number of versions reserved by each write of version_file
+VERSIONS_RESERVATION = 1000
+
+# the region entries which can be queried using awsh_cache.query()
+QUERY_TARGETS = [ 'instances', 'interfaces', 'subnets' ]
+
+def _atomic_write(file_path, data : str):
+    """Replace @file_path content with @data. Readers see either the old or
+    the new content, also after a crash"""
+    dir_path = path.dirname(file_path)
+    fd, tmp_path = tempfile.mkstemp(dir=dir_path, prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(data)
+            # the content has to reach the disk before the rename does
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, file_path)
+    except:
+        os.unlink(tmp_path)
+        raise
+
+    dir_fd = os.open(dir_path, os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+def _read_json(file_path):
+    with open(file_path, 'r') as f:
+        return json.load(f)
+
+def _content_hash(data : str):
+    return hashlib.sha1(data.encode()).digest()
+
 def synchronize_with_lock(func):
     def synchronize(*args, **kwargs):
         cache = args[0]
         cache.lock.acquire()
-        result = func(*args, **kwargs)
-        cache.needs_update = True
-        cache.lock.release()
+        try:
+            result = func(*args, **kwargs)
+        finally:
+            cache.lock.release()
 
         return result
 
     return synchronize
 
 
-# TODO: add decorator to all values that need synchronization
+def _query_value(entry : dict, field : str):
+    value = entry.get(field)
+    # instances states are dictionaries of their code and name
+    if field == 'state' and isinstance(value, dict):
+        return value.get('Name')
+
+    return value
+
+def _has_wildcards(pattern : str) -> bool:
+    return any(c in pattern for c in '*?[')
+
+def _matches_patterns(value, patterns : list) -> bool:
+    if value is None:
+        value = ''
+    elif isinstance(value, bool):
+        value = 'true' if value else 'false'
+    else:
+        value = str(value)
+
+    return any(fnmatchcase(value, pattern) for pattern in patterns)
+
+
+def _index_instances(instances : list) -> dict:
+    """Build the lookup indexes of a region's instances list"""
+    indexes = {
+        'position'      : dict(),   # instance id -> its index in the list
+        'public_dns'    : dict(),   # public DNS name -> instance
+        'eni'           : dict(),   # attached interface id -> instance
+        'az'            : dict(),   # availability zone -> list of instances
+        # instance id, public DNS name, public IP, private IPs and attached
+        # interface ids -> instance
+        'address'       : dict(),
+    }
+
+    for ix, instance in enumerate(instances):
+        address = indexes['address']
+
+        indexes['position'][instance['id']] = ix
+        address[instance['id']] = instance
+        if instance.get('public_dns'):
+            indexes['public_dns'][instance['public_dns']] = instance
+            address[instance['public_dns']] = instance
+        if instance.get('public_ip'):
+            address[instance['public_ip']] = instance
+        for interface in instance.get('interfaces', list()):
+            indexes['eni'][interface['id']] = instance
+            address[interface['id']] = instance
+            if interface.get('private_ip'):
+                address[interface['private_ip']] = instance
+        indexes['az'].setdefault(instance.get('az'), list()).append(instance)
+
+    return indexes
+
+def _index_interfaces(interfaces : dict) -> dict:
+    """Build the lookup indexes of a region's interfaces dictionary"""
+    indexes = {
+        'subnet'    : dict(),   # subnet id -> list of interfaces in it
+        'az'        : dict(),   # availability zone -> list of interfaces
+    }
+
+    for interface in interfaces.values():
+        indexes['subnet'].setdefault(interface.get('subnet'), list()).append(interface)
+        indexes['az'].setdefault(interface.get('az'), list()).append(interface)
+
+    return indexes
+
+
+def _region_changes(old_region : dict, new_region : dict, fields) -> dict:
+    """Describe what changed in @fields between two snapshots of a region.
+    Instances and interfaces are compared entry by entry, both by identity
+    since writers replace the entries they modify
+
+    @returns a dictionary which can contain 'instances' and 'interfaces'
+    (each with 'changed' and 'removed' entries) and 'fields' with the new
+    value of any other field which changed. Empty if nothing changed"""
+    changes = dict()
+
+    for field in fields:
+        old_value = old_region.get(field)
+        new_value = new_region.get(field)
+        if old_value is new_value:
+            continue
+
+        if field == 'instances':
+            old_instances = { instance['id'] : instance for instance in old_value or list() }
+            new_ids = set()
+            changed = list()
+            for instance in new_value:
+                new_ids.add(instance['id'])
+                old_instance = old_instances.get(instance['id'])
+                if old_instance is not instance and old_instance != instance:
+                    changed.append(instance)
+
+            removed = [ instance_id for instance_id in old_instances if instance_id not in new_ids ]
+            if changed or removed:
+                changes['instances'] = { 'changed' : changed, 'removed' : removed }
+
+        elif field == 'interfaces':
+            old_value = old_value or dict()
+            changed = { eni_id : eni for eni_id, eni in new_value.items()
+                        if old_value.get(eni_id) is not eni and old_value.get(eni_id) != eni }
+            removed = [ eni_id for eni_id in old_value if eni_id not in new_value ]
+            if changed or removed:
+                changes['interfaces'] = { 'changed' : changed, 'removed' : removed }
+
+        elif old_value != new_value:
+            changes.setdefault('fields', dict())[field] = new_value
+
+    return changes
+
+
+# The regions' data is published as read-only snapshots. Writers (serialized
+# by the cache lock) never modify a published region. Instead they create a
+# new copy of it and of the regions dictionary and swap it into
+# cache['regions']. Readers don't take the lock and get a consistent version
+# of the regions as long as they don't modify what they received.
+#
+# Each region snapshot has a 'version' field. Versions are unique and
+# increase monotonically across all regions and across server restarts, so
+# clients can tell whether the region they hold is outdated
 class awsh_cache:
 
     def __init__(self):
         self.cache = dict()
 
         self.lock = Lock()
-        self.needs_update = False
+
+        # the version given to the last published region snapshot
+        self.version = 0
+        # versions up to this one can be given without writing version_file.
+        # Only a cache read from the store (see read_cache()) reserves them
+        self.reserved_version = 0
+        self.is_stored = False
+
+        # region -> set of its fields which were modified since last written
+        self.dirty_fields = dict()
+        self.meta_dirty = False
+
+        # region -> { field -> its JSON encoding }. Only modified fields are
+        # encoded again when a region is written
+        self.encoded_fields = dict()
+        # region (or meta_file for the meta data) -> hash of the content last
+        # written to (or read from) disk
+        self.written_hashes = dict()
+
+        self.write_stats = {
+            'writes_performed'  : 0,
+            'writes_skipped'    : 0,
+        }
+
+        # region -> (version of a region snapshot, its JSON encoding as bytes).
+        # Used to reply state requests without encoding the regions each time
+        self.encoded_regions = dict()
+
+        # region -> { field -> (the field's value in a snapshot, its indexes) }
+        # for the instances and interfaces fields. Like the encodings, indexes
+        # are built on first use and kept until the field is replaced
+        self.region_indexes = dict()
+
+        # called with (region, version, changes) for each published region
+        # snapshot which differs from the previous one. The list is replaced
+        # rather than modified so the writers can iterate it without locking
+        self.listeners = list()
+        self.listeners_lock = Lock()
 
 
     def create_cache(self):
         self.cache['regions'] = dict()
         self.cache['ts_dict'] = dict()
+        self.cache['amis'] = dict()
 
 
     # Only the synchronous server accesses these fields
-    def is_record_old_enough(self, current_time, intervals, record):
-            ts_dict = self.cache['ts_dict']
-            if not record in ts_dict:
-                return True
+    def get_record_ts(self, record):
+        """Return the timestamp in which @record was last refreshed or None if
+        it never was"""
+        return self.cache['ts_dict'].get(record)
 
-            ts = ts_dict[record]
-            prev_time = datetime.fromtimestamp(ts)
 
-            return (current_time - prev_time).seconds >= intervals[record]
+    def __mark_dirty(self, region, *fields):
+        """Mark fields of a region as modified. Must be called with the lock
+        held (except for the region-less records written by the synchronous
+        server)"""
+        self.dirty_fields.setdefault(region, set()).update(fields)
 
+    def get_write_stats(self) -> dict:
+        """Return counters of region/meta writes which were performed and
+        skipped since their content didn't change"""
+        return dict(self.write_stats)
 
     # Only the synchronous server accesses these fields
     def update_record_ts(self, record, ts):
         self.cache['ts_dict'][record] = ts
+        self.meta_dirty = True
+
+    @synchronize_with_lock
+    def get_amis(self, ami_ids) -> dict:
+        """Get the cached name and distribution of AMIs
+
+        @ami_ids: the AMI ids to look for
+
+        @returns a dictionary with the AMIs found in cache. AMI ids are the keys
+        and a dictionary with 'name' and 'distro' fields is the value"""
+        amis = self.cache.setdefault('amis', dict())
+        return { ami_id : amis[ami_id] for ami_id in ami_ids if ami_id in amis }
+
+    @synchronize_with_lock
+    def set_amis(self, amis : dict):
+        """Add AMIs information to the cache. AMI names never change so
+        entries are never invalidated
+
+        @amis: dictionary with AMI ids as keys and a dictionary with 'name' and
+        'distro' fields as value"""
+        self.cache.setdefault('amis', dict()).update(amis)
+        self.meta_dirty = True
+
+    @synchronize_with_lock
+    def add_listener(self, listener, known_versions : Union[dict, None] = None):
+        """Call @listener(region, version, changes) each time a region
+        changes. @changes is described in _region_changes(). Listeners are
+        called with the cache lock held, in the order of the versions, and
+        shouldn't block
+
+        @known_versions: region -> version of the snapshot the listener's
+        owner holds. Each of these regions whose version differs is first
+        passed to the listener with a 'snapshot' of the whole region as
+        @changes, so that changes published before the listener was added
+        aren't missed"""
+        with self.listeners_lock:
+            self.listeners = self.listeners + [ listener ]
+
+        for region, known_version in (known_versions or dict()).items():
+            region_data = self.cache['regions'].get(region)
+            if region_data is None or region_data.get('version', 0) == known_version:
+                continue
+
+            try:
+                listener(region, region_data.get('version', 0), { 'snapshot' : region_data })
+            except Exception as e:
+                print(f"cache listener failed: {e}")
 
-    def __set_field_in_region(self, region, field, value):
-        if not region in self.cache['regions']:
-            self.cache['regions'][region] = dict()
+    def remove_listener(self, listener):
+        with self.listeners_lock:
+            self.listeners = [ l for l in self.listeners if l is not listener ]
 
-        self.cache['regions'][region][field] = value
+    def __notify_listeners(self, region, version, changes):
+        for listener in self.listeners:
+            try:
+                listener(region, version, changes)
+            except Exception as e:
+                print(f"cache listener failed: {e}")
+
+    def __publish_regions(self, updates : dict, with_changes = False) -> dict:
+        """Publish new snapshots of regions. Must be called with the lock held
+
+        @updates: dictionary with regions as keys and a dictionary of the
+        fields to set in the region as value
+        @with_changes: compute the changes even if there are no listeners
+
+        @returns a dictionary with regions as keys and their changes (see
+        _region_changes()) as value, if they were computed. Regions which
+        didn't change aren't published and have no changes"""
+        old_regions = self.cache['regions']
+        regions = dict(old_regions)
+
+        published = dict()
+        for region, fields in updates.items():
+            old_region = old_regions.get(region, dict())
+            # a refresh usually finds the region as it was. Fields which didn't
+            # change are left out and a region which didn't change keeps its
+            # snapshot, version and on-disk file
+            fields = { field : value for field, value in fields.items()
+                       if field not in old_region or
+                          (old_region[field] is not value and old_region[field] != value) }
+            if not fields:
+                continue
+            published[region] = fields
+
+            region_data = dict(old_region)
+            region_data.update(fields)
+
+            self.version += 1
+            if self.is_stored and self.version > self.reserved_version:
+                self.__reserve_versions()
+            region_data['version'] = self.version
+
+            regions[region] = region_data
+            self.__mark_dirty(region, 'version', *fields.keys())
+
+        # readers see either the old or the new regions dictionary
+        if published:
+            self.cache['regions'] = regions
+
+        if not self.listeners and not with_changes:
+            return dict()
+
+        all_changes = { region : dict() for region in updates }
+        for region, fields in published.items():
+            changes = _region_changes(old_regions.get(region, dict()), regions[region], fields)
+            all_changes[region] = changes
+
+            if changes:
+                self.__notify_listeners(region, regions[region]['version'], changes)
+
+        return all_changes
+
+    def __reserve_versions(self):
+        """Persist a new upper bound for the versions. After a restart,
+        versions continue from it, so they stay higher than those of
+        snapshots which were published but never written to the store"""
+        if not path.exists(store_dir):
+            os.makedirs(store_dir)
+
+        self.reserved_version = self.version + VERSIONS_RESERVATION
+        _atomic_write(version_file, str(self.reserved_version))
+
+    def get_encoded_region(self, region, region_data : dict = None) -> bytes:
+        """Get the JSON encoding of a region. The encoding is kept until the
+        region is modified
+
+        @region_data: the snapshot of the region to encode, the current one
+        by default
+
+        @returns the encoding of the region as ASCII bytes"""
+        if region_data is None:
+            region_data = self.cache['regions'][region]
+        version = region_data.get('version', 0)
+
+        encoded = self.encoded_regions.get(region)
+        # versions are unique, so the same version means the same content
+        if encoded is None or encoded[0] != version:
+            encoded = (version, json.dumps(region_data).encode('ascii'))
+            self.encoded_regions[region] = encoded
+
+        return encoded[1]
+
+    def __encode_regions(self, regions : dict) -> bytes:
+        """Encode @regions, a dictionary of region -> region snapshot"""
+        fragments = [ json.dumps(region).encode('ascii') + b': ' + self.get_encoded_region(region, region_data)
+                      for region, region_data in regions.items() ]
+
+        return b'{' + b', '.join(fragments) + b'}'
+
+    def __get_indexes(self, region_data : dict, region, field, build_index) -> dict:
+        value = region_data.get(field)
+        if value is None:
+            return build_index(list() if field == 'instances' else dict())
+
+        region_indexes = self.region_indexes.setdefault(region, dict())
+        indexed = region_indexes.get(field)
+        # snapshots aren't modified, so the same object means the same content
+        if indexed is None or indexed[0] is not value:
+            indexed = (value, build_index(value))
+            region_indexes[field] = indexed
+
+        return indexed[1]
+
+    def get_instances_indexes(self, region, region_data : dict = None) -> dict:
+        """Get the indexes of a region's instances (see _index_instances()).
+        @region_data is the snapshot to index, the current one by default"""
+        if region_data is None:
+            region_data = self.cache['regions'].get(region, dict())
+
+        return self.__get_indexes(region_data, region, 'instances', _index_instances)
+
+    def get_interfaces_indexes(self, region, region_data : dict = None) -> dict:
+        """Get the indexes of a region's interfaces (see _index_interfaces()).
+        @region_data is the snapshot to index, the current one by default"""
+        if region_data is None:
+            region_data = self.cache['regions'].get(region, dict())
+
+        return self.__get_indexes(region_data, region, 'interfaces', _index_interfaces)
+
+    def find_instance_by_dns(self, region, public_dns) -> Union[dict, None]:
+        """Get a cached instance by its public DNS name"""
+        return self.get_instances_indexes(region)['public_dns'].get(public_dns)
+
+    def get_free_interfaces(self, region, az = None) -> list:
+        """Get the interfaces which can be attached to an instance: the ones
+        which aren't attached and aren't deleted with their instance
+
+        @az: only return the interfaces in this availability zone"""
+        region_data = self.cache['regions'].get(region, dict())
+        attached = self.get_instances_indexes(region, region_data)['eni']
+        interfaces_indexes = self.get_interfaces_indexes(region, region_data)
+
+        if az is None:
+            interfaces = region_data.get('interfaces', dict()).values()
+        else:
+            interfaces = interfaces_indexes['az'].get(az, list())
+
+        return [ eni for eni in interfaces
+                 if not eni['delete_on_termination'] and eni['id'] not in attached ]
+
+    def lookup(self, address : str) -> tuple:
+        """Find an instance in any region by its id, public DNS name, public
+        IP, private IP or the id of an attached interface
+
+        @returns a tuple of the instance's region and the instance, or
+        (None, None) if no instance matches"""
+        # each region's index is only rebuilt when the region's instances
+        # change, so probing them is cheaper than merging them into one
+        for region, region_data in self.cache['regions'].items():
+            instance = self.get_instances_indexes(region, region_data)['address'].get(address)
+            if instance is not None:
+                return region, instance
+
+        return None, None
+
+    def get_encoded_state(self) -> bytes:
+        """Get the JSON encoding of all regions (identical to json.dumps() of
+        get_instances()) built from the regions' encodings"""
+        return self.__encode_regions(self.cache['regions'])
+
+    def get_encoded_changed_regions(self, known_versions : dict) -> bytes:
+        """Get the JSON encoding of the regions whose version differs from
+        @known_versions (a dictionary of region -> version). Regions missing
+        from it are included as well
+
+        @returns the encoding of a dictionary with the changed regions, empty
+        if none changed"""
+        changed = { region : region_data for region, region_data in self.cache['regions'].items()
+                    if region_data.get('version', 0) != known_versions.get(region) }
+
+        return self.__encode_regions(changed)
 
     @synchronize_with_lock
     def set_interface(self, interface_id, interface, region):
@@ -66,9 +508,11 @@ class awsh_cache:
         @interface_id: the id by which this interface would be saved
         @interface: the metadata for this interface
         @region: the region to which this interface belongs"""
-        self.cache['regions'][region]['interfaces'][interface_id] = interface
+        interfaces = dict(self.cache['regions'][region]['interfaces'])
+        interfaces[interface_id] = interface
+
+        self.__publish_regions({ region : { 'interfaces' : interfaces } })
 
-    @synchronize_with_lock
     def __set_cache_entry(self, entry, values, region=None):
         """Set an entry in the cache, e.g. instances, interfaces or
         has_running_instances field
@@ -77,56 +521,143 @@ class awsh_cache:
         @values(dict): the value of this entry
         @region: region(s) in in which the interfaces belong. This can be either
             a string for a single region, or a list in which case"""
+        self.__set_cache_entries({ entry : values }, region)
 
-        if region is None:
-            for region in values.keys():
-                self.__set_field_in_region(region=region, field=entry, value=values[region])
-        elif isinstance(region, str):
-            self.__set_field_in_region(region=region, field=entry, value=values)
-        else:
-            # this assignment have no effect other than to signify that we have
-            # several regions
-            regions = region
-            for region in regions:
-                self.__set_field_in_region(region=region, field=entry, value=values[region])
-
-    def set_instances(self, instances : Union[list, dict], region : Union[str, list, None] = None):
+    @synchronize_with_lock
+    def __set_cache_entries(self, entries : dict, region=None):
+        """Set several entries of regions in a single snapshot of each region
+
+        @entries: dictionary with the entries as keys and their values (as
+            described in __set_cache_entry()) as value
+        @region: like in __set_cache_entry()"""
+        updates = dict()
+        for entry, values in entries.items():
+            if region is None:
+                regions = values.keys()
+            elif isinstance(region, str):
+                regions = [ region ]
+                values = { region : values }
+            else:
+                regions = region
+
+            for region_name in regions:
+                updates.setdefault(region_name, dict())[entry] = values[region_name]
+
+        self.__publish_regions(updates)
+
+    def set_instances(self, instances : Union[list, dict], region : Union[str, list, None] = None,
+                      has_running_instances : Union[bool, dict, None] = None):
         """Set list of instances in region(s) from cache
         @instances(list): the instances in the region
         @region(str/list): region(s) in in which the instances belong. This can be either
             a string for a single region, or a list in which case
-            @instances would be a dictionary with keys equal to @region elements"""
-        self.__set_cache_entry('instances', instances, region)
+            @instances would be a dictionary with keys equal to @region elements
+        @has_running_instances: if specified, whether the region(s) have running
+            instances (in the same form as @instances). Set along with the
+            instances, in the same snapshot"""
+        entries = { 'instances' : instances }
+        if has_running_instances is not None:
+            entries['has_running_instances'] = has_running_instances
 
+        self.__set_cache_entries(entries, region)
 
-    @synchronize_with_lock
-    def set_instance(self, instance : dict, region : str, is_running = None):
+
+    def set_instance(self, instance : dict, region : str, is_running = None) -> dict:
         """Update a single instance entry in the cache
         @instance: the instance data. This data should contain 'id' field
                    which identifies its id
         @region: the instance's region
         @is_running: whether the instance is in a running state
 
-        @return None
+        @return the region's patch (see update_region_entries())
         """
-        instances = self.cache['regions'][region]['instances']
+        return self.update_region_entries(region, instances=[ instance ], is_running=is_running)
 
-        instance_ix = None
-        for index, cached_instance in enumerate(instances):
-            if cached_instance["id"] == instance["id"]:
-                instance_ix = index
-                break
 
-        if instance_ix is not None:
-            instances[instance_ix] = instance
-        else:
-            instances.append(instance)
+    @synchronize_with_lock
+    def update_region_entries(self, region : str, instances : Union[list, None] = None,
+                              interfaces : Union[dict, None] = None, is_running = None) -> dict:
+        """Update some of the instances and interfaces of a region. Entries
+        which aren't in the cache are added
+
+        @instances: the new instances entries, identified by their 'id' field
+        @interfaces: dictionary of the new interfaces entries by their id
+        @is_running: whether any of the updated instances is in a running state
+
+        @return a patch which brings a copy of the region up to date with
+        the update: the changes as described in _region_changes() along with
+        the region and its new 'version'
+        """
+        region_data = self.cache['regions'][region]
+        fields = dict()
+
+        if instances:
+            positions = self.get_instances_indexes(region, region_data)['position']
+            cached_instances = list(region_data['instances'])
+            for instance in instances:
+                ix = positions.get(instance['id'])
+                if ix is None:
+                    cached_instances.append(instance)
+                else:
+                    cached_instances[ix] = instance
+            fields['instances'] = cached_instances
+
+        if interfaces:
+            cached_interfaces = dict(region_data.get('interfaces', dict()))
+            cached_interfaces.update(interfaces)
+            fields['interfaces'] = cached_interfaces
 
         if is_running is not None:
-            self.cache['regions'][region]['has_running_instances'] |= is_running
+            fields['has_running_instances'] = region_data.get('has_running_instances', False) | is_running
+
+        changes = self.__publish_regions({ region : fields }, with_changes=True)
+
+        version = self.cache['regions'][region].get('version', 0)
+        return dict(changes[region], region=region, version=version)
 
 
     @synchronize_with_lock
+    def apply_instance_changes(self, region : str, changed_instances : list,
+                               removed_ids : list, has_running_instances : bool):
+        """Merge the result of an incremental instances query into a region
+
+        @region: the region of the instances
+        @changed_instances: new or modified instances entries
+        @removed_ids: ids of instances which no longer exist
+        @has_running_instances: whether any instance in the region is running
+        """
+        region_data = self.cache['regions'].get(region, dict())
+
+        changed = { instance['id'] : instance for instance in changed_instances }
+        removed_ids = set(removed_ids)
+
+        instances = list()
+        for cached_instance in region_data.get('instances', list()):
+            instance_id = cached_instance['id']
+            if instance_id in removed_ids:
+                continue
+
+            instances.append(changed.pop(instance_id, cached_instance))
+
+        # whatever is left wasn't in the cache before
+        instances.extend(changed.values())
+
+        self.__publish_regions({ region : {
+            'instances'             : instances,
+            'has_running_instances' : has_running_instances,
+        } })
+
+    def get_instances_states(self, region : str) -> dict:
+        """Get the state code of every cached instance in region
+
+        @returns a dictionary with instance ids as keys and state code as value"""
+        try:
+            instances = self.cache['regions'][region]['instances']
+        except KeyError:
+            return dict()
+
+        return { instance['id'] : instance['state']['Code'] for instance in instances }
+
     def get_instances(self, region=None):
         """Set list of instances in region from cache"""
         if region is None:
@@ -140,7 +671,6 @@ class awsh_cache:
             except:
                 return dict()
 
-    @synchronize_with_lock
     def get_region_data(self, region):
         """Get the cache information for a single region"""
         return self.cache['regions'][region]
@@ -176,7 +706,6 @@ class awsh_cache:
         self.__set_cache_entry('subnets', subnets, region)
 
 
-    @synchronize_with_lock
     def get_interfaces(self, region=None):
         """Set list of interfaces in region from cache"""
         if region is None:
@@ -191,29 +720,153 @@ class awsh_cache:
                 return dict()
 
 
+    def query(self, target : str, filters : dict, fields : list = None,
+              regions : list = None) -> dict:
+        """Find the entries of a type which match some filters
+
+        @target: one of QUERY_TARGETS
+        @filters: dictionary with entry fields as keys and a list of glob
+            patterns as value. An entry matches if each of the fields matches
+            one of its patterns. Instances are matched by the name of their
+            'state'. Interfaces can be filtered by 'free' ('true' or 'false'),
+            whether they can be attached to an instance
+        @fields: the fields of the matching entries to return. All of them if
+            None
+        @regions: the regions to search, all regions if None
+
+        @returns a dictionary with regions as keys and a list of the matching
+        entries as value. Regions without matches are omitted, unless they
+        were listed in @regions. Regions which aren't cached are omitted"""
+        if target not in QUERY_TARGETS:
+            raise ValueError(f"can't query {target}, expected one of {QUERY_TARGETS}")
+
+        # a consistent snapshot of all regions
+        all_regions = self.cache['regions']
+        keep_empty = regions is not None
+        if regions is None:
+            regions = all_regions.keys()
+
+        filters = dict(filters)
+        free = filters.pop('free', None)
+
+        results = dict()
+        for region in regions:
+            region_data = all_regions.get(region)
+            if region_data is None:
+                continue
+
+            entries = region_data.get(target, list())
+            if isinstance(entries, dict):
+                entries = entries.values()
+
+            # a filter on an indexed field without wildcards narrows the
+            # entries to check down to the ones it lists
+            indexes = dict()
+            if target == 'instances':
+                indexes = self.get_instances_indexes(region, region_data)
+            elif target == 'interfaces':
+                indexes = self.get_interfaces_indexes(region, region_data)
+
+            for field in [ 'subnet', 'az' ]:
+                patterns = filters.get(field)
+                if field not in indexes or not patterns or any(_has_wildcards(p) for p in patterns):
+                    continue
+
+                entries = [ entry for value in dict.fromkeys(patterns)
+                                  for entry in indexes[field].get(value, list()) ]
+                break
+
+            if target == 'interfaces' and free is not None:
+                want_free = free[0].lower() == 'true'
+                attached = self.get_instances_indexes(region, region_data)['eni']
+                entries = [ eni for eni in entries
+                            if (not eni['delete_on_termination'] and eni['id'] not in attached) == want_free ]
+
+            matches = list()
+            for entry in entries:
+                if not all(_matches_patterns(_query_value(entry, field), patterns)
+                           for field, patterns in filters.items()):
+                    continue
+
+                if fields is not None:
+                    entry = { field : entry.get(field) for field in fields }
+                matches.append(entry)
+
+            if matches or keep_empty:
+                results[region] = matches
+
+        return results
+
+
+    def __encode_region(self, region, dirty_fields) -> str:
+        """Return the JSON encoding of a region, re-encoding only its
+        @dirty_fields. The result is identical to json.dumps() of the region"""
+        region_data = self.cache['regions'][region]
+        encoded_fields = self.encoded_fields.setdefault(region, dict())
+
+        fragments = list()
+        for field, value in region_data.items():
+            if field in dirty_fields or field not in encoded_fields:
+                encoded_fields[field] = json.dumps(value)
+
+            fragments.append('{}: {}'.format(json.dumps(field), encoded_fields[field]))
+
+        return '{' + ', '.join(fragments) + '}'
+
     def update_cache(self):
+        """Write the regions which changed since last call (and the meta data
+        if it changed) to the on-disk store. Regions whose content is the same
+        as the one on disk aren't written.
 
-        if not path.exists(cache_dir):
-            os.makedirs(cache_dir)
+        @returns False if the store is locked by another process"""
 
-        if not self.needs_update:
-            return True
+        if not path.exists(regions_dir):
+            os.makedirs(regions_dir)
 
-        # duplicate logic to avoid locking a non-existent file
-        if not path.isfile(cache_file):
-            with open(cache_file, 'w') as f:
-                json.dump(self.cache, f, indent=4)
+        # serialize under lock to get a consistent view of each region
+        with self.lock:
+            dirty_fields = self.dirty_fields
+            meta_dirty = self.meta_dirty
+
+            if not dirty_fields and not meta_dirty:
+                return True
+
+            to_write = dict()
+            for region, fields in dirty_fields.items():
+                to_write[path.join(regions_dir, region)] = self.__encode_region(region, fields)
+
+            if meta_dirty:
+                to_write[meta_file] = json.dumps({ field : self.cache.get(field, dict())
+                                                   for field in META_FIELDS })
+
+            self.dirty_fields = dict()
+            self.meta_dirty = False
+
+        hashes = dict()
+        for file_path, data in list(to_write.items()):
+            hashes[file_path] = _content_hash(data)
+            if self.written_hashes.get(file_path) == hashes[file_path]:
+                self.write_stats['writes_skipped'] += 1
+                del to_write[file_path]
+
+        if not to_write:
             return True
 
-        with open(cache_file, 'w') as f:
+        with open(lock_file, 'a+') as f:
             try:
                 fcntl.lockf(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
             except:
+                # try again next time
+                with self.lock:
+                    for region, fields in dirty_fields.items():
+                        self.__mark_dirty(region, *fields)
+                    self.meta_dirty |= meta_dirty
                 return False
 
-            json.dump(self.cache, f, indent=4)
-
-            self.needs_update = False
+            for file_path, data in to_write.items():
+                _atomic_write(file_path, data)
+                self.written_hashes[file_path] = hashes[file_path]
+                self.write_stats['writes_performed'] += 1
 
             try:
                 fcntl.lockf(f, fcntl.LOCK_UN)
@@ -223,31 +876,106 @@ class awsh_cache:
         return True
 
 
-    def read_cache(self):
-        cached_info = None
+    def __migrate_cache_file(self):
+        """Move the cache from the single file used by older versions into the
+        store"""
+        cached_info = _read_json(cache_file)
+        if not cached_info:
+            return
+
+        self.cache = cached_info
+        for field in META_FIELDS:
+            self.cache.setdefault(field, dict())
+
+        for region, region_data in self.cache['regions'].items():
+            self.__mark_dirty(region, *region_data.keys())
+        self.meta_dirty = True
+
+        if not self.update_cache():
+            raise Exception("Cache is busy, failed to migrate it")
 
+        os.rename(cache_file, cache_file + ".migrated")
+
+
+    def read_region(self, region : str) -> bool:
+        """Load a single region from the on-disk store, without reading the
+        rest of the store
+
+        @returns False if the region isn't stored or its file can't be read"""
+        region_file = path.join(regions_dir, region)
+        if not path.isfile(region_file):
+            return False
+
+        try:
+            with open(region_file, 'r') as f:
+                data = f.read()
+            region_data = json.loads(data)
+        except (OSError, ValueError) as e:
+            # the region is queried again instead
+            print(f"Skipping unreadable region file {region_file}: {e}")
+            return False
+
+        if not isinstance(region_data, dict):
+            print(f"Skipping malformed region file {region_file}")
+            return False
+
+        with self.lock:
+            regions = dict(self.cache.get('regions', dict()))
+            regions[region] = region_data
+            self.cache['regions'] = regions
+
+            # keep versions increasing across restarts
+            self.version = max(self.version, region_data.get('version', 0))
+
+            self.encoded_fields.pop(region, None)
+            self.written_hashes[region_file] = _content_hash(data)
+
+        return True
+
+
+    def read_cache(self):
         if not path.exists(cache_dir):
             os.makedirs(cache_dir)
 
-        if not path.isfile(cache_file):
-            self.create_cache()
+        self.create_cache()
+        self.is_stored = True
+
+        if not path.exists(store_dir) and path.isfile(cache_file):
+            self.__migrate_cache_file()
             return True
 
-        with open(cache_file, 'r') as f:
+        if not path.exists(store_dir):
+            return True
+
+        with open(lock_file, 'a+') as f:
             try:
                 fcntl.lockf(f, fcntl.LOCK_SH)
             except:
                 return False
 
-            cached_info = json.load(f)
+            if path.isfile(version_file):
+                with open(version_file, 'r') as version_f:
+                    self.version = max(self.version, int(version_f.read()))
+
+            if path.isfile(meta_file):
+                with open(meta_file, 'r') as meta_f:
+                    data = meta_f.read()
+                meta = json.loads(data)
+                self.written_hashes[meta_file] = _content_hash(data)
+                for field in META_FIELDS:
+                    self.cache[field] = meta.get(field, dict())
+
+            regions = os.listdir(regions_dir) if path.isdir(regions_dir) else []
+            for region in regions:
+                # leftover of an interrupted write
+                if region.startswith('.tmp-'):
+                    continue
+
+                self.read_region(region)
 
             try:
                 fcntl.lockf(f, fcntl.LOCK_UN)
             except:
                 print("Failed to unlock for some reason")
 
-        if not cached_info:
-            return False
-
-        self.cache = cached_info
         return True
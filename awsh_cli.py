@@ -4,7 +4,7 @@ import json
 from collections import OrderedDict
 
 from awsh_curses import awsh_curses, run_curses_command, enter_debug
-from awsh_client import get_current_state, awsh_client
+from awsh_client import query_state, awsh_client
 import awsh_cache
 
 region=""
@@ -99,23 +99,28 @@ def create_intefaces(stdscr, output_stream, args):
         # client mode
         try:
             client = awsh_client(region, None, None, synchronous=True)
-            regions = get_current_state()
+            # only the region's subnets and interfaces are sent. A region
+            # which is asked for explicitly is in the reply (possibly with no
+            # entries) as long as the server caches it
+            regions = query_state('subnets', regions=[ region ])
 
             logger.debug("Contacted running server")
 
             if not region in regions:
-                # logger.error("Cannot find region {region} in cache")
+                logger.error(f"Cannot find region {region} in cache")
                 return
 
-            # TODO: maybe implement a client command to only get the intercaces?
-            # Only matters to be analog to ec2 path.
-            subnets = regions[region]['subnets']
-            interfaces = regions[region]['interfaces']
+            subnets = { subnet['id'] : subnet for subnet in regions[region] }
+            interfaces = { eni['id'] : eni
+                           for eni in query_state('interfaces', regions=[ region ])[region] }
         except ConnectionRefusedError as e:
             logger.info("No running server was found")
             if args.force_client_mode:
                 logger.error("force client mode requested, terminating")
                 return
+        except ValueError as e:
+            logger.error(f"Failed to query the server: {e}")
+            return
 
     # either failed to contact client or asked to access ec2 directly
     if regions is None:
@@ -1,17 +1,49 @@
 from typing import Union, Callable
 
-from awsh_req_resp_server import awsh_req_client
+from awsh_cache import cache_dir, _atomic_write
+from awsh_req_resp_server import awsh_req_client, get_shared_client
 from awsh_server import awsh_server_commands
 from awsh_utils import (find_in_saved_logins,
+                        index_instances_in_saved_logins,
                         awsh_get_subnet_color)
 from awsh_ui import awsh_rofi
 
 import json
+import os
 import re
 
 
+# region -> region data, as received by the last get_current_state() call.
+# Replaced rather than modified, so callers can keep the dictionary they got
+last_state = dict()
+
+# last_state of the previous client process, so that a new GUI or CLI call
+# only downloads the regions which changed since
+client_state_file = cache_dir + "/client_state"
+
+def _read_client_state():
+    try:
+        with open(client_state_file, 'r') as f:
+            regions = json.load(f)
+    except FileNotFoundError:
+        return dict()
+    except (OSError, ValueError) as e:
+        print(f"Failed to read client state: {e}")
+        return dict()
+
+    return regions if isinstance(regions, dict) else dict()
+
+def _write_client_state(regions : dict):
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        _atomic_write(client_state_file, json.dumps(regions))
+    except OSError as e:
+        print(f"Failed to save client state: {e}")
+
 # TODO: this probably needs to be integrated into the client
 def get_current_state(req_client = None):
+    global last_state
+
     # from awsh_cache import awsh_cache
 
     # cache = awsh_cache()
@@ -19,17 +51,106 @@ def get_current_state(req_client = None):
         # print("Failed to read cache")
     # return cache.get_instances()
 
-    req_client = awsh_req_client(fail_if_no_server=True, synchronous=True)
-    command = awsh_server_commands.GET_CURRENT_COMPLETE_STATE
-    request = '{}'.format(command)
+    req_client = get_shared_client()
+    # raises ConnectionRefusedError if there's no server
+    req_client.ensure_connected()
 
-    # import pickle
+    # start from the regions received in the previous call (or by the
+    # previous process) and only download the ones which changed since
+    if not last_state:
+        last_state = _read_client_state()
+    regions = dict(last_state)
+
+    command = awsh_server_commands.GET_STATE_IF_CHANGED
+    known_versions = [ '{}:{}'.format(region, region_data.get('version', 0))
+                       for region, region_data in regions.items() ]
+    request = ' '.join([ str(command) ] + known_versions)
 
     # ignore server's request failure (we assume that it cannot happen)
     _, server_reply = req_client.send_request_blocking(request)
+    changed_regions = json.loads(server_reply)
+    regions.update(changed_regions)
+
+    if changed_regions:
+        _write_client_state(regions)
+    last_state = regions
+
+    return regions
+
+
+def query_state(target : str = 'instances', fields : Union[list, None] = None,
+                regions : Union[list, None] = None, **filters) -> dict:
+    """Ask the server for the entries of @target (instances, interfaces or
+    subnets) which match @filters, instead of downloading whole regions
+
+    @fields: the fields of each entry to return, all of them if None
+    @regions: the regions to search, all of them if None
+    @filters: entry field -> a glob pattern or a list of them (e.g.
+        state='running', az='us-west-2*', name=['web-*', 'db-*'])
+
+    @returns a dictionary with regions as keys and the list of matching
+    entries as value"""
+    req_client = get_shared_client()
+    # raises ConnectionRefusedError if there's no server
+    req_client.ensure_connected()
+
+    arguments = [ str(awsh_server_commands.QUERY), f'target={target}' ]
+    if fields is not None:
+        arguments.append('fields=' + ','.join(fields))
+    if regions is not None:
+        arguments.append('region=' + ','.join(regions))
+    for field, patterns in filters.items():
+        if isinstance(patterns, str):
+            patterns = [ patterns ]
+        arguments.append(f'{field}=' + ','.join(patterns))
+
+    status, server_reply = req_client.send_request_blocking(' '.join(arguments))
+    if status != 0:
+        raise ValueError(f"query failed: {server_reply}")
+
     return json.loads(server_reply)
 
 
+def lookup_instance(address : str) -> tuple:
+    """Find an instance in any region by its id, public DNS name, public IP,
+    private IP or the id of an attached interface
+
+    @returns a tuple of the instance's region and its information, or
+    (None, None) if the server doesn't know it"""
+    req_client = get_shared_client()
+    # raises ConnectionRefusedError if there's no server
+    req_client.ensure_connected()
+
+    request = '{} {}'.format(awsh_server_commands.LOOKUP, address)
+    status, server_reply = req_client.send_request_blocking(request)
+    if status != 0:
+        raise ValueError(f"lookup failed: {server_reply}")
+
+    reply = json.loads(server_reply)
+    return reply.get('region'), reply.get('instance')
+
+
+def lookup_instance_in_saved_state(address : str) -> tuple:
+    """Find an instance like lookup_instance() does, in the state saved by the
+    last get_current_state() call. For when there's no server to ask
+
+    @returns a tuple of the instance's region and its information, or
+    (None, None) if it isn't in the saved state"""
+    for region, region_data in _read_client_state().items():
+        for instance in region_data.get('instances', list()):
+            addresses = [ instance.get('id'), instance.get('public_dns'), instance.get('public_ip') ]
+            for interface in instance.get('interfaces', list()):
+                addresses.extend([ interface.get('id'), interface.get('private_ip') ])
+
+            if address in addresses:
+                return region, instance
+
+    return None, None
+
+
+# seconds to wait before renewing a subscription which ended
+RESUBSCRIBE_DELAY = 5
+
 CLIENT_CALLBACK=Callable[[int, int, Union[dict,None]], None]
 
 class awsh_client:
@@ -39,12 +160,15 @@ class awsh_client:
 
     def __init__(self, region : str, instances : list,
                  interfaces : dict,
-                 synchronous : bool = False):
+                 synchronous : bool = False,
+                 version : int = 0):
         # state variable. Holds current regions state
         self.region = region
 
         self.instances = instances
         self.interfaces = interfaces
+        # the version of the region snapshot the state was taken from
+        self.version = version
 
         # self.remove_used_interfaces_from_pool()
 
@@ -67,6 +191,60 @@ class awsh_client:
             # command=awsh_server_commands.START_INSTANCE,
             # arguments=argument_string, request_id=request_id)
 
+    def apply_patch(self, patch : dict):
+        """Apply a patch of the region (the reply of a mutating command or a
+        subscription event) to the state. Patches which aren't newer than the
+        state are ignored
+
+        @returns the indices of the instances which were modified in place, or
+        None if instances were added or removed. In the latter case
+        self.instances is replaced by a new list"""
+        if patch["version"] <= self.version:
+            return list()
+
+        self.version = patch["version"]
+        changed_rows = list()
+
+        # the whole region, sent when the changes since self.version weren't
+        # followed (e.g. when subscribing)
+        snapshot = patch.get("snapshot")
+        if snapshot is not None:
+            self.interfaces.clear()
+            self.interfaces.update(snapshot.get("interfaces", dict()))
+            self.instances = list(snapshot.get("instances", list()))
+            return None
+
+        interfaces_changes = patch.get("interfaces", dict())
+        self.interfaces.update(interfaces_changes.get("changed", dict()))
+        for eni_id in interfaces_changes.get("removed", list()):
+            self.interfaces.pop(eni_id, None)
+
+        instances_changes = patch.get("instances")
+        if not instances_changes:
+            return changed_rows
+
+        instances_ixs = { instance["id"] : ix for ix, instance in enumerate(self.instances) }
+
+        changed = instances_changes["changed"]
+        removed = set(instances_changes["removed"])
+        added = [ instance for instance in changed if instance["id"] not in instances_ixs ]
+
+        if added or removed:
+            changed = { instance["id"] : instance for instance in changed }
+            instances = [ changed.get(instance["id"], instance) for instance in self.instances
+                          if instance["id"] not in removed ]
+            instances.extend(added)
+
+            self.instances = instances
+            return None
+
+        for instance in changed:
+            ix = instances_ixs[instance["id"]]
+            self.instances[ix] = instance
+            changed_rows.append(ix)
+
+        return changed_rows
+
     def get_req_id(self):
         request_id = self.next_req_id
         self.next_req_id = request_id + 1
@@ -75,29 +253,28 @@ class awsh_client:
 
     def remove_used_interfaces_from_pool(self):
         """Mark interfaces which are attached to interfaces as used. This way
-        they won't be presented as an option when connecting an interface"""
-
-        for instance in self.instances:
-            try:
-                for interface in instance['interfaces']:
-                    eni = interface['id']
-                    # default interfaces not always listed in interfaces or the data
-                    # might be stale
-                    if eni in self.interfaces:
-                        self.interfaces[eni]['status'] = "in-use"
+        they won't be presented as an option when connecting an interface.
+        Mustn't be called from a response handler"""
 
-            except KeyError as e:
-                print(f"Couldn't find key \"{e.args[0]}\" in {instance['id']} for region {self.region}")
+        # the server finds them with its index of the attached interfaces
+        used_interfaces = query_state('interfaces', fields=[ 'id' ], regions=[ self.region ],
+                                      free='false').get(self.region, list())
+        for interface in used_interfaces:
+            eni = interface['id']
+            # the data might be stale
+            if eni in self.interfaces:
+                self.interfaces[eni]['status'] = "in-use"
 
 
     def send_client_command(self, command, arguments, request_id,
                             handler : Union[CLIENT_CALLBACK, None] = None):
         try:
-            req_client = awsh_req_client(synchronous=self.synchronous)
+            # all commands share the process' connection to the server
+            req_client = get_shared_client()
             request = '{} {}'.format(command, arguments)
 
             # this function is called by the request client
-            # after it finishes its connection with the server
+            # once the server replies
             # TODO: Does this function needs to be inlined ?
             # (does it access some variables in the parent function ? If not
             # worth moving it to have smaller indentation)
@@ -105,10 +282,6 @@ class awsh_client:
                              response_status : int,
                              server_reply : str):
 
-                # we maintain a connection per-request
-                if not self.synchronous:
-                    connection.close()
-
                 if response_status != 0:
                     print("request id {} failed with status {} and reply {}".format(
                           request_id, response_status, server_reply))
@@ -172,17 +345,14 @@ class awsh_client:
                 finish_callback(0, 1, None)
             return
 
-        def set_state_cb(request_id, status, instances):
+        # the reply is the region's patch, which the owner of the state applies
+        # using apply_patch()
+        def set_state_cb(request_id, status, patch):
             if status != 0:
                 return
 
-            # NULL or empty dictionary means the sever has no update for
-            # our instances state
-            if instances:
-                self.instances = instances
-
             if finish_callback:
-                finish_callback(request_id, status, instances)
+                finish_callback(request_id, status, patch)
 
         # assign request id
         request_id = self.get_req_id()
@@ -304,7 +474,9 @@ class awsh_client:
         @color: subnet color"""
         az_subnets = dict()
 
-        # find all subnets and their colors
+        # find all subnets and their colors. The client already holds the
+        # region's interfaces (kept in sync by the server's events), so they
+        # aren't queried again
         for interface in self.interfaces.values():
             if interface['az'] != az:
                 continue
@@ -499,9 +671,52 @@ class awsh_client:
 
         return index
 
+    def subscribe(self, event_handler : Callable[[dict], None]):
+        """Ask the server to push the changes made to the region's instances
+        and interfaces. @event_handler(event) is called from the connection's
+        thread with each change (see awsh_server's SUBSCRIBE command).
+
+        The server first sends the region if it changed since self.version,
+        and the subscription is renewed the same way if the connection to
+        the server is lost"""
+        req_client = get_shared_client()
+
+        def handle_event(connection : awsh_req_client, event : str):
+            event_handler(json.loads(event))
+
+        def handle_reply(connection : awsh_req_client, status : int, reply : str):
+            print(f"subscription to region {self.region} ended with status {status}: {reply}, "
+                  f"resubscribing in {RESUBSCRIBE_DELAY}s")
+            # the server might be restarting. Called from the connection's
+            # loop, which the request mustn't block
+            connection.loop.call_later(RESUBSCRIBE_DELAY, send_subscribe)
+
+        def send_subscribe():
+            request = '{} {}:{}'.format(awsh_server_commands.SUBSCRIBE, self.region, self.version)
+            req_client.send_request(request, handle_reply, handle_event)
+
+        send_subscribe()
+
+    def index_instances(self, finish_callback = None) -> dict:
+        """Save the logins of all running instances in the region with a
+        single write to the saved logins
+
+        @returns a dictionary with instance ids as keys and their index as
+        value"""
+        indices = index_instances_in_saved_logins(self.instances)
+
+        if finish_callback is not None:
+            finish_callback(indices)
+
+        return indices
+
     def get_instance_info_from_server_by_address(self, instance_dns: str):
         """Query AWSH server for a information about an instance based on its
-           DNS address"""
+           DNS address
+
+           @returns the instance's information or None if it isn't found"""
+        _, instance = lookup_instance(instance_dns)
+        return instance
 
 
 def testing():
@@ -1,7 +1,12 @@
 #!/usr/bin/env python3
 
-from typing import Any, List, Tuple
+from typing import Any, Callable, List, Tuple
+import concurrent.futures
+import logging
+import threading
+import time
 import boto3
+import botocore.config
 import botocore.exceptions
 
 from awsh_utils import get_os_by_ami_name
@@ -21,6 +26,133 @@ os_to_username = {
 RUNNING_STATE_CODE = 16
 TERMINATED_STATE_CODE = 48
 
+# Number of regions queried in parallel when sweeping several regions, and the
+# time (in seconds) we're willing to wait for a single region to answer
+DEFAULT_REGIONS_CONCURRENCY = 8
+DEFAULT_REGION_TIMEOUT = 60
+
+# Number of HTTP connections kept alive per region. Connections are shared
+# between the sweeps and the requests the server handles
+DEFAULT_MAX_POOL_CONNECTIONS = 10
+
+# How the regions' inventory (instances, interfaces, subnets) is queried. The
+# 'client' backend uses paginated describe_* calls and parses their replies
+# directly, the 'resource' backend iterates boto3 resource objects
+INVENTORY_BACKEND_CLIENT = 'client'
+INVENTORY_BACKEND_RESOURCE = 'resource'
+
+# maximum page size allowed by the describe_* calls we use
+INVENTORY_PAGE_SIZE = 1000
+# number of instances described in a single describe_instances call when
+# specifying their ids
+INSTANCE_IDS_CHUNK = 200
+# number of AMIs described in a single describe_images call (the maximum
+# number of values of a filter)
+AMI_FILTER_MAX_VALUES = 200
+
+NOT_TERMINATED_STATES = [ 'pending', 'running', 'shutting-down', 'stopping', 'stopped' ]
+
+def get_name_tag(tags):
+    """Return the value of 'Name' tag out of a list of tags as returned by
+    EC2 or an empty string if it doesn't exist"""
+    if not tags:
+        return ''
+
+    for tag in tags:
+        if tag['Key'] == 'Name':
+            return tag['Value']
+
+    return ''
+
+def parse_instance_interfaces(network_interfaces : list) -> list:
+    """Parse the 'NetworkInterfaces' list of an instance description into
+    the interfaces list kept for each instance"""
+    interfaces = list()
+    for interface_attr in network_interfaces:
+        card_id_index = 0
+        # on some instances the network card index is specified as well,
+        # while on others it's not
+        if 'NetworkCardIndex' in interface_attr['Attachment']:
+            card_id_index = interface_attr['Attachment']['NetworkCardIndex']
+
+        interface = {
+            'id'                    : interface_attr['NetworkInterfaceId'],
+            'mac'                   : interface_attr['MacAddress'],
+            'private_ip'            : interface_attr['PrivateIpAddress'],
+            'subnet'                : interface_attr['SubnetId'],
+            'vpc'                   : interface_attr['VpcId'],
+            'security_group'        : interface_attr['Groups'],
+            'delete_on_termination' : interface_attr['Attachment']['DeleteOnTermination'],
+            'device_index'          : interface_attr['Attachment']['DeviceIndex'],
+            'card_id_index'         : card_id_index,
+            'description'           : interface_attr['Description'],
+        }
+        interfaces.append(interface)
+
+    interfaces.sort(key=lambda k: k['card_id_index'])
+
+    return interfaces
+
+def parse_instance_description(instance : dict, amis : dict) -> dict:
+    """Parse an instance as returned by describe_instances into the instance
+    entry kept in the cache
+
+    @instance: the instance description
+    @amis: AMIs information as returned by Aws._resolve_amis()"""
+    interfaces = parse_instance_interfaces(instance.get('NetworkInterfaces', []))
+    ami = amis[instance['ImageId']]
+
+    return {
+        'name'              : get_name_tag(instance.get('Tags')),
+        'id'                : instance['InstanceId'],
+        'ena_support'       : instance.get('EnaSupport'),
+        'state'             : instance['State'],
+        'architecture'      : instance['Architecture'],
+        'ami_id'            : instance['ImageId'],
+        'ami_name'          : ami['name'],
+        'distro'            : ami['distro'],
+        'key'               : instance.get('KeyName'),
+        'public_dns'        : instance.get('PublicDnsName'),
+        'public_ip'         : instance.get('PublicIpAddress'),
+        'placement'         : instance['Placement'],
+        'az'                : instance['Placement']["AvailabilityZone"],
+        'instance_type'     : instance['InstanceType'],
+        'interfaces'        : interfaces,
+        'num_interfaces'    : len(interfaces),
+    }
+
+def parse_eni_description(interface : dict) -> dict:
+    """Parse an interface as returned by describe_network_interfaces. The
+    result is identical to Aws.parse_eni_metadata()"""
+    attachment = interface.get('Attachment')
+    delete_on_termination = attachment and attachment['DeleteOnTermination'] or False
+    return {
+            'name'                  : get_name_tag(interface.get('TagSet')),
+            'id'                    : interface['NetworkInterfaceId'],
+            'az'                    : interface['AvailabilityZone'],
+            'mac_address'           : interface.get('MacAddress'),
+            'groups'                : interface['Groups'],
+            'private_ip'            : interface.get('PrivateIpAddress'),
+            'status'                : interface['Status'],
+            'subnet'                : interface['SubnetId'],
+            'source_dest_check'     : interface.get('SourceDestCheck'),
+            'description'           : interface.get('Description'),
+            'availability_zone'     : interface['AvailabilityZone'],
+            'delete_on_termination' : delete_on_termination,
+            }
+
+def parse_subnet_description(subnet : dict) -> dict:
+    """Parse a subnet as returned by describe_subnets. The result is
+    identical to Aws.parse_subnet_metadata()"""
+    return {
+            'name'                  : get_name_tag(subnet.get('Tags')),
+            'id'                    : subnet['SubnetId'],
+            'az'                    : subnet['AvailabilityZone'],
+            'state'                 : subnet['State'],
+            'availability_zone'     : subnet['AvailabilityZone'],
+            'default_for_az'        : subnet['DefaultForAz'],
+            }
+
 def ip_str_to_int(ip_str):
     ip_arr = ip_str.split('.')
     ip = 0
@@ -113,15 +245,353 @@ def choose_from_list(qprompt, choices):
 
 class Aws:
 
-    def __init__ (self):
+    def __init__ (self, regions_concurrency = DEFAULT_REGIONS_CONCURRENCY,
+                  region_timeout = DEFAULT_REGION_TIMEOUT, ami_cache = None,
+                  inventory_backend = INVENTORY_BACKEND_CLIENT,
+                  max_pool_connections = DEFAULT_MAX_POOL_CONNECTIONS):
+        """@ami_cache: optional object (e.g. awsh_cache) which persists AMI
+        names across runs. It needs to implement get_amis() and set_amis()
+        @inventory_backend: INVENTORY_BACKEND_CLIENT or INVENTORY_BACKEND_RESOURCE
+        @max_pool_connections: HTTP connections kept alive for each region"""
         self.regions = dict()
         self.available_regions_list = None
+        self.ami_cache = ami_cache
+        self.inventory_backend = inventory_backend
+
+        self.regions_concurrency = max(1, regions_concurrency)
+        self.region_timeout = region_timeout
+
+        self.logger = logging.getLogger("awsh_ec2")
+
+        # boto3 clients are created once per region and reused by all
+        # requests. Creating them parses the service model and opens a new
+        # connection pool. Sessions aren't thread safe, so the creation is done
+        # under a lock. The clients themselves are thread safe, but resources
+        # aren't: each thread gets its own EC2 resources, wrapping the shared
+        # clients
+        self.session = boto3.Session()
+        self.boto_config = botocore.config.Config(
+            max_pool_connections=max_pool_connections,
+            tcp_keepalive=True)
+        self.boto_lock = threading.Lock()
+        self.clients = dict()
+        self.ec2_resource_class = None
+        self.thread_local = threading.local()
+
+        # (query kind, region) -> future of the query currently running. A
+        # query asked for while an identical one runs waits for its result
+        # instead of calling EC2 again
+        self.inflight_queries = dict()
+        self.inflight_lock = threading.Lock()
+        self.stats = { 'region_queries' : 0, 'coalesced_region_queries' : 0 }
+
+    def _client(self, service, region):
+        """Get the pooled boto3 client of @service in @region"""
+        key = (service, region)
+        with self.boto_lock:
+            if key not in self.clients:
+                self.clients[key] = self.session.client(service, region_name=region,
+                                                        config=self.boto_config)
+            return self.clients[key]
+
+    def _ec2_resource(self, region):
+        """Get the calling thread's EC2 resource of @region. It uses the
+        region's pooled EC2 client"""
+        ec2_resources = getattr(self.thread_local, 'ec2_resources', None)
+        if ec2_resources is None:
+            ec2_resources = self.thread_local.ec2_resources = dict()
+
+        if region not in ec2_resources:
+            client = self._ec2_client(region)
+            with self.boto_lock:
+                # the resource class is built from the service model, which is
+                # the same for all regions
+                if self.ec2_resource_class is None:
+                    self.ec2_resource_class = type(self.session.resource('ec2', region_name=region,
+                                                                         config=self.boto_config))
+            ec2_resources[region] = self.ec2_resource_class(client=client)
+
+        return ec2_resources[region]
+
+    def _ec2_client(self, region):
+        """Get the pooled EC2 client of @region"""
+        return self._client('ec2', region)
+
+    def get_available_regions(self):
+        """Return the list of regions in which EC2 is available"""
+        if not self.available_regions_list:
+            with self.boto_lock:
+                available_regions = self.session.get_available_regions('ec2')
+            self.available_regions_list = list(available_regions)
+
+        return self.available_regions_list
+
+    def _single_flight(self, key : tuple, query_func : Callable, not_before = None):
+        """Return the result of @query_func(). If a query with the same @key
+        is already running, wait for it and return its result (or raise its
+        exception) instead. The result is shared by all callers, who mustn't
+        modify it
+
+        @not_before: time.monotonic() timestamp. A running query which started
+        before it isn't waited for (e.g. it might miss a change the caller
+        just made)"""
+        with self.inflight_lock:
+            self.stats['region_queries'] += 1
+
+            inflight = self.inflight_queries.get(key)
+            if inflight is not None and (not_before is None or inflight[1] >= not_before):
+                self.stats['coalesced_region_queries'] += 1
+                future = inflight[0]
+                is_owner = False
+            else:
+                # queries asked for from now on wait for this one
+                future = concurrent.futures.Future()
+                self.inflight_queries[key] = (future, time.monotonic())
+                is_owner = True
+
+        if not is_owner:
+            self.logger.debug(f"Waiting for in-flight query {key}")
+            return future.result()
+
+        try:
+            result = query_func()
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self.inflight_lock:
+                if self.inflight_queries.get(key, (None,))[0] is future:
+                    del self.inflight_queries[key]
+
+    def get_stats(self) -> dict:
+        with self.inflight_lock:
+            return dict(self.stats, inflight_queries=len(self.inflight_queries))
+
+    def _query_regions_concurrently(self, query_func : Callable, regions : list,
+                                    desc : str, skip_failed : bool = False,
+                                    coalesce : bool = False,
+                                    fresh : bool = False) -> dict:
+        """Run @query_func for every region in @regions using a bounded pool of
+        threads. A region fails if @query_func raises or doesn't finish in
+        self.region_timeout seconds.
+
+        @query_func: function which receives a region and returns its data
+        @regions: the regions to query
+        @desc: what is queried (used for logging)
+        @skip_failed: if set, failed regions are left out of the result and
+        don't affect the other regions. Otherwise the failure of a region is
+        raised
+        @coalesce: if set, a region which is already queried for @desc by
+        another caller gets that query's result (see _single_flight()). Only
+        for queries whose result depends on nothing but the region
+        @fresh: when coalescing, only use queries which started after this call
+
+        @returns a dictionary with regions as keys and @query_func's result as
+        value"""
+
+        results = dict()
+        if not regions:
+            return results
+
+        not_before = time.monotonic() if fresh else None
+
+        # a region is timed out relative to when it started running, not when
+        # it was submitted, since it might have waited for a free worker
+        start_times = dict()
+        def timed_query(region):
+            start_times[region] = time.monotonic()
+            if coalesce:
+                return self._single_flight((desc, region), lambda: query_func(region), not_before)
+            return query_func(region)
+
+        workers_nr = min(self.regions_concurrency, len(regions))
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers_nr,
+                                                         thread_name_prefix="awsh_ec2_sweep")
+
+        pending = { executor.submit(timed_query, region) : region for region in regions }
+        try:
+            while pending:
+                done, _ = concurrent.futures.wait(pending, timeout=1,
+                                                  return_when=concurrent.futures.FIRST_COMPLETED)
+
+                for future in done:
+                    region = pending.pop(future)
+                    try:
+                        results[region] = future.result()
+                    except Exception as e:
+                        self.logger.warning(f"Failed to query {desc} in region {region}: {e}")
+                        if not skip_failed:
+                            raise
+
+                now = time.monotonic()
+                for future, region in list(pending.items()):
+                    started = start_times.get(region)
+                    if started is None or now - started < self.region_timeout:
+                        continue
+
+                    # the thread can't be interrupted, we just stop waiting for it
+                    self.logger.warning(f"Timed out querying {desc} in region {region}")
+                    pending.pop(future)
+                    if not skip_failed:
+                        raise TimeoutError(f"Timed out querying {desc} in region {region}")
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+        return results
+
+    def _resolve_amis(self, ec2_client, image_ids) -> dict:
+        """Get the name and distribution of every AMI in @image_ids using a
+        DescribeImages call per AMI_FILTER_MAX_VALUES AMIs. AMI names never change, so AMIs found in
+        self.ami_cache aren't queried at all
+
+        @ec2_client: boto3 EC2 client of the region the AMIs belong to
+        @image_ids: AMI ids to resolve
+
+        @returns a dictionary with AMI ids as keys and a dictionary with 'name'
+        and 'distro' entries as value"""
+
+        image_ids = set(image_ids)
+        amis = dict()
+        if self.ami_cache is not None:
+            amis = self.ami_cache.get_amis(image_ids)
+
+        missing_ids = sorted(ami_id for ami_id in image_ids if ami_id not in amis)
+        if not missing_ids:
+            return amis
+
+        new_amis = dict()
+        # ImageIds fails the whole call if any of the AMIs was deregistered,
+        # while an image-id filter just leaves it out of the reply
+        for i in range(0, len(missing_ids), AMI_FILTER_MAX_VALUES):
+            chunk = missing_ids[i:i + AMI_FILTER_MAX_VALUES]
+            try:
+                response = ec2_client.describe_images(Filters=[ { 'Name' : 'image-id', 'Values' : chunk } ])
+            except botocore.exceptions.ClientError as error:
+                self.logger.warning(f"Failed to describe AMIs {chunk}: {error}")
+                continue
+
+            for image in response['Images']:
+                name = image.get('Name', '')
+                new_amis[image['ImageId']] = {
+                    'name'      : name,
+                    'distro'    : get_os_by_ami_name(name),
+                }
+
+        if new_amis and self.ami_cache is not None:
+            self.ami_cache.set_amis(new_amis)
+
+        amis.update(new_amis)
+
+        # deregistered (or otherwise inaccessible) AMIs aren't matched by the
+        # filter, and a failed call leaves its chunk unresolved. Don't cache
+        # them in case they become available later
+        for ami_id in missing_ids:
+            if ami_id not in amis:
+                amis[ami_id] = { 'name' : '', 'distro' : '' }
+
+        return amis
 
     def get_instance_in_region(self, region, instance_id = None):
         """List instances in a given region, if instance_id is specified, query
-        only this specific instance data"""
+        only this specific instance data
+
+        @returns a tuple of (instances list, whether any instance is running)"""
+
+        if self.inventory_backend == INVENTORY_BACKEND_RESOURCE:
+            return self._get_instance_in_region_resource(region, instance_id)
+
+        ec2_client = self._ec2_client(region)
+        if instance_id:
+            ret_instances = self._describe_instances(ec2_client, InstanceIds=[ instance_id ])
+        else:
+            ret_instances = self._describe_instances(
+                ec2_client,
+                Filters=[ { 'Name' : 'instance-state-name', 'Values' : NOT_TERMINATED_STATES } ],
+                PaginationConfig={ 'PageSize' : INVENTORY_PAGE_SIZE })
+
+        has_running_instances = any(is_instance_running(instance) for instance in ret_instances)
+
+        return ret_instances, has_running_instances
+
+    def _describe_instances(self, ec2_client, **kwargs) -> list:
+        """Run a paginated describe_instances call with @kwargs and parse the
+        non-terminated instances it returns"""
+        paginator = ec2_client.get_paginator('describe_instances')
+
+        all_instances = list()
+        for page in paginator.paginate(**kwargs):
+            for reservation in page['Reservations']:
+                for instance in reservation['Instances']:
+                    # don't return terminated instances
+                    if instance['State']['Code'] == TERMINATED_STATE_CODE:
+                        continue
+                    all_instances.append(instance)
+
+        amis = self._resolve_amis(ec2_client,
+                                  [ instance['ImageId'] for instance in all_instances ])
+
+        return [ parse_instance_description(instance, amis) for instance in all_instances ]
+
+    def get_instance_changes_in_region(self, region, known_states : dict):
+        """Find the instances whose state changed compared to @known_states.
+        Only the instances' states are listed (using describe_instance_status),
+        and only the changed instances are fully described. Changes which don't
+        involve a state change (e.g. attaching an ENI) aren't detected.
+
+        @region: the region to query
+        @known_states: dictionary with instance ids as keys and their last known
+        state code as value
+
+        @returns a tuple of (changed instances list, removed instances ids list,
+        whether any instance is running)"""
+
+        ec2_client = self._ec2_client(region)
+        paginator = ec2_client.get_paginator('describe_instance_status')
+
+        current_states = dict()
+        for page in paginator.paginate(IncludeAllInstances=True,
+                                       PaginationConfig={ 'PageSize' : INVENTORY_PAGE_SIZE }):
+            for status in page['InstanceStatuses']:
+                current_states[status['InstanceId']] = status['InstanceState']['Code']
+
+        removed_ids = [ instance_id for instance_id in known_states
+                        if current_states.get(instance_id, TERMINATED_STATE_CODE) == TERMINATED_STATE_CODE ]
+
+        changed_ids = [ instance_id for instance_id, state in current_states.items()
+                        if state != TERMINATED_STATE_CODE and known_states.get(instance_id) != state ]
+
+        changed_instances = list()
+        # InstanceIds can't be paginated with MaxResults, ask for a chunk at a time
+        for i in range(0, len(changed_ids), INSTANCE_IDS_CHUNK):
+            changed_instances.extend(self._describe_instances(
+                ec2_client, InstanceIds=changed_ids[i:i + INSTANCE_IDS_CHUNK]))
+
+        has_running_instances = RUNNING_STATE_CODE in current_states.values()
+
+        return changed_instances, removed_ids, has_running_instances
+
+    def query_instance_changes_in_regions(self, known_states : dict) -> dict:
+        """Run get_instance_changes_in_region() on several regions
+
+        @known_states: dictionary with regions as keys and the known states of
+        the region's instances (see get_instance_changes_in_region) as value
+
+        @returns a dictionary with regions as keys and the result of
+        get_instance_changes_in_region() as value. Regions which failed to be
+        queried are left out"""
+        return self._query_regions_concurrently(
+            lambda region: self.get_instance_changes_in_region(region, known_states[region]),
+            list(known_states.keys()),
+            "instance changes",
+            skip_failed=True)
 
-        ec2 = boto3.resource('ec2', region_name=region)
+    def _get_instance_in_region_resource(self, region, instance_id = None):
+        """Same as get_instance_in_region() but iterates boto3 resource
+        objects"""
+
+        ec2 = self._ec2_resource(region)
         if not instance_id:
             all_instances = ec2.instances.all()
         else:
@@ -133,45 +603,23 @@ class Aws:
 
         has_running_instances = False
 
+        # don't return terminated instances
+        all_instances = [ instance for instance in all_instances
+                          if instance.state['Code'] != TERMINATED_STATE_CODE ]
+
+        # accessing instance.image would query each AMI separately
+        amis = self._resolve_amis(ec2.meta.client,
+                                  [ instance.image_id for instance in all_instances ])
+
         ret_instances = list()
         for instance in all_instances:
-            # don't return terminated instances
-            if instance.state['Code'] == TERMINATED_STATE_CODE:
-                continue
             if instance.state['Code'] == RUNNING_STATE_CODE:
                 has_running_instances = True
 
-            interfaces = list()
-            for interface_attr in instance.network_interfaces_attribute:
-                card_id_index = 0
-                # on some instances the network card index is specified as well,
-                # while on others it's not
-                if 'NetworkCardIndex' in interface_attr['Attachment']:
-                    card_id_index = interface_attr['Attachment']['NetworkCardIndex']
-
-                interface = {
-                    'id'                    : interface_attr['NetworkInterfaceId'],
-                    'mac'                   : interface_attr['MacAddress'],
-                    'private_ip'            : interface_attr['PrivateIpAddress'],
-                    'subnet'                : interface_attr['SubnetId'],
-                    'vpc'                   : interface_attr['VpcId'],
-                    'security_group'        : interface_attr['Groups'],
-                    'delete_on_termination' : interface_attr['Attachment']['DeleteOnTermination'],
-                    'device_index'          : interface_attr['Attachment']['DeviceIndex'],
-                    'card_id_index'         : card_id_index,
-                    'description'           : interface_attr['Description'],
-                }
-                interfaces.append(interface)
-
-            interfaces.sort(key=lambda k: k['card_id_index'])
+            interfaces = parse_instance_interfaces(instance.network_interfaces_attribute)
 
-            # Get 'Name' tag of the instance. 'tags' attribute might not be
-            # defined
-            instance_name = ''
-            if instance.tags:
-                for tag in instance.tags:
-                    if tag['Key'] == 'Name':
-                        instance_name = tag['Value']
+            # 'tags' attribute might not be defined
+            instance_name = get_name_tag(instance.tags)
 
             ret_instances.append({
                 'name'              : instance_name,
@@ -180,8 +628,8 @@ class Aws:
                 'state'             : instance.state,
                 'architecture'      : instance.architecture,
                 'ami_id'            : instance.image_id,
-                'ami_name'          : instance.image.name,
-                'distro'            : get_os_by_ami_name(instance.image.name),
+                'ami_name'          : amis[instance.image_id]['name'],
+                'distro'            : amis[instance.image_id]['distro'],
                 'key'               : instance.key_name,
                 'public_dns'        : instance.public_dns_name,
                 'public_ip'         : instance.public_ip_address,
@@ -194,41 +642,43 @@ class Aws:
 
         return ret_instances, has_running_instances
 
-    def query_instances_in_regions(self, regions : list) -> Tuple[dict, Any]:
+    def query_instances_in_regions(self, regions : list,
+                                   skip_failed_regions = False,
+                                   fresh = False) -> Tuple[dict, Any]:
+        """Query the instances of several regions concurrently. A region which
+        is already being queried by another thread gets the result of that
+        query, which is shared and mustn't be modified
+
+        @skip_failed_regions: leave regions which failed to be queried out of
+        the result, instead of raising the failure
+        @fresh: don't use queries which started before this call"""
+        results = self._query_regions_concurrently(self.get_instance_in_region,
+                                                   regions,
+                                                   "instances",
+                                                   skip_failed_regions,
+                                                   coalesce=True,
+                                                   fresh=fresh)
         instances = dict()
         has_running_instances = dict()
 
-        for region in regions:
-            try:
-                instances[region], has_running_instances[region] = self.get_instance_in_region(region)
-            except:
-                print("Failed to query region", region)
-                instances[region], has_running_instances[region] = list(), False
+        for region, (region_instances, has_running) in results.items():
+            instances[region] = region_instances
+            has_running_instances[region] = has_running
 
         return instances, has_running_instances
 
     def query_all_instances(self):
         """List instances in all regions available to user.
            Caution: this operation might take a while"""
-        session = boto3.Session()
-
-        if not self.available_regions_list:
-            available_regions = session.get_available_regions('ec2')
-            self.available_regions_list = list(available_regions)
-
-        return self.query_instances_in_regions(self.available_regions_list)
+        return self.query_instances_in_regions(self.get_available_regions(),
+                                               skip_failed_regions=True)
 
     def quary_preferred_regions(self):
         return self.query_instances_in_regions(prefrred_regions)
 
     def print_online_instances(self):
         regions = self.regions
-        available_regions = available_regions_list
-
-        if not available_regions:
-            session = boto3.Session()
-            available_regions = session.get_available_regions('ec2')
-            self.available_regions_list = available_regions
+        available_regions = self.get_available_regions()
 
         for region in available_regions:
             print("Querying region: " + region)
@@ -359,16 +809,14 @@ class Aws:
         return sec_group
 
     def create_ssh_icmp_enabled_sg_region(self, region):
-        ec2 = boto3.resource('ec2', region_name=region)
+        ec2 = self._ec2_resource(region)
 
         for vpc in ec2.vpcs.all():
             self.create_ssh_icmp_enabled_sg_vpc(vpc)
 
 
     def create_ssh_icmp_enabled_sg_all_regions(self):
-        session = boto3.Session()
-
-        for region in list(session.get_available_regions('ec2')):
+        for region in self.get_available_regions():
             print("Adding ssh icmp enabled sg in", region)
             try:
                 self.create_ssh_icmp_enabled_sg_region(region)
@@ -411,12 +859,8 @@ class Aws:
         if isinstance(subnet, str):
             if not region:
                 raise SystemExit("create_interface: passing subnet id argument requires to specify region")
-            ec2 = boto3.resource('ec2', region_name=region)
+            ec2 = self._ec2_resource(region)
             subnet = ec2.Subnet(subnet)
-        else:
-            region = subnet.availability_zone
-
-        ec2 = boto3.resource('ec2', region_name=region)
 
         print("Creating interface", name)
 
@@ -449,7 +893,7 @@ class Aws:
     # TODO: add an option for this function to get a list of ENIs to detach.
     # This would save the server access
     def detach_private_enis(self, region, instance_id):
-        ec2 = boto3.resource('ec2', region_name=region)
+        ec2 = self._ec2_resource(region)
         instance = ec2.Instance(instance_id)
 
         enis_to_detach = list()
@@ -458,7 +902,7 @@ class Aws:
                 enis_to_detach.append(interface_attr['NetworkInterfaceId'])
 
         if not len(enis_to_detach):
-            return []
+            return [], None
 
         for eni_id in enis_to_detach:
             eni = ec2.NetworkInterface(eni_id)
@@ -470,7 +914,20 @@ class Aws:
 
 
     def _get_interface_in_region(self, region):
-        ec2 = boto3.resource('ec2', region_name=region)
+        if self.inventory_backend == INVENTORY_BACKEND_RESOURCE:
+            return self._get_interface_in_region_resource(region)
+
+        paginator = self._ec2_client(region).get_paginator('describe_network_interfaces')
+
+        ret_interfaces = dict()
+        for page in paginator.paginate(PaginationConfig={ 'PageSize' : INVENTORY_PAGE_SIZE }):
+            for interface in page['NetworkInterfaces']:
+                ret_interfaces[interface['NetworkInterfaceId']] = parse_eni_description(interface)
+
+        return ret_interfaces
+
+    def _get_interface_in_region_resource(self, region):
+        ec2 = self._ec2_resource(region)
         all_interfaces = ec2.network_interfaces.all()
 
         ret_interfaces = dict()
@@ -480,27 +937,21 @@ class Aws:
 
         return ret_interfaces
 
-    def query_interfaces_in_regions(self, regions):
-        interfaces = dict()
-        for region in regions:
-            try:
-                interfaces[region] = self._get_interface_in_region(region)
-            except:
-                print("Failed to query interfaces in region", region)
-                interfaces[region] = dict()
-
-        return interfaces
+    def query_interfaces_in_regions(self, regions, skip_failed_regions = False,
+                                    fresh = False):
+        """Query all interfaces in specified regions. Coalesced like
+        query_instances_in_regions()"""
+        return self._query_regions_concurrently(self._get_interface_in_region,
+                                                regions, "interfaces",
+                                                skip_failed_regions,
+                                                coalesce=True,
+                                                fresh=fresh)
 
     def query_all_interfaces(self):
         """List interfaces in all regions available to user.
            Caution: this operation might take a while"""
-        session = boto3.Session()
-
-        if not self.available_regions_list:
-            available_regions = session.get_available_regions('ec2')
-            self.available_regions_list = list(available_regions)
-
-        regions = self.query_interfaces_in_regions(self.available_regions_list)
+        regions = self.query_interfaces_in_regions(self.get_available_regions(),
+                                                   skip_failed_regions=True)
 
         return regions
 
@@ -529,7 +980,20 @@ class Aws:
 
 
     def _get_subnets_in_region(self, region):
-        ec2 = boto3.resource('ec2', region_name=region)
+        if self.inventory_backend == INVENTORY_BACKEND_RESOURCE:
+            return self._get_subnets_in_region_resource(region)
+
+        paginator = self._ec2_client(region).get_paginator('describe_subnets')
+
+        ret_subnets = dict()
+        for page in paginator.paginate(PaginationConfig={ 'PageSize' : INVENTORY_PAGE_SIZE }):
+            for subnet in page['Subnets']:
+                ret_subnets[subnet['SubnetId']] = parse_subnet_description(subnet)
+
+        return ret_subnets
+
+    def _get_subnets_in_region_resource(self, region):
+        ec2 = self._ec2_resource(region)
         all_subnets = ec2.subnets.all()
 
         ret_subnets = dict()
@@ -539,28 +1003,21 @@ class Aws:
 
         return ret_subnets
 
-    def query_subnets_in_regions(self, regions):
-        """Query all subnets in specified regions"""
-        subnets = dict()
-        for region in regions:
-            try:
-                subnets[region] = self._get_subnets_in_region(region)
-            except:
-                print("Failed to query subnets in region", region)
-                subnets[region] = dict()
-
-        return subnets
+    def query_subnets_in_regions(self, regions, skip_failed_regions = False,
+                                 fresh = False):
+        """Query all subnets in specified regions. Coalesced like
+        query_instances_in_regions()"""
+        return self._query_regions_concurrently(self._get_subnets_in_region,
+                                                regions, "subnets",
+                                                skip_failed_regions,
+                                                coalesce=True,
+                                                fresh=fresh)
 
     def query_all_subnets(self):
         """List subnets in all regions available to user.
            Caution: this operation might take a while"""
-        session = boto3.Session()
-
-        if not self.available_regions_list:
-            available_regions = session.get_available_regions('ec2')
-            self.available_regions_list = list(available_regions)
-
-        regions = self.query_subnets_in_regions(self.available_regions_list)
+        regions = self.query_subnets_in_regions(self.get_available_regions(),
+                                                skip_failed_regions=True)
 
         return regions
 
@@ -570,7 +1027,7 @@ class Aws:
         @region: the region to query
 
         @returns a list of amis in that region"""
-        ec2 = boto3.resource('ec2', region_name=region)
+        ec2 = self._ec2_resource(region)
         all_amis = ec2.images.filter(
             Owners=[
                 'self',
@@ -608,7 +1065,7 @@ class Aws:
 
     def create_subnet(self, region, az, name, vpc = None):
         available_vpcs = 3
-        ec2 = boto3.resource('ec2', region_name=region)
+        ec2 = self._ec2_resource(region)
 
         if vpc:
             # supporting it might be trickier than what one might think
@@ -651,7 +1108,7 @@ class Aws:
     def connect_eni_to_instance(self, region : str, instance_id : str, eni_id : str,
                                 device_index : int, network_card_index = 0):
 
-        ec2 = boto3.resource('ec2', region_name=region)
+        ec2 = self._ec2_resource(region)
 
         # TODO: this all should be move to some CLI program. This file should be
         # backend only
@@ -726,7 +1183,7 @@ class Aws:
         return instances[0]
 
     def terminate_instance(self, instance_id, region):
-        ec2 = boto3.resource('ec2', region_name=region)
+        ec2 = self._ec2_resource(region)
 
         instance = ec2.Instance(instance_id)
         try:
@@ -738,7 +1195,7 @@ class Aws:
                 raise error
 
     def start_instance(self, instance_id, region, wait_to_start=False):
-        ec2 = boto3.resource('ec2', region_name=region)
+        ec2 = self._ec2_resource(region)
 
         instance = ec2.Instance(instance_id)
         try:
@@ -760,7 +1217,7 @@ class Aws:
         return None
 
     def stop_instance(self, instance_id, region, wait_until_stop=False):
-        ec2 = boto3.resource('ec2', region_name=region)
+        ec2 = self._ec2_resource(region)
 
         instance = ec2.Instance(instance_id)
         try:
@@ -782,12 +1239,9 @@ class Aws:
         and the region long name as value"""
 
         # the region doesn't really matter here, but it's a required parameter
-        ssm = boto3.client('ssm', region_name='us-east-1')
+        ssm = self._client('ssm', 'us-east-1')
 
-        if not self.available_regions_list:
-            session = boto3.Session()
-            available_regions = session.get_available_regions('ec2')
-            self.available_regions_list = list(available_regions)
+        self.get_available_regions()
 
         long_names = dict()
         requests = list()
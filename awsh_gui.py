@@ -14,15 +14,10 @@ from gui.instances_view import instances_view
 from gui.region_view import region_view as instances_view_v2
 
 from awsh_cache import awsh_cache
-from awsh_req_resp_server import awsh_req_client
 from awsh_client import get_current_state
 
 import breeze_resources
 
-# TODO: remove all these, they are only here for testing
-import threading
-import asyncore
-
 AWSH_HOME = os.path.dirname(os.path.realpath(__file__))
 
 class aws_gui(QWidget):
@@ -32,43 +27,19 @@ class aws_gui(QWidget):
     def __init__(self, regions):
         super().__init__()
 
-        def loop_server():
-            while self.is_alive:
-                asyncore.loop(timeout=0.5, count=1)
-            print('no longer alive, broke server loop')
-
         # setup client to server
-        # FIXME: This shouldn't be necessary. For some reason asyncore.loop()
-        # stalls a lot and works pretty bad w/o spawning a client near a call to
-        # loop. This shouldn't be this way. The loop can run w/o any clients
-        # alive, and handle each client's spawn. This might be related to the
-        # global map of sockets. Maybe pass a custom socket map to
-        # asyncore.loop()
         try:
             regions = get_current_state()
 
-            # !!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!
-            # TODO: Is it really needed ? The idea was that the client would have
-            # one general socket for all regions through which it can get messages.
-            # Nevertheless, you seem to prefer creating a new socket for state query
-            # operation. You need to decide how many sockets you need open.
-            #
-            # To achieve blocking operation it seems like the easiest way would be
-            # to use custom socket map. This makes the looping operation in this
-            # thread loop over a different socket map. You should really decide what
-            # to do here.
-            # !!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!
-            self.req_client = awsh_req_client(fail_if_no_server=True)
-            wait_thread = threading.Timer(interval=1, function=loop_server)
-            wait_thread = threading.Thread(target=loop_server)
-            wait_thread.start()
+            # the region views send their commands over the same connection
+            self.server_connected = True
 
             # print("Queried regions")
             # print("new regions are:")
             # print(new_regions)
         except Exception:
             print("AWSH server isn't found")
-            self.req_client = None
+            self.server_connected = False
 
             cache = awsh_cache()
             if not cache.read_cache():
@@ -90,7 +61,7 @@ class aws_gui(QWidget):
             view = self.viewStackedLayout.itemAt(currentView_ix).widget()
             view.setFocus()
 
-        connection_status = ("" if self.req_client else "not ") + "connected"
+        connection_status = ("" if self.server_connected else "not ") + "connected"
         window_title = "AWS Helper (" + connection_status + ")"
         self.setWindowTitle(window_title)
         self.show()
@@ -114,13 +85,17 @@ class aws_gui(QWidget):
             interfaces = all_regions[region].get('interfaces', dict())
             subnets = all_regions[region].get('subnets', dict())
             has_running_instances = all_regions[region].get('has_running_instances', False)
+            version = all_regions[region].get('version', 0)
 
+            # the server pushes the region's changes to its view
             region_views[region] = instances_view_v2(
                     region,
                     region_long_name=region_long_name,
                     instances=instances,
                     interfaces=interfaces,
-                    subnets=subnets)
+                    subnets=subnets,
+                    version=version,
+                    subscribe=self.server_connected)
 
             if has_running_instances:
                 views_with_running_instance.insert(0, region_views[region])
@@ -156,10 +131,6 @@ class aws_gui(QWidget):
             return
         elif key == Qt.Key.Key_Escape or e.text() == 'q':
             self.is_alive = False
-            # if it's None then no server side exists
-            if self.req_client:
-                self.req_client.close()
-
             self.close()
         elif len(e.text()) == 1 and e.text() in 'np':
             letter = e.text()
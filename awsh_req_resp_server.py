@@ -1,16 +1,72 @@
-import asyncore
-import asynchat
+import asyncio
+import concurrent.futures
+import heapq
+import itertools
+import os
+import os.path as path
 import socket
+import struct
 import threading
-
 import time
+import zlib
+
 import logging
-import errno
-from typing import Tuple
 
 AWHS_PORT=7007
+# Local clients connect to this unix socket when it exists and use the TCP
+# port otherwise. It's only accessible by the user running the server
+AWSH_UNIX_SOCKET_PATH=path.join(os.environ.get('XDG_RUNTIME_DIR') or path.expanduser('~/.cache'),
+                                'awsh', 'awsh.sock')
 AWSH_ACK_STR='AWSHACK'
 AWSH_RESULT_STR='AWSHRESULT'
+# a reply which doesn't complete its request (e.g. the events of a
+# subscription). Any number of them can precede the AWSHRESULT reply
+AWSH_EVENT_STR='AWSHEVENT'
+# the request id, reply type and status of a reply all fit in these many bytes
+REPLY_HEADER_MAX_LEN=64
+
+# A client which sends "AWSHHELLO cap1 cap2 ..." as its first line gets back
+# the same line with the capabilities the server supports out of these. Old
+# clients don't send it and keep using the newline terminated protocol
+AWSH_HELLO_STR='AWSHHELLO'
+# replies are sent as FRAME_HEADER followed by the reply body
+CAP_FRAMED='framed'
+# frame bodies of at least COMPRESS_MIN_LEN bytes are zlib compressed. Requires
+# CAP_FRAMED
+CAP_ZLIB='zlib'
+SERVER_CAPABILITIES=[CAP_FRAMED, CAP_ZLIB]
+# Over the local socket, plain and compressed replies take about the same
+# time up to a few hundred instances (runs of tests/reply_compression_bench.py
+# differ on which is faster), and plain replies are faster from around 1000
+# instances. Since the server only listens on localhost and on its unix socket,
+# clients don't ask for CAP_ZLIB unless AWSH_COMPRESS_REPLIES=1 is set, e.g.
+# when the port is forwarded over a slower link
+CLIENT_CAPABILITIES=[CAP_FRAMED]
+if os.environ.get('AWSH_COMPRESS_REPLIES') == '1':
+    CLIENT_CAPABILITIES.append(CAP_ZLIB)
+
+# smaller replies fit a few packets, there's little to save by compressing them
+COMPRESS_MIN_LEN=2**14
+COMPRESS_LEVEL=1
+
+REPLY_TYPE_ACK=0
+REPLY_TYPE_RESULT=1
+REPLY_TYPE_EVENT=2
+
+# status of a request which was rejected because too many requests are queued
+REPLY_STATUS_BUSY=2
+
+DEFAULT_WORKERS=8
+DEFAULT_MAX_QUEUED_REQUESTS=64
+# request id, reply type, flags, status, body length
+FRAME_HEADER=struct.Struct('!IBBiI')
+FRAME_FLAG_ZLIB=0x1
+
+# initial size of the client's receive buffer. Frame bodies which don't fit
+# it are read into a buffer of their own
+RECV_BUFFER_SIZE=2**16
+# replies with a larger body aren't copied into a single buffer before sending
+REPLY_JOIN_MAX_LEN=2**16
 
 # Useful for the future
 # from functools import wraps
@@ -35,55 +91,219 @@ class request_item:
     def complete_request(self, reply = '', status = 0):
         self.connection.complete_request(self.request_id, reply, status)
 
+    def send_event(self, event) -> bool:
+        """Send @event to the client without completing the request. Returns
+        False if the client has disconnected"""
+        return self.connection.send_event(self.request_id, event)
+
+    def on_close(self, callback):
+        """Call @callback (from the server's event loop) when the client
+        disconnects"""
+        self.connection.add_close_callback(callback)
+
+
+class awsh_request_executor:
+    """Runs requests on a fixed number of worker threads. Requests which arrive
+    while all workers are busy wait in a queue ordered by priority (lower value
+    first, in arrival order within the same priority). Once @max_queued
+    requests are waiting new ones are rejected"""
+
+    def __init__(self, workers : int = DEFAULT_WORKERS,
+                 max_queued : int = DEFAULT_MAX_QUEUED_REQUESTS):
+        self.logger = logging.getLogger("awsh_request_executor")
+
+        self.workers_nr = workers
+        self.max_queued = max_queued
+
+        self.condition = threading.Condition()
+        self.stopped = False
+        # heap of (priority, seq, time queued, function)
+        self.queue = list()
+        self.queue_seq = itertools.count()
+
+        self.running = 0
+        self.stats = {
+            'max_queued_seen'   : 0,
+            'completed'         : 0,
+            'rejected'          : 0,
+            # seconds requests spent in the queue
+            'total_wait_time'   : 0.0,
+        }
+
+        for i in range(workers):
+            worker = threading.Thread(target=self.__worker, name=f"awsh_worker_{i}",
+                                      daemon=True)
+            worker.start()
+
+    def submit(self, func, priority : int = 0) -> bool:
+        """Queue @func to be called by a worker. Returns False if the queue is
+        full"""
+        with self.condition:
+            if self.stopped or len(self.queue) >= self.max_queued:
+                self.stats['rejected'] += 1
+                return False
+
+            heapq.heappush(self.queue, (priority, next(self.queue_seq), time.monotonic(), func))
+            self.stats['max_queued_seen'] = max(self.stats['max_queued_seen'], len(self.queue))
+            self.condition.notify()
+
+        return True
+
+    def __worker(self):
+        while True:
+            with self.condition:
+                while not self.queue and not self.stopped:
+                    self.condition.wait()
+
+                if self.stopped:
+                    return
+
+                _, _, queued_time, func = heapq.heappop(self.queue)
+                self.stats['total_wait_time'] += time.monotonic() - queued_time
+                self.running += 1
 
-class awsh_connection(asynchat.async_chat):
+            try:
+                func()
+            except Exception:
+                self.logger.exception("request execution failed")
+            finally:
+                with self.condition:
+                    self.running -= 1
+                    self.stats['completed'] += 1
+
+    def get_stats(self) -> dict:
+        with self.condition:
+            queued_by_priority = dict()
+            for priority, _, _, _ in self.queue:
+                queued_by_priority[priority] = queued_by_priority.get(priority, 0) + 1
+
+            return dict(self.stats,
+                        workers=self.workers_nr,
+                        max_queued=self.max_queued,
+                        running=self.running,
+                        queued=len(self.queue),
+                        queued_by_priority=queued_by_priority)
+
+    def shutdown(self):
+        """Stop the workers once they finish their current request. Queued
+        requests are dropped"""
+        with self.condition:
+            self.stopped = True
+            self.queue.clear()
+            self.condition.notify_all()
+
+
+class awsh_line_protocol(asyncio.Protocol):
+    """Splits the incoming byte stream into newline terminated messages and
+    passes each of them (without the terminator) to handle_line() as a
+    memoryview which is only valid during the call"""
+
+    def __init__(self):
+        self.transport = None
+        self.received_data = bytearray()
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        received_data = self.received_data
+        # a large reply arrives in many chunks, only look for the terminator
+        # in the new one
+        search_start = len(received_data)
+        received_data += data
+
+        if b'\n' not in data:
+            return
 
-    def __init__(self, sock, request_object):
-        asynchat.async_chat.__init__(self, sock=sock)
+        start = 0
+        end = received_data.find(b'\n', search_start)
+        with memoryview(received_data) as view:
+            while end >= 0:
+                self.handle_line(view[start:end])
+                start = end + 1
+                end = received_data.find(b'\n', start)
 
-        self.logger = logging.getLogger("awsh_connection")
+        del received_data[:start]
+
+    def handle_line(self, line : memoryview):
+        raise NotImplementedError
+
+
+class awsh_connection(awsh_line_protocol):
+    """The server side of a client connection. Requests are processed by the
+    server's executor, and their replies are written back from the event
+    loop"""
+
+    def __init__(self, request_object, loop, executor : awsh_request_executor):
+        super().__init__()
 
+        self.logger = logging.getLogger("awsh_connection")
         self.logger.debug('created awsh connection')
-        self.received_data = []
+
         self.request_object = request_object
+        self.loop = loop
+        self.executor = executor
+        # set by the client's hello. Only modified before the first request
+        # so the request threads can read them without locking
+        self.framed = False
+        self.compress = False
+
+        self.close_callbacks = list()
+
+    def connection_made(self, transport):
+        super().connection_made(transport)
+        # asyncio only disables Nagle for sockets created with IPPROTO_TCP.
+        # Without it a reply written as header and body waits for the
+        # client's delayed ack
+        sock = transport.get_extra_info('socket')
+        if sock.family != socket.AF_UNIX:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def connection_lost(self, exc):
+        self.logger.debug('connection closed')
+        self.transport = None
+
+        for callback in self.close_callbacks:
+            callback()
+        self.close_callbacks = list()
+
+    def add_close_callback(self, callback):
+        def add_callback():
+            if self.transport is None:
+                callback()
+            else:
+                self.close_callbacks.append(callback)
 
-        self.set_terminator(b"\n")
+        self.loop.call_soon_threadsafe(add_callback)
 
+    def __negotiate(self, client_capabilities : list):
+        capabilities = [ cap for cap in client_capabilities if cap in SERVER_CAPABILITIES ]
+        self.logger.debug(f'negotiated capabilities: {capabilities}')
 
-    def collect_incoming_data(self, data):
-        """Read an incoming request from the client and store it in the request
-        queue"""
-        self.logger.debug('Received partial message: ' + str(data))
-        ddata = data.decode('ascii')
-        self.received_data.append(ddata)
+        hello = ' '.join([ AWSH_HELLO_STR ] + capabilities) + '\n'
+        self.transport.write(bytes(hello, 'ascii'))
 
+        self.framed = CAP_FRAMED in capabilities
+        self.compress = self.framed and CAP_ZLIB in capabilities
 
-    # override default push function. It's the same as in asynchat but without
-    # initiating the send explicitly. The asyncore.loop() takes care to do so
-    def push(self, data):
-        if not isinstance(data, (bytes, bytearray, memoryview)):
-            raise TypeError('data argument must be byte-ish (%r)',
-                            type(data))
-        sabs = self.ac_out_buffer_size
-        if len(data) > sabs:
-            for i in range(0, len(data), sabs):
-                self.producer_fifo.append(data[i:i+sabs])
-        else:
-            self.producer_fifo.append(data)
+    def handle_line(self, line : memoryview):
+        # We received a request. Ack it, and put it into processing
 
+        line = str(line, 'ascii')
+        self.logger.debug('Received request: ' + line)
 
-    def found_terminator(self):
-        # We received a request. Ack it, and put it into processing
+        request_command = line.split()
+        if not request_command:
+            return
 
-        self.logger.debug('Received request: ' +  ' '.join(self.received_data))
+        if request_command[0] == AWSH_HELLO_STR:
+            self.__negotiate(request_command[1:])
+            return
 
-        request_command = ' '.join(self.received_data).split()
         req_id = int(request_command[0])
         req_item = request_item(self, req_id)
 
-        ack_str = '{} {}{}'.format(req_id, AWSH_ACK_STR, '\n')
-        ack = bytes(ack_str, 'ascii')
-        self.push(ack)
+        self.__write(self.__encode_reply(req_id, REPLY_TYPE_ACK))
 
         def process_request():
             try:
@@ -95,230 +315,590 @@ class awsh_connection(asynchat.async_chat):
 
             return
 
-        job = threading.Thread(target=process_request)
-        job.start()
+        get_priority = getattr(self.request_object, 'get_request_priority', None)
+        priority = get_priority(request_command[1:]) if get_priority else 0
 
-        self.received_data = []
+        if not self.executor.submit(process_request, priority):
+            self.logger.warning(f"too many queued requests, rejecting request {req_id}")
+            req_item.complete_request(reply='server busy', status=REPLY_STATUS_BUSY)
 
 
+    def __encode_reply(self, req_id : int, reply_type : int, status : int = 0,
+                       body : bytes = b'', flags : int = 0) -> list:
+        """Return the list of buffers which make up a reply in the protocol
+        used by this connection. The body is always the last one"""
+        if self.framed:
+            return [ FRAME_HEADER.pack(req_id, reply_type, flags, status, len(body)), body ]
+
+        if reply_type == REPLY_TYPE_ACK:
+            return [ bytes('{} {}\n'.format(req_id, AWSH_ACK_STR), 'ascii') ]
+
+        reply_type_str = AWSH_EVENT_STR if reply_type == REPLY_TYPE_EVENT else AWSH_RESULT_STR
+        header = '{} {} {} '.format(req_id, reply_type_str, status)
+        return [ bytes(header, 'ascii'), body + b'\n' ]
+
+    def __write(self, buffers : list):
+        # the client might have disconnected while the request was processed
+        if self.transport is None:
+            self.logger.debug('connection closed before reply was sent')
+            return
+
+        # a large body is written as is rather than copied to join it with
+        # its header
+        if len(buffers[-1]) > REPLY_JOIN_MAX_LEN:
+            for buffer in buffers:
+                self.transport.write(buffer)
+        else:
+            self.transport.write(b''.join(buffers))
+
+    def __send_reply(self, req_id, reply_type, response, status):
+        if not isinstance(response, (bytes, bytearray)):
+            response = bytes(str(response), 'ascii')
+
+        flags = 0
+        # compressed in the caller's thread, zlib releases the GIL
+        if self.compress and len(response) >= COMPRESS_MIN_LEN:
+            response = zlib.compress(response, COMPRESS_LEVEL)
+            flags |= FRAME_FLAG_ZLIB
+
+        reply_buffers = self.__encode_reply(req_id, reply_type, status, response, flags)
+
+        # transports aren't thread safe, let the loop write the reply
+        self.loop.call_soon_threadsafe(self.__write, reply_buffers)
+
+        return len(response), flags
+
     def complete_request(self, req_id, response, success):
-        reply = '{} {} {} {}{}'.format(req_id, AWSH_RESULT_STR, int(success), response, '\n')
-        reply_bytes = bytes(reply, 'ascii')
+        """Send the reply of a request. @response can be either a string or
+        (already encoded) ASCII bytes. Can be called from any thread"""
+        size, flags = self.__send_reply(req_id, REPLY_TYPE_RESULT, response, int(success))
 
-        self.logger.debug (f'completed request id {req_id} (size {len(reply_bytes)})')
-        # reply the response
-        self.push(reply_bytes)
-        # close connection on your side
-        # self.close()
+        self.logger.debug (f'completed request id {req_id} (size {size}, flags {flags})')
 
+    def send_event(self, req_id, event) -> bool:
+        """Send an event of a request which isn't completed yet. @event can be
+        either a string or ASCII bytes. Can be called from any thread.
 
-class awsh_req_server(asyncore.dispatcher):
+        Returns False if the client has disconnected"""
+        if self.transport is None:
+            return False
+
+        self.__send_reply(req_id, REPLY_TYPE_EVENT, event, 0)
+        return True
+
+
+class awsh_req_server:
     """This server waits for requests and passes them to @request_object using
-    its process_request method."""
+    its process_request method.
 
-    use_encoding = 0
-    encoding = 'latin-1'
+    If @request_object has a get_request_priority(request) method, requests
+    with a lower returned value are executed first when they have to wait for
+    a worker"""
 
-    def __init__(self, request_object):
+    def __init__(self, request_object, workers : int = DEFAULT_WORKERS,
+                 max_queued_requests : int = DEFAULT_MAX_QUEUED_REQUESTS,
+                 unix_socket : bool = True):
+        """@unix_socket: listen on AWSH_UNIX_SOCKET_PATH in addition to the
+        TCP port"""
 
         assert getattr(request_object, 'process_request', None) != None
 
         self.logger = logging.getLogger("awsh_req_server")
 
-        asyncore.dispatcher.__init__(self)
-        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.request_object = request_object
+        self.executor = awsh_request_executor(workers, max_queued_requests)
+        self.loop = asyncio.new_event_loop()
+        self.servers = list()
+
+        # bind here so that a taken port is reported to the caller rather than
+        # to the server thread
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind(('localhost', AWHS_PORT))
+        self.address = self.socket.getsockname()
 
         self.logger.info("Started async server on port {}".format(AWHS_PORT))
 
-        self.request_object = request_object
-
-        self.bind(('localhost', AWHS_PORT))
-        self.address = self.socket.getsockname()
+        self.unix_socket = None
+        self.unix_socket_path = None
+        if unix_socket:
+            self.__bind_unix_socket(AWSH_UNIX_SOCKET_PATH)
         return
 
+    def __bind_unix_socket(self, socket_path):
+        os.makedirs(path.dirname(socket_path), mode=0o700, exist_ok=True)
+
+        # the TCP port is ours, so a socket file left there belongs to a
+        # server which didn't exit cleanly
+        if path.exists(socket_path):
+            os.unlink(socket_path)
+
+        unix_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            unix_socket.bind(socket_path)
+            os.chmod(socket_path, 0o600)
+        except OSError as e:
+            unix_socket.close()
+            self.logger.error(f"Failed to listen on {socket_path}, local clients would use TCP: {e}")
+            return
 
-    def start_server(self):
-        self.listen(5)
+        self.unix_socket = unix_socket
+        self.unix_socket_path = socket_path
+        self.logger.info(f"Listening on {socket_path}")
 
 
-    def handle_accept(self):
-        self.logger.debug("Accepted a connection")
-        client_info = self.accept()
-        awsh_connection(sock = client_info[0],
-                        request_object = self.request_object)
+    def start_server(self):
+        """Serve requests until handle_close() is called. Blocks the calling
+        thread"""
+        asyncio.set_event_loop(self.loop)
+
+        def create_connection():
+            self.logger.debug("Accepted a connection")
+            return awsh_connection(self.request_object, self.loop, self.executor)
+
+        self.servers.append(self.loop.run_until_complete(
+                self.loop.create_server(create_connection, sock=self.socket, backlog=5)))
+        if self.unix_socket is not None:
+            self.servers.append(self.loop.run_until_complete(
+                    self.loop.create_unix_server(create_connection, sock=self.unix_socket, backlog=5)))
+
+        try:
+            self.loop.run_forever()
+        finally:
+            self.executor.shutdown()
+            for server in self.servers:
+                server.close()
+                self.loop.run_until_complete(server.wait_closed())
+            self.loop.close()
+
+            # new clients would fall back to TCP
+            if self.unix_socket_path is not None and path.exists(self.unix_socket_path):
+                os.unlink(self.unix_socket_path)
 
 
     def handle_close(self):
+        """Stop the server. Can be called from any thread"""
         self.logger.info('server: closing server')
-        self.close()
+        if self.loop.is_closed():
+            return
 
+        self.loop.call_soon_threadsafe(self.loop.stop)
 
-class awsh_req_client(asynchat.async_chat):
-    """This client communicates with a awsh_req_server server. It sends it
-    requests and receives the reply from it asynchronously (might be in a
-    different order than originally sent)"""
 
-    def __init__(self, fail_if_no_server=False, synchronous=False):
+# All clients of a process share one event loop, run by a daemon thread
+client_loop = None
+client_loop_lock = threading.Lock()
 
-        # We're gonna loop over existing sockets if we're waiting for them to
-        # complete
-        if synchronous:
-            self.socket_map = dict()
-        else:
-            self.socket_map = None
+def get_client_loop() -> asyncio.AbstractEventLoop:
+    global client_loop
+
+    with client_loop_lock:
+        if client_loop is None:
+            client_loop = asyncio.new_event_loop()
+            loop_thread = threading.Thread(target=client_loop.run_forever,
+                                           name="awsh_client_loop",
+                                           daemon=True)
+            loop_thread.start()
+
+    return client_loop
+
+
+class awsh_client_protocol(asyncio.BufferedProtocol):
+    """Reads the server's replies into a reusable receive buffer. Until the
+    server answers the hello (or if it doesn't support framing) replies are
+    newline terminated, afterwards each of them is a frame"""
+
+    def __init__(self, client, capabilities : list):
+        self.client = client
+        self.capabilities = capabilities
+        self.transport = None
+        self.framed = False
+
+        self.recv_buffer = bytearray(RECV_BUFFER_SIZE)
+        # unprocessed data is kept in recv_buffer[recv_start:recv_end]
+        self.recv_start = 0
+        self.recv_end = 0
+
+        # a frame whose body is read directly into its own buffer
+        self.frame_header = None
+        self.frame_body = None
+        self.frame_received = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+        # sent before any request, so the server negotiates before replying
+        # to anything
+        if self.capabilities:
+            hello = ' '.join([ AWSH_HELLO_STR ] + self.capabilities) + '\n'
+            transport.write(bytes(hello, 'ascii'))
+
+    def connection_lost(self, exc):
+        self.client.handle_connection_lost(self.transport, exc)
+
+    def get_buffer(self, sizehint):
+        if self.frame_body is not None:
+            return memoryview(self.frame_body)[self.frame_received:]
+
+        if self.recv_end == len(self.recv_buffer):
+            self.__make_room()
+
+        return memoryview(self.recv_buffer)[self.recv_end:]
+
+    def __make_room(self):
+        recv_buffer = self.recv_buffer
+        data_len = self.recv_end - self.recv_start
+
+        # the buffer is exported to the transport and cannot be resized, move
+        # the data to its beginning or to a larger buffer
+        if self.recv_start == 0:
+            self.recv_buffer = bytearray(len(recv_buffer) * 2)
+
+        self.recv_buffer[:data_len] = recv_buffer[self.recv_start:self.recv_end]
+        self.recv_start = 0
+        self.recv_end = data_len
+
+    def buffer_updated(self, nbytes):
+        if self.frame_body is not None:
+            self.frame_received += nbytes
+            if self.frame_received == len(self.frame_body):
+                frame_header, frame_body = self.frame_header, self.frame_body
+                self.frame_header = self.frame_body = None
+                self.client.handle_frame(frame_header, frame_body)
+            return
+
+        scan_start = self.recv_end
+        self.recv_end += nbytes
+        self.__process_received(scan_start)
+
+    def __handle_hello(self, line : memoryview):
+        capabilities = str(line, 'ascii').split()[1:]
+        self.framed = CAP_FRAMED in capabilities
+        self.client.server_capabilities = capabilities
+
+    def __process_received(self, scan_start : int):
+        recv_buffer = self.recv_buffer
+        start, end = self.recv_start, self.recv_end
+
+        with memoryview(recv_buffer) as view:
+            while start < end:
+                if not self.framed:
+                    # data before scan_start was already searched for a newline
+                    line_end = recv_buffer.find(b'\n', max(start, scan_start), end)
+                    if line_end < 0:
+                        break
 
-        asynchat.async_chat.__init__(self, map=self.socket_map)
+                    line = view[start:line_end]
+                    if line[:len(AWSH_HELLO_STR)] == AWSH_HELLO_STR.encode('ascii'):
+                        self.__handle_hello(line)
+                    else:
+                        self.client.handle_line(line)
+
+                    start = line_end + 1
+                    continue
+
+                if end - start < FRAME_HEADER.size:
+                    break
+
+                frame_header = FRAME_HEADER.unpack_from(recv_buffer, start)
+                body_start = start + FRAME_HEADER.size
+                body_end = body_start + frame_header[-1]
+
+                if body_end <= end:
+                    self.client.handle_frame(frame_header, view[body_start:body_end])
+                    start = body_end
+                    continue
+
+                # the rest of the body is read straight into its final buffer
+                self.frame_header = frame_header
+                self.frame_body = bytearray(frame_header[-1])
+                self.frame_received = end - body_start
+                self.frame_body[:self.frame_received] = view[body_start:end]
+                start = end
+
+        if start == end:
+            start = end = 0
+
+        self.recv_start, self.recv_end = start, end
+
+
+class awsh_req_client:
+    """This client communicates with a awsh_req_server server. It sends it
+    requests and receives the reply from it asynchronously (might be in a
+    different order than originally sent).
+
+    Response handlers are called from the clients' event loop thread"""
+
+    def __init__(self, fail_if_no_server=False, synchronous=False,
+                 capabilities : list = CLIENT_CAPABILITIES, reconnect=False,
+                 unix_socket=True):
+        """@capabilities: protocol extensions to ask the server for. An empty
+        list keeps the newline terminated protocol
+        @reconnect: if the connection is closed, open a new one when the next
+        request is sent. Requests which were pending on the closed connection
+        fail
+        @unix_socket: connect to the server's unix socket if it exists, and
+        to its TCP port otherwise"""
+
+        self.synchronous = synchronous
+        self.capabilities = list(capabilities)
+        self.reconnect = reconnect
+        self.unix_socket = unix_socket
 
         self.logger = logging.getLogger("awsh_req_client")
-        # coloredlogs.install(level='DEBUG', logger=logger)
-        # self.logger = logging.basicConfig(level=logging.DEBUG)
         self.logger.info('started awsh client')
 
-        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.loop = get_client_loop()
+        self.transport = None
+        # the connection attempt in progress, only accessed from the loop
+        self.connecting = None
+        # set once the server answers the hello
+        self.server_capabilities = list()
 
         self.next_request_id = 0
         # this would hold each request from client by request id
         self.pending_commands = dict()
-        # per request id reply queue
-        # self.received_replies = dict()
-        self.received_reply = list()
+        self.pending_lock = threading.Lock()
 
-        self.logger.debug('connecting')
+        try:
+            self.ensure_connected()
+        except OSError as e:
+            if fail_if_no_server:
+                raise
 
-        self.socket.setblocking(fail_if_no_server)
-        # err = self.socket.connect_ex(('localhost', AWHS_PORT))
-        # if err:
-            # print(f"error is {err} ({errno.errorcode[err]})")
-        self.connect(('localhost', AWHS_PORT))
+            self.logger.error(f'client: failed to connect to server: {e}')
 
 
-    def handle_connect(self):
-        self.logger.debug('client: connection succeeded')
-        self.set_terminator(b"\n")
-        # self.push(b"hello world\n")
+    async def __connect(self):
+        if self.connecting is None:
+            self.logger.debug('connecting')
+            self.connecting = self.loop.create_task(self.__open_connection())
+        connecting = self.connecting
 
-    def is_synchronous(self):
-        return self.socket_map is not None
+        try:
+            transport, _ = await connecting
+        finally:
+            if self.connecting is connecting:
+                self.connecting = None
 
-    def collect_incoming_data(self, data):
-        # print('client: received data ' + str(data), flush=True)
+        # several requests might have waited for the same attempt
+        if self.transport is None and not transport.is_closing():
+            self.transport = transport
+            self.logger.debug('client: connection succeeded')
 
-        self.logger.debug(f'Received partial mesasge of len {len(data)}')
-        self.received_reply.append(data)
+    async def __open_connection(self):
+        create_protocol = lambda: awsh_client_protocol(self, self.capabilities)
 
+        if self.unix_socket and path.exists(AWSH_UNIX_SOCKET_PATH):
+            try:
+                return await self.loop.create_unix_connection(create_protocol, AWSH_UNIX_SOCKET_PATH)
+            except OSError as e:
+                self.logger.debug(f'client: failed to connect to {AWSH_UNIX_SOCKET_PATH}, using TCP: {e}')
 
-    def _find_next_space(self, msg : str) -> Tuple[str, str]:
-        """Parse the next word starting @msg start up until you next space, and
-        return remaining string after that (not including the space)"""
-        i = 0
-        for char in msg:
-            if char == ' ':
-                break
+        return await self.loop.create_connection(create_protocol, 'localhost', AWHS_PORT)
 
-            i = i + 1
+    def ensure_connected(self):
+        """Connect to the server if not connected. Raises OSError (e.g.
+        ConnectionRefusedError) if it isn't running. Mustn't be called from a
+        response handler"""
+        if self.transport is not None:
+            return
 
-        return msg[:i], msg[i + 1:]
+        asyncio.run_coroutine_threadsafe(self.__connect(), self.loop).result()
 
-    def found_terminator(self):
 
-        logger = self.logger
+    def is_synchronous(self):
+        return self.synchronous
 
-        decoded_data_arr = map(lambda e : str(e, 'ascii'), self.received_reply)
-        reply = ''.join(decoded_data_arr)
-        self.received_reply = []
+    def handle_connection_lost(self, transport, exc):
+        self.logger.debug('client: connection closed')
+        if self.transport is transport:
+            self.transport = None
 
-        logger.debug(f"Received reply of length {len(reply)}")
+        with self.pending_lock:
+            pending_ids = list(self.pending_commands)
 
-        pending_commands = self.pending_commands
+        for req_id in pending_ids:
+            self.__fail_request(req_id, 'connection to server closed')
 
-        # print(reply)
+    def __fail_request(self, req_id, reason):
+        with self.pending_lock:
+            pending_command = self.pending_commands.pop(req_id, None)
 
-        # reply = received_reply.split()
-        req_id, msg = self._find_next_space(reply)
-        print("req_id", req_id)
-        if not req_id in pending_commands:
-            logger.error("Received reply for unexisting req id {}".format(req_id))
+        if pending_command is None or not pending_command['res_handler']:
             return
 
-        reply_type, msg = self._find_next_space(msg)
-        print("reply_type", reply_type)
+        pending_command['res_handler'](self, 1, reason)
+
+
+    def handle_line(self, line : memoryview):
+        """Parse a newline terminated reply"""
+
+        # only the header is split, the (possibly large) message is decoded
+        # straight from the receive buffer
+        header = bytes(line[:REPLY_HEADER_MAX_LEN]).split(b' ', 3)
+        reply_type = header[1].decode('ascii') if len(header) > 1 else ''
 
         if reply_type == AWSH_ACK_STR:
-            if pending_commands[req_id]['ack']:
+            self.__handle_reply(int(header[0]), REPLY_TYPE_ACK, 0, b'')
+            return
+
+        if reply_type not in [ AWSH_RESULT_STR, AWSH_EVENT_STR ]:
+            self.logger.error("client: invalid reply type (neither ack, event or result code): type = " + reply_type)
+            self.logger.error("client: closing connection")
+            self.close()
+            return
+
+        status = header[2] if len(header) > 2 else b'1'
+        # req id, type and status, each followed by a space
+        msg_offset = sum(len(field) + 1 for field in header[:3])
+
+        reply_type = REPLY_TYPE_EVENT if reply_type == AWSH_EVENT_STR else REPLY_TYPE_RESULT
+        self.__handle_reply(int(header[0]), reply_type, int(status), line[msg_offset:])
+
+    def handle_frame(self, frame_header : tuple, body):
+        req_id, reply_type, flags, status, _ = frame_header
+
+        if reply_type not in [ REPLY_TYPE_ACK, REPLY_TYPE_RESULT, REPLY_TYPE_EVENT ]:
+            self.logger.error(f"client: invalid frame type {reply_type}")
+            self.logger.error("client: closing connection")
+            self.close()
+            return
+
+        if flags & FRAME_FLAG_ZLIB:
+            body = zlib.decompress(body)
+
+        self.__handle_reply(req_id, reply_type, status, body)
+
+    def __handle_reply(self, req_id : int, reply_type : int, status : int, body):
+
+        logger = self.logger
+
+        logger.debug(f"Received reply of length {len(body)}")
+
+        with self.pending_lock:
+            pending_command = self.pending_commands.get(req_id)
+
+        if pending_command is None:
+            logger.error("Received reply for unexisting req id {}".format(req_id))
+            return
+
+        if reply_type == REPLY_TYPE_ACK:
+            if pending_command['ack']:
                 logger.error("client: Received ack for already acknowledged command. req id: {}".format(req_id))
             else:
                 logger.debug("client: Acked. req id: {}".format(req_id))
-                pending_commands[req_id]['ack'] = True
+                pending_command['ack'] = True
             return
-        elif not pending_commands[req_id]['ack']:
+        elif not pending_command['ack']:
             logger.error("Received reply_type for a request that hasn't been acked")
             return
 
-        if reply_type != AWSH_RESULT_STR:
-            logger.error("client: invalid reply type (neither ack or result code): type = " + reply_type)
-            logger.error("client: closing connection")
-            self.close()
+        if reply_type == REPLY_TYPE_EVENT:
+            event_handler = pending_command['event_handler']
+            if event_handler:
+                event_handler(self, str(body, 'ascii'))
             return
 
         logger.debug("client: Received response. req id: {}".format(req_id))
 
-        status, msg = self._find_next_space(msg)
-        request_success = int(status)
-
-        # parse the response
-        # if len(reply) > 3:
-            # request_response = ''.join(reply[3:])
-        # else:
-            # request_response = ''
+        with self.pending_lock:
+            del self.pending_commands[req_id]
 
-        # logger.debug(f"received reply_type: {request_response}")
-        response_handler = pending_commands[req_id]['res_handler']
+        response_handler = pending_command['res_handler']
 
         if not response_handler:
             logger.debug('No respond handler. Doing nothing with the reply')
         else:
-            response_handler(self, request_success, msg)
+            response_handler(self, status, str(body, 'ascii'))
+
+
+    def __write(self, req_id, request_bytes):
+        if self.transport is None and self.reconnect:
+            self.loop.create_task(self.__reconnect_and_write(req_id, request_bytes))
+            return
+
+        if self.transport is None:
+            self.logger.error('client: not connected, dropping request')
+            self.__fail_request(req_id, 'not connected to server')
+            return
+
+        self.transport.write(request_bytes)
 
+    async def __reconnect_and_write(self, req_id, request_bytes):
+        try:
+            await self.__connect()
+        except OSError as e:
+            self.logger.error(f'client: failed to reconnect to server: {e}')
+            self.__fail_request(req_id, 'not connected to server')
+            return
+
+        # the new connection might have been closed already
+        if self.transport is None:
+            self.__fail_request(req_id, 'connection to server closed')
+            return
+
+        self.transport.write(request_bytes)
 
-    def send_request(self, request, response_handler = None):
+    def send_request(self, request, response_handler = None, event_handler = None):
+        """Send @request to the server. @response_handler(connection, status,
+        reply) is called once the server replies. @event_handler(connection,
+        event) is called for each event the server sends before that. Can be
+        called from any thread"""
 
         self.logger.debug(f'client: sending request {request}')
 
-        req_id = str(self.next_request_id)
+        with self.pending_lock:
+            req_id = self.next_request_id
+            self.next_request_id = self.next_request_id + 1
 
-        self.pending_commands[req_id] = { 'ack': False,
-                                          'res_handler': response_handler
-                                        }
+            self.pending_commands[req_id] = { 'ack': False,
+                                              'res_handler': response_handler,
+                                              'event_handler': event_handler,
+                                            }
 
         request = '{} {}{}'.format(req_id, request, '\n')
-        request = bytes(request, 'ascii')
-        producer = asynchat.simple_producer(request)
-        self.push_with_producer(producer)
-
-        self.next_request_id = self.next_request_id + 1
+        self.loop.call_soon_threadsafe(self.__write, req_id, bytes(request, 'ascii'))
 
     def send_request_blocking(self, request):
-        """Send a command to the server and block until it returns.
+        """Send a command to the server and block until it returns. Mustn't be
+        called from a response handler.
 
         This function returns the server's response"""
 
-        global response
-        response = None
+        response = concurrent.futures.Future()
 
         def handle_reply(connection, response_success, server_reply):
-            global response
-            response = response_success, server_reply
-            print("Got blocking request response")
-
-            connection.close()
+            response.set_result((response_success, server_reply))
 
         self.send_request(request, handle_reply)
 
-        asyncore.loop(map=self.socket_map)
+        return response.result()
+
+    def close(self):
+        """Close the connection to the server. Can be called from any thread"""
+        def close_transport():
+            if self.transport is not None:
+                self.transport.close()
+
+        self.loop.call_soon_threadsafe(close_transport)
 
-        print("done looping")
 
-        return response
+# The client used by all the requests of this process
+shared_client = None
+shared_client_lock = threading.Lock()
+
+def get_shared_client() -> awsh_req_client:
+    """Return the process' single connection to the server, creating it on
+    first use. Requests from all threads are multiplexed over it, and it
+    reconnects if the server was restarted"""
+    global shared_client
+
+    with shared_client_lock:
+        if shared_client is None:
+            shared_client = awsh_req_client(reconnect=True)
+
+    return shared_client
 
 
 class test_class:
@@ -332,7 +912,6 @@ class test_class:
 
 def start_requests_server(req_server):
     req_server.start_server()
-    asyncore.loop(timeout=0.5)
 
 if __name__ == '__main__':
     """ testing """
@@ -340,21 +919,6 @@ if __name__ == '__main__':
     # server = awsh_req_server(test_class())
     client = awsh_req_client()
 
-    def handle_response(connection, response_success, server_reply):
-        connection.close()
-
     print('sending request')
 
-    client.send_request('1 us-east-1', response_handler=handle_response)
-
-    # client.close()
-
-    # comm = threading.Thread(target=asyncore.loop)
-    # comm.daemon = True
-    # comm.start()
-
-    # while True:
-        # client.push(b'message')
-        # time.sleep(0.1)
-
-    asyncore.loop(map=client.socket_map)
+    print(client.send_request_blocking('1 us-east-1'))
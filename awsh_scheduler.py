@@ -0,0 +1,190 @@
+import heapq
+import itertools
+import threading
+import time
+from typing import Union
+
+# Refresh periods (in seconds) of every record type. A record of a hot region
+# (one with running instances or which a client recently asked about) is
+# refreshed every 'hot' seconds. The period of an idle region's record is
+# doubled each time a refresh finds nothing new, up to 'idle' seconds
+refresh_periods = {
+    "instance_changes"      : { 'hot' : 60,             'idle' : 60 * 30 },
+    "instances"             : { 'hot' : 3600,           'idle' : 3600 * 8 },
+    "interfaces"            : { 'hot' : 3600,           'idle' : 3600 * 24 * 2 },
+    "subnets"               : { 'hot' : 3600 * 6,       'idle' : 3600 * 24 * 2 },
+    # not region specific
+    "regions_long_names"    : { 'hot' : 3600 * 24 * 30, 'idle' : 3600 * 24 * 30 },
+    }
+
+# how long a region stays hot after a client touched it
+TOUCH_HOT_PERIOD = 60 * 15
+# how long to wait before retrying a failed refresh
+RETRY_PERIOD = 60
+
+def record_key_str(record : str, region : Union[str, None]) -> str:
+    """Return the string under which the last refresh time of a (record,
+    region) pair is saved"""
+    if region is None:
+        return record
+
+    return f"{record}/{region}"
+
+class awsh_refresh_scheduler:
+    """Keeps the next time each (record, region) pair needs to be refreshed.
+
+    Entries are kept in a heap ordered by due time. Rescheduling an entry
+    pushes a new heap item and the old one is ignored when popped"""
+
+    def __init__(self, periods : dict = refresh_periods):
+        self.periods = periods
+
+        self.lock = threading.Lock()
+        # set to wake up a thread waiting for the next due entry
+        self.wakeup = threading.Event()
+
+        self.heap = list()
+        # breaks ties between heap items with the same due time
+        self.heap_seq = itertools.count()
+        # (record, region) -> the due time of its valid heap item
+        self.due_times = dict()
+        # (record, region) -> period used in last scheduling
+        self.current_periods = dict()
+        # the regions which have scheduled records
+        self.regions = set()
+        # region -> time of last client command, while the region is hot
+        self.touched_regions = dict()
+
+    def __push(self, key, due_time):
+        self.due_times[key] = due_time
+        heapq.heappush(self.heap, (due_time, next(self.heap_seq), key))
+
+    def add(self, record : str, region : Union[str, None], last_refresh = None):
+        """Start scheduling a (record, region) pair.
+
+        @last_refresh: timestamp of the last time this record was refreshed.
+        If not specified the record is due immediately"""
+        key = (record, region)
+
+        period = self.periods[record]['hot']
+        due_time = time.time() if last_refresh is None else last_refresh + period
+
+        with self.lock:
+            if region is not None:
+                self.regions.add(region)
+            self.current_periods[key] = period
+            self.__push(key, due_time)
+
+    def is_region_hot(self, region, has_running_instances : bool) -> bool:
+        if has_running_instances:
+            return True
+
+        with self.lock:
+            touch_time = self.touched_regions.get(region)
+            if touch_time is None:
+                return False
+
+            if time.time() - touch_time < TOUCH_HOT_PERIOD:
+                return True
+
+            del self.touched_regions[region]
+            return False
+
+    def pop_due(self) -> list:
+        """Remove all the entries which are due and return them as list of
+        (record, region) tuples. The caller needs to call complete() or
+        failed() for each of them"""
+        now = time.time()
+        due = list()
+
+        with self.lock:
+            while self.heap and self.heap[0][0] <= now:
+                due_time, _, key = heapq.heappop(self.heap)
+                # it was rescheduled since this item was pushed
+                if self.due_times.get(key) != due_time:
+                    continue
+
+                del self.due_times[key]
+                due.append(key)
+
+        return due
+
+    def complete(self, record : str, region : Union[str, None], is_hot : bool,
+                 changed : bool):
+        """Schedule the next refresh of a (record, region) pair after it was
+        refreshed
+
+        @is_hot: whether the region is hot (see is_region_hot())
+        @changed: whether the refresh found any change in the record"""
+        key = (record, region)
+        periods = self.periods[record]
+
+        with self.lock:
+            if is_hot or changed:
+                period = periods['hot']
+            else:
+                period = min(self.current_periods.get(key, periods['hot']) * 2, periods['idle'])
+
+            self.current_periods[key] = period
+            self.__push(key, time.time() + period)
+
+    def failed(self, record : str, region : Union[str, None]):
+        """Schedule a retry of a (record, region) pair whose refresh failed"""
+        key = (record, region)
+        retry_period = min(RETRY_PERIOD, self.periods[record]['hot'])
+
+        with self.lock:
+            self.__push(key, time.time() + retry_period)
+
+    def touch(self, region : str):
+        """Mark that a client asked about @region. Its records are made due no
+        later than their hot period. Regions which aren't refreshed are
+        ignored"""
+        now = time.time()
+
+        with self.lock:
+            if region not in self.regions:
+                return
+
+            self.touched_regions[region] = now
+
+            for key, due_time in list(self.due_times.items()):
+                record, key_region = key
+                if key_region != region:
+                    continue
+
+                period = self.periods[record]['hot']
+                self.current_periods[key] = period
+                if due_time > now + period:
+                    self.__push(key, now + period)
+
+        self.wake()
+
+    def time_until_next(self) -> Union[float, None]:
+        """Return the number of seconds until the next entry is due, or None if
+        nothing is scheduled"""
+        with self.lock:
+            while self.heap and self.due_times.get(self.heap[0][2]) != self.heap[0][0]:
+                heapq.heappop(self.heap)
+
+            if not self.heap:
+                return None
+
+            return max(0, self.heap[0][0] - time.time())
+
+    def wait(self, max_timeout = None):
+        """Sleep until the next entry is due or until wake() is called
+
+        @max_timeout: if specified, sleep no longer than this number of seconds"""
+        # clear before computing the timeout so that a wake() which happens in
+        # between isn't lost
+        self.wakeup.clear()
+
+        timeout = self.time_until_next()
+        if max_timeout is not None:
+            timeout = max_timeout if timeout is None else min(timeout, max_timeout)
+
+        self.wakeup.wait(timeout)
+
+    def wake(self):
+        self.wakeup.set()
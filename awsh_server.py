@@ -4,30 +4,27 @@ import botocore.exceptions as be
 import threading
 import signal
 import time
-from datetime import datetime
 import json
 
 from pid import PidFile
 
 from awsh_ec2 import Aws
 from awsh_cache import awsh_cache
-from awsh_req_resp_server import start_requests_server, awsh_req_server, awsh_connection
+from awsh_scheduler import awsh_refresh_scheduler, record_key_str
+from awsh_req_resp_server import (start_requests_server, awsh_req_server, awsh_connection,
+                                  DEFAULT_WORKERS, DEFAULT_MAX_QUEUED_REQUESTS)
 
 import logging
 
 # TODO: separate the request handler and the synchronous update into two
 # functions. They don't share anything in common except shared access to boto3
 
-intervals = {
-    # TODO: not used, maybe remove it completely
-    "regions_get_long_name"     : 3600 * 24 * 30,
-    "instance_in_pref_regions"  : 3600 * 1,
-    "instance_in_all_regions"   : 3600 * 8,
-    "interfaces_in_all_regions" : 3600 * 24 * 2,
-    "subnets_in_all_regions"    : 3600 * 24 * 2,
-    # "all_amis": 3600 * 24,
-    # "all_instance_size": 3600 * 24,
-    }
+# records which aren't region specific. See awsh_scheduler.refresh_periods for
+# the refresh periods of all records
+GLOBAL_RECORDS = [ "regions_long_names" ]
+
+# seconds to wait before retrying to write a busy cache
+CACHE_UPDATE_RETRY = 5
 
 def update(dict1, dict2):
     # Update all new/changes entries in dict2
@@ -51,25 +48,71 @@ class awsh_server_commands():
     GET_CURRENT_REGION_STATE=9
     GET_CURRENT_COMPLETE_STATE=10
     GET_SUBNETS=11
+    GET_SERVER_STATS=12
+    # arguments are the regions to follow, all of them if none. A region can
+    # be given as region:version with the version of the snapshot the client
+    # holds, to receive the region first if it changed since
+    SUBSCRIBE=13
+    # arguments are region:version pairs of the regions the client holds.
+    # Replies with the regions which changed since (an empty dictionary if
+    # none did)
+    GET_STATE_IF_CHANGED=14
+    # arguments are key=value words. 'target' is one of awsh_cache's
+    # QUERY_TARGETS (instances by default), 'region' and 'fields' (the fields
+    # to return) are comma separated lists. Any other key is a filter on the
+    # entries' field with comma separated glob patterns (see
+    # awsh_cache.query()). Replies with the matching entries by region
+    QUERY=15
+    # argument is an instance id, public DNS name, public IP, private IP or
+    # attached interface id. Replies with the 'region' and 'instance' it
+    # belongs to (an empty dictionary if none)
+    LOOKUP=16
+
+# Requests waiting for a worker are executed by this order. Replying from the
+# cache is fast and the GUI blocks on it, EC2 mutations which wait for the
+# instance or create resources are the slowest
+PRIORITY_CACHE_READ = 0
+PRIORITY_EC2_QUERY  = 1
+PRIORITY_SLOW_MUTATION = 2
+
+command_priorities = {
+    awsh_server_commands.GET_CURRENT_REGION_STATE   : PRIORITY_CACHE_READ,
+    awsh_server_commands.GET_CURRENT_COMPLETE_STATE : PRIORITY_CACHE_READ,
+    awsh_server_commands.GET_SUBNETS                : PRIORITY_CACHE_READ,
+    awsh_server_commands.GET_SERVER_STATS           : PRIORITY_CACHE_READ,
+    awsh_server_commands.SUBSCRIBE                  : PRIORITY_CACHE_READ,
+    awsh_server_commands.GET_STATE_IF_CHANGED       : PRIORITY_CACHE_READ,
+    awsh_server_commands.QUERY                      : PRIORITY_CACHE_READ,
+    awsh_server_commands.LOOKUP                     : PRIORITY_CACHE_READ,
+    awsh_server_commands.QUERY_REGION               : PRIORITY_EC2_QUERY,
+    awsh_server_commands.STOP_INSTANCE              : PRIORITY_EC2_QUERY,
+    awsh_server_commands.CONNECT_ENI                : PRIORITY_EC2_QUERY,
+    awsh_server_commands.DETACH_ALL_ENIS            : PRIORITY_EC2_QUERY,
+    awsh_server_commands.START_INSTANCE             : PRIORITY_SLOW_MUTATION,
+    awsh_server_commands.CREATE_ENIS                : PRIORITY_SLOW_MUTATION,
+    awsh_server_commands.CREATE_SUBNET              : PRIORITY_SLOW_MUTATION,
+    awsh_server_commands.CREATE_ENI_AND_SUBNET      : PRIORITY_SLOW_MUTATION,
+}
 
 server_stop = False
 
-def signal_handler(sig, frame):
-    print('Exiting server')
-    global server_stop
-    # exit the server gracefully
-    server_stop = True
-
 class awsh_server:
 
-    def __init__(self):
+    def __init__(self, workers : int = DEFAULT_WORKERS,
+                 max_queued_requests : int = DEFAULT_MAX_QUEUED_REQUESTS):
+        """@workers: number of threads executing client requests
+        @max_queued_requests: number of requests which can wait for a worker
+        before new ones are rejected as busy"""
+        self.workers = workers
+        self.max_queued_requests = max_queued_requests
+
         self.query_info_timer = threading.Timer(1, self.query_info)
         self.req_resp_server_running = False
         self.query_info_running = False
-        self.ec2 = Aws()
 
         # the cache would hold the server's state
         self.cache = awsh_cache()
+        self.ec2 = Aws(ami_cache=self.cache)
 
         self.logger = logging.getLogger("awsh-server")
 
@@ -77,13 +120,36 @@ class awsh_server:
             self.logger.error("Failed to read cache. Terminating")
             raise Exception("Cache is busy")
 
+        # functions refreshing each record. They receive a list of regions and
+        # return a dictionary of region -> whether the record changed. Regions
+        # which failed to be refreshed are left out
+        self.record_refreshers = {
+            # listed first so that on a fresh start the full instances query
+            # precedes the (then cheap) instance changes query
+            "instances"             : self.__refresh_instances,
+            "instance_changes"      : self.__refresh_instance_changes,
+            "interfaces"            : self.__refresh_interfaces,
+            "subnets"               : self.__refresh_subnets,
+            "regions_long_names"    : self.__refresh_regions_long_names,
+        }
+
+        self.scheduler = awsh_refresh_scheduler()
+        self.__schedule_records()
+
     def start_requests_server(self):
         if not self.req_resp_server_running:
             self.req_resp_server_running = True
-            self.req_server = awsh_req_server(self)
+            self.req_server = awsh_req_server(self, self.workers, self.max_queued_requests)
             req_server_thread = threading.Thread(target=lambda: start_requests_server(self.req_server))
             req_server_thread.start()
 
+    def get_request_priority(self, request : list) -> int:
+        """Called by awsh_req_server to order requests waiting for a worker"""
+        try:
+            return command_priorities.get(int(request[0]), PRIORITY_EC2_QUERY)
+        except (IndexError, ValueError):
+            return PRIORITY_CACHE_READ
+
     def process_request(self, request: list, connection: awsh_connection):
         """This function is the needs to be implemented for awsh_req_server.  It
         is called each time a request is submitted.
@@ -97,6 +163,16 @@ class awsh_server:
         cache  = self.cache
 
         logger.debug("aws_server: received command {}".format(request[0]))
+
+        # all region specific commands have the region as first argument.
+        # Regions clients work with are refreshed more often
+        if len(request) > 1 and request[0] not in [ str(awsh_server_commands.GET_CURRENT_COMPLETE_STATE),
+                                                    str(awsh_server_commands.GET_SERVER_STATS),
+                                                    str(awsh_server_commands.GET_STATE_IF_CHANGED),
+                                                    str(awsh_server_commands.SUBSCRIBE),
+                                                    str(awsh_server_commands.QUERY),
+                                                    str(awsh_server_commands.LOOKUP) ]:
+            self.scheduler.touch(request[1])
         # will be overridden depending on the request
         reply = ''
 
@@ -114,8 +190,7 @@ class awsh_server:
 
             reply = json.dumps(instances[region])
 
-            cache.set_instances(instances)
-            cache.set_is_running_instances(has_running_instances)
+            cache.set_instances(instances, has_running_instances=has_running_instances)
 
             logger.debug('finished querying region')
 
@@ -126,11 +201,8 @@ class awsh_server:
             logger.info('starting instance {} in region {}'.format(instance_id, region))
             instance_info = self.ec2.start_instance(instance_id, region, wait_to_start=True)
 
-            cache.set_instance(instance_info, region, is_running=True) # type: ignore
-
-            # TODO: This is wasteful to send all instances on the socket. Also
-            # it allows a race. Fix it
-            reply = json.dumps(cache.get_instances(region))
+            patch = cache.set_instance(instance_info, region, is_running=True) # type: ignore
+            reply = json.dumps(patch)
 
             logger.debug('finished starting instance {} in region {}'.format(instance_id, region))
 
@@ -151,8 +223,9 @@ class awsh_server:
             logger.info(f'connecting eni {eni} to instance {instance_id} (as index {index}) in region {region}')
             instance_info = self.ec2.connect_eni_to_instance(region, instance_id, eni, index)
 
-            cache.set_instance(instance_info, region)
-            reply = json.dumps(instance_info)
+            patch = cache.update_region_entries(region, [ instance_info ],
+                                                self.__interfaces_with_status(region, [ eni ], 'in-use'))
+            reply = json.dumps(patch)
 
             logger.debug(f'finished connecting eni {eni} to instance {instance_id} (as index {index}) in region {region}')
         elif request[0] == str(awsh_server_commands.DETACH_ALL_ENIS):
@@ -166,11 +239,9 @@ class awsh_server:
             # function
             detached_enis, instance_info = self.ec2.detach_private_enis(region, instance_id)
 
-            reply_dict = {
-                "detached_enis" : detached_enis,
-                "instance" : instance_info
-            }
-            reply = json.dumps(reply_dict)
+            patch = cache.update_region_entries(region, [ instance_info ] if instance_info else [],
+                                                self.__interfaces_with_status(region, detached_enis, 'available'))
+            reply = json.dumps(patch)
 
             logger.debug(f'detaching all enis from instance {instance_id} in region {region}')
 
@@ -206,19 +277,73 @@ class awsh_server:
             for inf_name in interfaces_names:
                 self.ec2.create_interface(inf_name, subnet)
 
-            interfaces = self.ec2.query_interfaces_in_regions([region])
+            # an interfaces query which started before the creation misses
+            # the new interfaces
+            interfaces = self.ec2.query_interfaces_in_regions([region], fresh=True)
 
             cache.set_interfaces(interfaces)
-            reply = json.dumps(cache.get_region_data(region))
+            reply = cache.get_encoded_region(region)
 
         elif request[0] == str(awsh_server_commands.GET_CURRENT_REGION_STATE):
             region = request[1]
 
             logger.info(f"asked for current state for region {region}")
-            reply = json.dumps(cache.get_region_data(region))
+            reply = cache.get_encoded_region(region)
         elif request[0] == str(awsh_server_commands.GET_CURRENT_COMPLETE_STATE):
             logger.info("asked for current complete state")
-            reply = json.dumps(cache.get_instances())
+            reply = cache.get_encoded_state()
+        elif request[0] == str(awsh_server_commands.GET_STATE_IF_CHANGED):
+            known_versions = dict()
+            for region_version in request[1:]:
+                region, _, version = region_version.rpartition(':')
+                known_versions[region] = int(version)
+
+            logger.info(f"asked for the regions which changed out of {len(known_versions)} regions")
+            reply = cache.get_encoded_changed_regions(known_versions)
+        elif request[0] == str(awsh_server_commands.QUERY):
+            target  = 'instances'
+            fields  = None
+            regions = None
+            filters = dict()
+            for argument in request[1:]:
+                key, _, value = argument.partition('=')
+                if key == 'target':
+                    target = value
+                elif key == 'fields':
+                    fields = value.split(',')
+                elif key == 'region':
+                    regions = value.split(',')
+                else:
+                    filters[key] = value.split(',')
+
+            logger.info(f"asked to query {target} in regions {regions or 'all'} by {filters}")
+            reply = json.dumps(cache.query(target, filters, fields, regions))
+        elif request[0] == str(awsh_server_commands.LOOKUP):
+            address = request[1]
+
+            logger.info(f"asked to look up {address}")
+            region, instance = cache.lookup(address)
+            reply = json.dumps({ 'region' : region, 'instance' : instance } if instance else dict())
+        elif request[0] == str(awsh_server_commands.GET_SERVER_STATS):
+            reply = json.dumps({
+                "requests"      : self.req_server.executor.get_stats(),
+                "cache_writes"  : cache.get_write_stats(),
+                "ec2_queries"   : self.ec2.get_stats(),
+            })
+        elif request[0] == str(awsh_server_commands.SUBSCRIBE):
+            regions = list()
+            known_versions = dict()
+            for argument in request[1:]:
+                region, _, version = argument.partition(':')
+                regions.append(region)
+                if version:
+                    known_versions[region] = int(version)
+
+            logger.info(f"subscribing to changes in regions {regions or 'all'}")
+            self.__subscribe(regions, known_versions, connection)
+
+            # the request stays open until the client disconnects
+            return
         else:
             logger.error('aws_server: unknown command {}'.format(request[0]))
 
@@ -226,104 +351,170 @@ class awsh_server:
 
         connection.complete_request(reply=reply)
 
-    def query_info(self):
+    def __interfaces_with_status(self, region : str, eni_ids : list, status : str) -> dict:
+        """Copies of the cached interfaces in @eni_ids with their status set to
+        @status"""
+        interfaces = self.cache.get_interfaces(region)
+        return { eni_id : dict(interfaces[eni_id], status=status)
+                 for eni_id in eni_ids if eni_id in interfaces }
 
-        logger = self.logger
+    def __subscribe(self, regions : list, known_versions : dict, connection : awsh_connection):
+        """Send the changes applied to the cache in @regions (all regions if
+        empty) as events of the request, until the client disconnects.
 
-        while not server_stop:
+        Each event is a JSON dictionary with the 'region' and 'version' of the
+        new region snapshot along with the changes described in
+        awsh_cache._region_changes(). Regions in @known_versions (region ->
+        version the client holds) which have a different version are sent
+        first, with the whole region in 'snapshot'"""
+        cache = self.cache
+        regions = set(regions)
 
-            time.sleep(5)
-            # TODO: is there any benefit to having it cached ?
-            ec2 = self.ec2
+        def send_changes(region, version, changes):
+            if regions and region not in regions:
+                return
 
-            cache = self.cache
+            event = dict(changes, region=region, version=version)
+            if not connection.send_event(json.dumps(event)):
+                cache.remove_listener(send_changes)
 
-            current_time = datetime.now()
+        cache.add_listener(send_changes, known_versions)
+        connection.on_close(lambda: cache.remove_listener(send_changes))
 
-            # TODO: Maybe move the intervals struct to aws_cache ?
-            if cache.is_record_old_enough(current_time, intervals, 'instance_in_all_regions'):
-                logger.info("querying all instances")
+    def __is_region_hot(self, region):
+        try:
+            has_running_instances = self.cache.get_region_data(region).get('has_running_instances', False)
+        except KeyError:
+            has_running_instances = False
 
-                try:
-                    all_instances, has_running_instances = ec2.query_all_instances()
-                except (be.EndpointConnectionError, be.ConnectTimeoutError) as err:
-                    logger.warning("Failed to query EC2 due to internet failure")
-                    continue
+        return self.scheduler.is_region_hot(region, has_running_instances)
 
-                cache.set_instances(all_instances)
-                cache.set_is_running_instances(has_running_instances)
+    def __refresh_instances(self, regions : list) -> dict:
+        cache = self.cache
 
-                cache.update_record_ts('instance_in_all_regions', current_time.timestamp())
-                cache.update_record_ts('instance_in_pref_regions', current_time.timestamp())
-                logger.info('done querying all instances')
-            # elif cache.is_record_old_enough(current_time, intervals, 'instance_in_pref_regions'):
-                # print("querying preferred instances", end=' - ', flush = True)
+        instances, has_running_instances = self.ec2.query_instances_in_regions(
+            regions, skip_failed_regions=True)
 
-                # preferred_instances, has_running_instances = ec2.quary_preferred_regions()
+        changed = { region : cache.get_instances(region) != instances[region]
+                    for region in instances }
 
-                # cache.set_instances(preferred_instances)
-                # cache.set_is_running_instances(has_running_instances)
+        cache.set_instances(instances, has_running_instances=has_running_instances)
 
-                # cache.update_record_ts('instance_in_pref_regions', current_time.timestamp())
-                # print('done')
+        return changed
 
-            if cache.is_record_old_enough(current_time, intervals, 'interfaces_in_all_regions'):
-                logger.info("querying all interfaces")
+    def __refresh_instance_changes(self, regions : list) -> dict:
+        cache = self.cache
 
-                try:
-                    all_interfaces = ec2.query_all_interfaces()
-                except (be.EndpointConnectionError, be.ConnectTimeoutError, be.ReadTimeoutError) as err:
-                    logger.warning("Failed to query EC2 due to internet failure")
-                    continue
+        known_states = { region : cache.get_instances_states(region) for region in regions }
+        all_changes = self.ec2.query_instance_changes_in_regions(known_states)
 
-                # We allow the awsh_client to decide itself whether an interface
-                # is free or not based on the instance's attached ENIs. Denote
-                # all interfaces as free
-                for enis in all_interfaces.values():
-                    for eni in enis.values():
-                        eni['status'] = 'available'
+        changed = dict()
+        for region, changes in all_changes.items():
+            changed_instances, removed_ids, has_running_instances = changes
+            changed[region] = bool(changed_instances or removed_ids)
+            if not changed[region]:
+                continue
 
-                self.cache.set_interfaces(all_interfaces)
+            cache.apply_instance_changes(region, changed_instances,
+                                         removed_ids, has_running_instances)
 
-                cache.update_record_ts('interfaces_in_all_regions', current_time.timestamp())
-                logger.info("done querying all interfaces")
+        return changed
 
+    def __refresh_interfaces(self, regions : list) -> dict:
+        cache = self.cache
 
-            if cache.is_record_old_enough(current_time, intervals, 'regions_get_long_name'):
+        queried_interfaces = self.ec2.query_interfaces_in_regions(regions, skip_failed_regions=True)
 
-                logger.info("querying regions long names")
+        # We allow the awsh_client to decide itself whether an interface
+        # is free or not based on the instance's attached ENIs. Denote
+        # all interfaces as free. The queried interfaces might be shared with
+        # other requests and are copied rather than modified
+        all_interfaces = { region : { eni_id : dict(eni, status='available')
+                                      for eni_id, eni in enis.items() }
+                           for region, enis in queried_interfaces.items() }
 
-                try:
-                    regions_long_names = ec2.get_regions_full_name()
-                except (be.EndpointConnectionError, be.ConnectTimeoutError, be.ReadTimeoutError) as err:
-                    logger.warning("Failed to query EC2 due to internet failure")
-                    continue
+        changed = { region : cache.get_interfaces(region) != all_interfaces[region]
+                    for region in all_interfaces }
 
-                self.cache.set_regions_long_names(regions_long_names)
+        cache.set_interfaces(all_interfaces)
 
-                cache.update_record_ts('regions_get_long_name', current_time.timestamp())
-                logger.info("done querying regions long names")
+        return changed
 
+    def __refresh_subnets(self, regions : list) -> dict:
+        subnets = self.ec2.query_subnets_in_regions(regions, skip_failed_regions=True)
 
-            if cache.is_record_old_enough(current_time, intervals, 'subnets_in_all_regions'):
+        self.cache.set_subnets(subnets)
 
-                logger.info("querying regions subnets")
+        # subnets rarely change, no need to keep them refreshed as hot records
+        return { region : False for region in subnets }
 
-                try:
-                    subnets = ec2.query_all_subnets()
-                except (be.EndpointConnectionError, be.ConnectTimeoutError, be.ReadTimeoutError):
-                    logger.warning("Failed to query EC2 due to internet failure")
-                    continue
+    def __refresh_regions_long_names(self, regions : list) -> dict:
+        regions_long_names = self.ec2.get_regions_full_name()
+
+        self.cache.set_regions_long_names(regions_long_names)
 
-                self.cache.set_subnets(subnets)
+        return { None : False }
 
-                cache.update_record_ts('subnets_in_all_regions', current_time.timestamp())
-                logger.info("done querying subnet data")
+    def __schedule_records(self):
+        """Add all records to the scheduler, taking into account when they were
+        last refreshed"""
+        cache = self.cache
+        scheduler = self.scheduler
+
+        for record in self.record_refreshers:
+            regions = [ None ] if record in GLOBAL_RECORDS else self.ec2.get_available_regions()
+            for region in regions:
+                last_refresh = cache.get_record_ts(record_key_str(record, region))
+                scheduler.add(record, region, last_refresh)
+
+    def query_info(self):
+        """Refresh each (record, region) pair when the scheduler says it's due
+        and sleep until the next one is"""
+
+        logger = self.logger
+        cache = self.cache
+        scheduler = self.scheduler
 
-            # update fail because of locking, retry again next time
+        while not server_stop:
+
+            due_records = dict()
+            for record, region in scheduler.pop_due():
+                due_records.setdefault(record, list()).append(region)
+
+            for record, regions in due_records.items():
+                logger.info(f"refreshing {record} in {len(regions)} region(s)")
+
+                try:
+                    changed = self.record_refreshers[record](regions)
+                except (be.EndpointConnectionError, be.ConnectTimeoutError, be.ReadTimeoutError):
+                    logger.warning("Failed to query EC2 due to internet failure")
+                    changed = dict()
+                except Exception as e:
+                    logger.error(f"Failed to refresh {record}: {e}")
+                    changed = dict()
+
+                refresh_time = time.time()
+                for region in regions:
+                    # failed to query region, retry it soon
+                    if region not in changed:
+                        scheduler.failed(record, region)
+                        continue
+
+                    cache.update_record_ts(record_key_str(record, region), refresh_time)
+                    scheduler.complete(record, region,
+                                       is_hot=self.__is_region_hot(region),
+                                       changed=changed[region])
+
+                logger.info(f"done refreshing {record} ({sum(changed.values())} changed)")
+
+            # update fail because of locking, retry again soon
             # TODO: maybe rename to something clearer
             if not cache.update_cache():
-                logger.warning("Failed to update cache. Will try next iteration")
+                logger.warning("Failed to update cache. Will try again in {} seconds".format(
+                               CACHE_UPDATE_RETRY))
+                scheduler.wait(max_timeout=CACHE_UPDATE_RETRY)
+            else:
+                scheduler.wait()
 
         # kill request server as well
         self.req_server.handle_close()
@@ -344,15 +535,24 @@ def start_server(args):
     """Query EC2 for information like existing instances, subnets
        available amis, available instance size etc.
 
-       args is unused, but declared to be consistent with other awsh subcommands"""
+       args: the parsed server subcommand arguments"""
 
     try:
         # This would prevent more than one process to be run
         with PidFile('awsh_server_daemon') as p:
+            server = awsh_server(workers=args.workers,
+                                 max_queued_requests=args.max_queued_requests)
+
+            def signal_handler(sig, frame):
+                print('Exiting server')
+                global server_stop
+                # exit the server gracefully
+                server_stop = True
+                server.scheduler.wake()
+
             signal.signal(signal.SIGINT, signal_handler)
             signal.signal(signal.SIGTERM, signal_handler)
 
-            server = awsh_server()
             print("Starting aws helper server")
 
             server.start_server()
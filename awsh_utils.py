@@ -1,7 +1,9 @@
 from os.path import expanduser
+import fcntl
 import json
 import os
 import re
+import threading
 
 INSTANCES_DIR = expanduser("~") + '/saved_instances'
 LOGIN_FILE = INSTANCES_DIR + '/saved_logins'
@@ -102,46 +104,169 @@ def get_login_and_kernel_by_ami_name(ami_name: str):
     return 'ec2-user', ''
 
 
-def get_available_interface_in_az_list(interfaces : dict, instances : list, az : str) -> list:
-    """This functions returns a list containing the available ENIs
-    in the provided availability zone
-    @interfaces: dictionary of interfaces as defined created by the awsh_server
-    class
-    @az: the availability zone to search available ENIs in
+class awsh_saved_logins:
+    """In-memory index of the saved logins file. Each line of the file is a
+    JSON entry of a server, identified by its line number.
+
+    The file is indexed by server and by the offset of each line. The index
+    is rebuilt whenever the file's modification time or size change, e.g.
+    when another process adds an entry"""
+
+    def __init__(self, login_file : str):
+        self.login_file = login_file
+        self.lock = threading.Lock()
+        self.__reset(None)
+
+    def __reset(self, file_stat):
+        # identifies the content the index was built from
+        self.file_stat = file_stat
+        # line number (starting at 1) of each server's first entry
+        self.servers = dict()
+        # offset in the file of each line
+        self.offsets = list()
+        self.file_len = 0
+
+    def __index_line(self, line : bytes, offset : int):
+        self.offsets.append(offset)
+        line_nr = len(self.offsets)
+
+        try:
+            server = json.loads(line)['server']
+        except (ValueError, KeyError, TypeError):
+            return
+
+        self.servers.setdefault(server, line_nr)
+        # entries can be saved as user@server
+        self.servers.setdefault(server.rpartition('@')[2], line_nr)
+
+    def __refresh(self):
+        """Rebuild the index if the file changed. Must be called with the lock
+        held"""
+        try:
+            st = os.stat(self.login_file)
+        except FileNotFoundError:
+            self.__reset(None)
+            return
+
+        file_stat = (st.st_ino, st.st_size, st.st_mtime_ns)
+        if file_stat == self.file_stat:
+            return
+
+        self.__reset(file_stat)
+
+        with open(self.login_file, 'rb') as f:
+            offset = 0
+            for line in f:
+                self.__index_line(line, offset)
+                offset += len(line)
+
+        self.file_len = offset
+
+    def find(self, server : str):
+        """@returns the line number of @server's entry or None"""
+        with self.lock:
+            self.__refresh()
+            return self.servers.get(server)
+
+    def add(self, entry : dict) -> int:
+        """Append @entry to the file
+
+        @returns its line number"""
+        return self.add_many([ entry ])[0]
+
+    def add_many(self, entries : list) -> list:
+        """Append the entries whose server isn't saved yet to the file, using
+        a single write
+
+        @returns the line number of each entry's server"""
+        if not os.path.exists(INSTANCES_DIR):
+            os.mkdir(INSTANCES_DIR)
+
+        # the file lock keeps other processes from appending between reading
+        # the index and writing the new lines, which would move them. It's a
+        # flock() lock, since a lockf() one is released as soon as the index
+        # refresh closes its own descriptor of the file
+        with self.lock, open(self.login_file, "ab") as lfile:
+            fcntl.flock(lfile, fcntl.LOCK_EX)
+            try:
+                self.__refresh()
+
+                line_nrs = list()
+                # servers added by this call -> their line number
+                added = dict()
+                new_lines = list()
+                for entry in entries:
+                    server = entry['server']
+                    line_nr = self.servers.get(server) or added.get(server)
+                    if line_nr is None:
+                        new_lines.append("{}\n".format(json.dumps(entry)).encode())
+                        line_nr = added[server] = len(self.offsets) + len(new_lines)
+
+                    line_nrs.append(line_nr)
+
+                if not new_lines:
+                    return line_nrs
+
+                lfile.write(b''.join(new_lines))
+                lfile.flush()
+
+                # only the new lines need to be indexed
+                offset = self.file_len
+                for line in new_lines:
+                    self.__index_line(line, offset)
+                    offset += len(line)
+
+                st = os.stat(self.login_file)
+                self.file_len = offset
+                self.file_stat = (st.st_ino, st.st_size, st.st_mtime_ns)
+            finally:
+                fcntl.flock(lfile, fcntl.LOCK_UN)
+
+            return line_nrs
+
+    def get(self, index : int):
+        """@returns the entry in the line following line number @index (the
+        indices get_entry_at_index() always used) or None"""
+        with self.lock:
+            self.__refresh()
+
+            if index < 0:
+                index += len(self.offsets)
+            if not 0 <= index < len(self.offsets):
+                return None
+
+            with open(self.login_file, 'rb') as lfile:
+                lfile.seek(self.offsets[index])
+                line = lfile.readline()
+
+        return json.loads(line)
+
+    def clear(self):
+        with self.lock, open(self.login_file, 'ab') as lfile:
+            fcntl.flock(lfile, fcntl.LOCK_EX)
+            try:
+                lfile.truncate(0)
+                self.__refresh()
+            finally:
+                fcntl.flock(lfile, fcntl.LOCK_UN)
+
+
+saved_logins = awsh_saved_logins(LOGIN_FILE)
 
-    @returns a @enis_ids list"""
 
-    # create a set of all interfaces that are already connected
-    used_interfaces = set()
-    for instance in instances:
-        if instance["az"] != az:
-            continue
-
-        for interface in instance["interfaces"]:
-            used_interfaces.add(interface["id"])
-
-    possible_interfaces = []
-    for eni, interface in interfaces.items():
-        status = interface['status']
-        interface_az = interface['az']
-
-        # these are interfaces created by default. Don't count them
-        if interface['delete_on_termination']:
-            continue
-
-        if interface_az != az:
-            continue
-
-        if eni in used_interfaces:
-            continue
-
-        possible_interfaces.append(eni)
+def clean_saved_logins():
+    saved_logins.clear()
 
-    return possible_interfaces
 
-
-def clean_saved_logins():
-    open(LOGIN_FILE, 'w').close()
+def _login_entry(server, username, key, kernel, ami_name) -> dict:
+    key_path = '{}/{}.pem'.format(KEYS_DIR, key)
+    return {
+        "username": username,
+        "server": server,
+        "key": key_path,
+        "kernel": kernel,
+        "ami_name": ami_name
+    }
 
 
 # TODO: maybe add an option to insert an entry from the start ?
@@ -154,20 +279,9 @@ def find_in_saved_logins(server, username=None, key=None, kernel="",
     if len(server) == 0:
         return None
 
-    if not os.path.exists(INSTANCES_DIR):
-        os.mkdir(INSTANCES_DIR)
-
-    # create the login file if it doesn't exist
-    with open(LOGIN_FILE, "a"):
-        pass
-
-    with open(LOGIN_FILE, "r+") as lfile:
-        line_nr = 1
-        for line in lfile:
-            if server in line:
-                return line_nr
-
-            line_nr += 1
+    line_nr = saved_logins.find(server)
+    if line_nr is not None:
+        return line_nr
 
     if add_if_missing and (not username or not key):
         print("Need username and key to add non-existing entry to logins")
@@ -176,19 +290,29 @@ def find_in_saved_logins(server, username=None, key=None, kernel="",
     if not add_if_missing:
         return None
 
-    with open(LOGIN_FILE, "a") as lfile:
-        key_path = '{}/{}.pem'.format(KEYS_DIR, key)
-        entry = {
-            "username": username,
-            "server": server,
-            "key": key_path,
-            "kernel": kernel,
-            "ami_name": ami_name
-        }
+    return saved_logins.add(_login_entry(server, username, key, kernel, ami_name))
+
+
+def index_instances_in_saved_logins(instances : list) -> dict:
+    """Save the logins of all running instances in @instances (which can
+    belong to several regions). Instances which are already saved keep their
+    entry, the rest are appended in a single write
 
-        lfile.write("{}\n".format(json.dumps(entry)))
+    @returns a dictionary with the ids of the running instances as keys and
+    their line number in the saved logins as value"""
+    instances_ids = list()
+    entries = list()
+    for instance in instances:
+        server = instance.get("public_dns")
+        if instance["state"]["Name"] != "running" or not server or not instance.get("key"):
+            continue
+
+        username, kernel = get_login_and_kernel_by_ami_name(instance["ami_name"])
 
-    return line_nr
+        instances_ids.append(instance["id"])
+        entries.append(_login_entry(server, username, instance["key"], kernel, instance["ami_name"]))
+
+    return dict(zip(instances_ids, saved_logins.add_many(entries)))
 
 
 def get_entry_at_index(index):
@@ -196,14 +320,7 @@ def get_entry_at_index(index):
     if not isinstance(index, int):
         return None
 
-    with open(LOGIN_FILE, "r") as lfile:
-        lines = lfile.readlines()
-        if len(lines) <= index:
-            return None
-
-        line = lines[index]
-
-    return json.loads(line)
+    return saved_logins.get(index)
 
 
 def main():
@@ -147,6 +147,24 @@ class ec2_instance(QWidget):
             hlayout.addWidget(label)
 
 
+    def updateInstance(self, instance : dict):
+        """Redraw the widget with the new information of its instance"""
+        self.instance = instance
+
+        instance_state = True if instance["state"]["Name"] == "running" else False
+        self.instance_state_indicator.setProperty("running", instance_state)
+        self.instance_state_indicator.style().polish(self.instance_state_indicator)
+
+        tag_name = instance["name"] if instance["name"] != "" else instance["id"]
+        self.instance_desc.setText(tag_name)
+
+        while self.bottom.count():
+            self.bottom.takeAt(0).widget().deleteLater()
+        self.__add_interfaces(self.bottom)
+
+        self.update()
+
+
     def mark(self):
         self.upper_container.setProperty("selected", True)
         self.upper_container.style().polish(self.upper_container)
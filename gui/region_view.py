@@ -18,7 +18,8 @@ class region_view(QWidget):
     """Lists the insatnces and operations in a specific region"""
 
     def __init__(self, region : str, region_long_name : str, instances : list,
-                 interfaces : dict, subnets : dict):
+                 interfaces : dict, subnets : dict, version : int = 0,
+                 subscribe : bool = False):
         super().__init__()
 
         self.logger = logging.getLogger(f"awsh_region_view_{region}")
@@ -32,7 +33,8 @@ class region_view(QWidget):
         # initialization. Maybe execute asynchronous call to server to require
         # them after region is displayed
         self.ctl = region_view_ctl(region, instances, interfaces, subnets,
-                                   INSTANCES_VIEW_ROW_LEN, self.signals)
+                                   INSTANCES_VIEW_ROW_LEN, self.signals,
+                                   version=version, subscribe=subscribe)
 
         # draw the GUI part
         self.createUpperLayout()
@@ -144,6 +146,25 @@ class region_view(QWidget):
         self._setInstancesIndices()
 
 
+    # Slot function
+    def applyStateEvent(self, event : dict):
+        """The server pushed a change to the region. Redraw only the instances
+        which changed"""
+        ctl = self.ctl
+
+        changed_rows = ctl.applyStateEvent(event)
+        if changed_rows is None:
+            self.updateInstances()
+            return
+
+        instances = ctl.getInstancesList()
+        for row in changed_rows:
+            self.instances_widgets[row].updateInstance(instances[row])
+
+        if ctl.getSelectedInstance() in changed_rows:
+            self._updateInstanceDesc()
+
+
     def _add_widget_pair(self, fwidget : QWidget, swidget : QWidget):
         """Creates a horizonal layout of widget pairs"""
         pair_layout = QHBoxLayout()
@@ -397,6 +418,7 @@ class region_view(QWidget):
         signals.server_commands_added.connect(self._updateMessages)
         signals.instances_list_changed.connect(self.updateInstances)
         signals.instances_indices_changed.connect(self._setInstancesIndices)
+        signals.state_event_received.connect(self.applyStateEvent)
 
 
     # slot function
@@ -1,12 +1,12 @@
 from typing import Dict, Tuple, Union, Callable, Any
 import logging
 
-from awsh_client import awsh_client
+from awsh_client import awsh_client, query_state
 
 from PyQt5.QtCore import QObject, pyqtSignal
 
 from awsh_ui import awsh_ui
-from awsh_utils import awsh_get_subnet_color, clean_saved_logins, find_in_saved_logins, get_available_interface_in_az_list, get_login_and_kernel_by_ami_name
+from awsh_utils import awsh_get_subnet_color, clean_saved_logins, find_in_saved_logins, get_login_and_kernel_by_ami_name
 
 
 class region_view_command_status(QObject):
@@ -22,6 +22,9 @@ class region_view_signals(QObject):
     server_commands_added = pyqtSignal()
     instances_list_changed = pyqtSignal()
     instances_indices_changed = pyqtSignal()
+    # carries a state event pushed by the server. Emitted from the
+    # connection's thread, the slot runs in the GUI's
+    state_event_received = pyqtSignal(object)
 
 
 CLIENT_FUNC_TYPE = Callable[[Callable], Any]
@@ -34,7 +37,8 @@ class region_view_ctl():
 
     def __init__(self, region : str, instances : list,
                  interfaces : dict, subnets : dict,
-                 inst_row_len : int, signals : region_view_signals) -> None:
+                 inst_row_len : int, signals : region_view_signals,
+                 version : int = 0, subscribe : bool = False) -> None:
 
         self.logger = logging.getLogger(f"awsh_region_view_ctl_{region}")
         # TODO: this doesn't work for some reason... Only 'INFO' logs show
@@ -57,10 +61,15 @@ class region_view_ctl():
         self.server_commands = list()
         self.instances_indices = None
 
-        self.client = awsh_client(region, instances, interfaces)
+        # @version is the one of the region snapshot the instances were taken
+        # from. Server events which aren't newer are already reflected in them
+        self.client = awsh_client(region, instances, interfaces, version=version)
 
         self._configureKeybindings()
 
+        if subscribe:
+            self.client.subscribe(self.signals.state_event_received.emit)
+
 
     def setUI(self, ui_class : awsh_ui):
         self.ui = ui_class
@@ -150,6 +159,54 @@ class region_view_ctl():
         client_func(client_cb)
 
 
+    def __getSelectionInList(self, instances : list) -> Union[int, None]:
+        """Find the index of the selected instance in a new @instances list.
+        If it no longer exists, the instance before it is selected instead"""
+        chosen_ix = None
+        if self.chosen_instance_ix is not None and self.chosen_instance_ix < len(self.instances):
+            prev_instance_id = self.instances[self.chosen_instance_ix]["id"]
+
+            for ix, instance in enumerate(instances):
+                if instance["id"] == prev_instance_id:
+                    chosen_ix = ix
+                    break
+
+        # selected instance no longer exists
+        instances_nr = len(instances)
+        if chosen_ix is None and instances_nr > 0:
+            # this would cover both None case and 0
+            if not self.chosen_instance_ix:
+                chosen_ix = 0
+            else:
+                chosen_ix = (self.chosen_instance_ix - 1) % instances_nr
+
+        return chosen_ix
+
+
+    def applyStateEvent(self, event : dict) -> Union[list, None]:
+        """Apply a change to the region, either pushed by the server or the
+        reply of a command. Must be called from the GUI thread
+
+        @returns the indices of the instances which changed in place, or None
+        if instances were added or removed and the whole list needs to be
+        drawn again"""
+        client = self.client
+
+        subnets = event.get("fields", event.get("snapshot", dict())).get("subnets")
+        if subnets is not None and event["version"] > client.version:
+            self.subnets.clear()
+            self.subnets.update(subnets)
+
+        changed_rows = client.apply_patch(event)
+        if changed_rows is None:
+            self.chosen_instance_ix = self.__getSelectionInList(client.instances)
+            self.previous_selected_instance = None
+
+        self.instances = client.instances
+
+        return changed_rows
+
+
     def _refreshInstances(self):
         client = self.client
 
@@ -165,28 +222,10 @@ class region_view_ctl():
             # make sure selection is still valid
             # some instances might be terminated and the new insatnces
             # list is different
-            prev_select_instance = self.instances[self.chosen_instance_ix]
-            prev_instance_id = prev_select_instance["id"]
-
-            chosen_ix = None
-            for ix, instance in enumerate(client.instances):
-                if instance["id"] == prev_instance_id:
-                    chosen_ix = ix
-                    break
-
-            # selected instance no longer exists
-            instances_nr = len(client.instances)
-            if chosen_ix is None and instances_nr > 0:
-                # this would cover both None case and 0
-                if not self.chosen_instance_ix:
-                    chosen_ix = 0   
-                else:
-                    chosen_ix = (self.chosen_instance_ix - 1) % instances_nr
-
+            self.chosen_instance_ix = self.__getSelectionInList(client.instances)
 
             self.logger.info("region instances queried. Emitting signal")
 
-            self.chosen_instance_ix = chosen_ix
             # TODO: need to decide whether the client should hold any state. It
             # is really only needed to know which ENIs I can still attach and
             # which not
@@ -212,11 +251,14 @@ class region_view_ctl():
         instance = self.instances[self.chosen_instance_ix]
         instance_az = instance["az"]
 
-        available_enis = get_available_interface_in_az_list(
-            self.interfaces,
-            self.instances,
-            instance_az)
+        # the server finds the free interfaces with its index of the attached
+        # ones instead of going over all the instances
+        free_enis = query_state('interfaces', fields=[ 'id' ], regions=[ self.region ],
+                                free='true', az=instance_az).get(self.region, list())
+        available_enis = [ eni["id"] for eni in free_enis if eni["id"] in self.interfaces ]
 
+        # the region's subnets are held and updated by the subscription,
+        # there's nothing to save by querying them
         subnets = self.subnets.values()
         available_subnets_ids = list()
         for subnet in subnets:
@@ -293,18 +335,12 @@ class region_view_ctl():
         instance["num_interfaces"] = num_interface + 1
 
         def __connectExistingEniCB(success : Any, server_reply : Union[dict, None]):
-            if not success:
+            if not success or not server_reply:
                 eni["status"] = 'available'
                 return
 
-            instance_info = server_reply
-            if instance_info is not None:
-                instance.update(instance_info)
-
-            eni["status"] = 'in-use'
-            # while it's not true, it's easier than asking the GUI to draw a
-            # specific instance
-            self.signals.instances_list_changed.emit()
+            # the reply is the region's patch, applied in the GUI thread
+            self.signals.state_event_received.emit(server_reply)
     
         client = self.client
         instance_name = instance["id"]
@@ -373,17 +409,8 @@ class region_view_ctl():
             if not success or server_reply is None:
                 return
 
-            detached_enis = server_reply["detached_enis"]
-            instance_info = server_reply["instance"]
-
-            for eni_id in detached_enis:
-                if eni_id in self.interfaces:
-                    self.interfaces[eni_id]["status"] = "available"
-
-            instance.update(instance_info)
-            # while it's not true, it's easier than asking the GUI to draw a
-            # specific instance
-            self.signals.instances_list_changed.emit()
+            # the reply is the region's patch, applied in the GUI thread
+            self.signals.state_event_received.emit(server_reply)
 
         client = self.client
 
@@ -417,19 +444,19 @@ class region_view_ctl():
         if state >= 2:
             return
 
-        client = self.client
         instance = self.instances[self.chosen_instance_ix]
 
         def __set_state_func(cb):
             self.client.set_instance_state(instance, state, cb)   
 
 
-        def __set_state_cb(success : Any, _):
-            if not success:
+        def __set_state_cb(success : Any, server_reply : Union[dict, None]):
+            # stopping an instance has no reply, the change is pushed by the
+            # server once the instance's state is refreshed
+            if not success or not server_reply:
                 return
 
-            self.instances = client.instances
-            self.signals.instances_list_changed.emit()
+            self.signals.state_event_received.emit(server_reply)
 
         action_strs = [ 
             "Starting", "Stopping", "Rebooting", "Terminating"
@@ -526,6 +553,21 @@ class region_view_ctl():
         self.signals.instances_indices_changed.emit()
 
 
+    def _index_all_instances(self):
+        """Index all running instances in the region at once"""
+        indices = self.client.index_instances()
+        self.logger.debug(f"indexed {len(indices)} running instances")
+
+        if self.instances_indices is None:
+            self._getInstancesCachedIndices()
+
+        for i, instance in enumerate(self.instances):
+            if instance["id"] in indices:
+                self.instances_indices[i] = indices[instance["id"]] # pyright: ignore
+
+        self.signals.instances_indices_changed.emit()
+
+
     def _clear_all_indices(self):
         clean_saved_logins()
         self.instances_indices = dict()
@@ -568,6 +610,8 @@ class region_view_ctl():
         indices_manu = dict()
         self._addKeybind(indices_manu, "Index instance", "I", [],
                          self._index_current_instance)
+        self._addKeybind(indices_manu, "Index all running instances", "A", [],
+                         self._index_all_instances)
         self._addKeybind(indices_manu, "Clear cached instances", "C", [],
                          self._clear_all_indices)
 
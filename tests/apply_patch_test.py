@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+"""Tests of awsh_client.apply_patch() with the patches the server sends.
+
+The patches are produced by an in-memory awsh_cache, the way the server
+produces them: the replies of mutating commands (update_region_entries())
+and subscription events (cache listeners). They're passed through JSON like
+on the wire. Run directly or with pytest."""
+
+import json
+import sys
+from os import path
+
+# dirty hack allowing the test to be triggerred as stand alone application and
+# still be able to access all modules in repo
+file_dir = path.dirname(path.realpath(__file__))
+main_dir = path.dirname(file_dir)
+sys.path.append(main_dir)
+
+from awsh_cache import awsh_cache
+from awsh_client import awsh_client
+
+REGION = 'us-east-1'
+OTHER_REGION = 'eu-west-1'
+
+
+def make_instance(i, state = 'running', enis = ()):
+    return {
+        'id'            : f'i-{i}',
+        'name'          : f'test-{i}',
+        'state'         : { 'Name' : state },
+        'interfaces'    : [ { 'id' : eni_id } for eni_id in enis ],
+    }
+
+
+def make_interface(i, status = 'available'):
+    return { 'id' : f'eni-{i}', 'status' : status, 'az' : 'us-east-1a' }
+
+
+class region_fixture:
+    """A cache holding a region, a client built from the region's snapshot and
+    the subscription events of the region"""
+
+    def __init__(self, instances_nr = 3, interfaces_nr = 2):
+        self.cache = awsh_cache()
+        self.cache.create_cache()
+        self.cache.set_instances([ make_instance(i) for i in range(instances_nr) ], REGION)
+        self.cache.set_interfaces({ f'eni-{i}' : make_interface(i) for i in range(interfaces_nr) }, REGION)
+
+        region_data = self.on_wire(self.cache.get_instances()[REGION])
+        self.client = awsh_client(REGION, region_data['instances'], region_data['interfaces'],
+                                  version=region_data['version'])
+
+        self.events = list()
+        self.cache.add_listener(lambda region, version, changes:
+                                self.events.append(self.on_wire(dict(changes, region=region, version=version))))
+
+    @staticmethod
+    def on_wire(data):
+        return json.loads(json.dumps(data))
+
+    def region(self):
+        return self.on_wire(self.cache.get_instances()[REGION])
+
+    def assert_in_sync(self):
+        region_data = self.region()
+        assert self.client.instances == region_data['instances']
+        assert self.client.interfaces == region_data['interfaces']
+        assert self.client.version == region_data['version']
+
+
+def test_modified_instances_are_updated_in_place():
+    fixture = region_fixture()
+    instances = fixture.client.instances
+
+    patch = fixture.cache.set_instance(make_instance(1, state='stopped'), REGION)
+    assert fixture.client.apply_patch(fixture.on_wire(patch)) == [ 1 ]
+
+    assert fixture.client.instances is instances
+    assert instances[1]['state'] == { 'Name' : 'stopped' }
+    fixture.assert_in_sync()
+
+
+def test_added_instance_replaces_the_list():
+    fixture = region_fixture()
+    instances = fixture.client.instances
+
+    patch = fixture.cache.update_region_entries(REGION, instances=[ make_instance(7, enis=[ 'eni-0' ]) ],
+                                                interfaces={ 'eni-0' : make_interface(0, 'in-use') })
+    assert fixture.client.apply_patch(fixture.on_wire(patch)) is None
+
+    # callers holding the old list keep seeing it unchanged
+    assert fixture.client.instances is not instances
+    assert len(instances) == 3
+    assert fixture.client.interfaces['eni-0']['status'] == 'in-use'
+    fixture.assert_in_sync()
+
+
+def test_removed_entries():
+    fixture = region_fixture()
+
+    # an instance and an interface disappear, another instance changes
+    fixture.cache.apply_instance_changes(REGION, [ make_instance(2, state='stopped') ], [ 'i-0' ],
+                                         has_running_instances=True)
+    interfaces = fixture.region()['interfaces']
+    del interfaces['eni-1']
+    fixture.cache.set_interfaces(interfaces, REGION)
+
+    assert len(fixture.events) == 2
+    for event in fixture.events:
+        assert event['region'] == REGION
+
+    assert fixture.client.apply_patch(fixture.events[0]) is None
+    assert fixture.client.apply_patch(fixture.events[1]) == []
+
+    assert [ instance['id'] for instance in fixture.client.instances ] == [ 'i-1', 'i-2' ]
+    assert list(fixture.client.interfaces) == [ 'eni-0' ]
+    fixture.assert_in_sync()
+
+
+def test_version_gaps_and_stale_patches():
+    fixture = region_fixture()
+
+    # versions are shared by all regions, so consecutive patches of a region
+    # usually skip versions
+    fixture.cache.set_instances([ make_instance(9) ], OTHER_REGION)
+    fixture.cache.set_instance(make_instance(0, state='stopped'), OTHER_REGION)
+    patch = fixture.on_wire(fixture.cache.set_instance(make_instance(0, state='stopped'), REGION))
+    assert patch['version'] > fixture.client.version + 1
+
+    assert fixture.client.apply_patch(patch) == [ 0 ]
+    fixture.assert_in_sync()
+
+    # the reply of a command and the subscription event carry the same
+    # change, whichever arrives second is ignored
+    assert fixture.events[-1]['version'] == patch['version']
+    assert fixture.client.apply_patch(fixture.events[-1]) == []
+
+    # a patch older than the state is ignored
+    stale = dict(patch, version=patch['version'] - 1,
+                 instances={ 'changed' : [ make_instance(0, state='terminated') ], 'removed' : [ 'i-1' ] })
+    assert fixture.client.apply_patch(stale) == []
+    fixture.assert_in_sync()
+
+
+def test_unchanged_region_isnt_published():
+    fixture = region_fixture()
+    version = fixture.client.version
+
+    # a refresh which finds the region as it was
+    fixture.cache.set_instances(fixture.region()['instances'], REGION, has_running_instances=False)
+    assert fixture.region()['version'] == version + 1
+    fixture.cache.set_instances(fixture.region()['instances'], REGION, has_running_instances=False)
+    fixture.cache.set_interfaces(fixture.region()['interfaces'], REGION)
+
+    patch = fixture.cache.update_region_entries(REGION, instances=[ make_instance(0) ])
+    assert patch == { 'region' : REGION, 'version' : version + 1 }
+    assert fixture.region()['version'] == version + 1
+    # only the first refresh, which added has_running_instances, was sent
+    assert [ event['version'] for event in fixture.events ] == [ version + 1 ]
+    assert fixture.cache.get_encoded_changed_regions({ REGION : version + 1 }) == b'{}'
+
+
+def test_subscribing_sends_missed_changes():
+    fixture = region_fixture()
+    instances = fixture.client.instances
+
+    # changes published after the client's snapshot was taken, and before
+    # it subscribed
+    fixture.cache.set_instance(make_instance(1, state='stopped'), REGION)
+    fixture.cache.update_region_entries(REGION, instances=[ make_instance(7) ],
+                                        interfaces={ 'eni-7' : make_interface(7) })
+
+    events = list()
+    listener = lambda region, version, changes: events.append(fixture.on_wire(dict(changes, region=region,
+                                                                                   version=version)))
+    fixture.cache.add_listener(listener, { REGION : fixture.client.version, OTHER_REGION : 0 })
+
+    # only the region which changed, as a whole
+    assert [ event['region'] for event in events ] == [ REGION ]
+    assert fixture.client.apply_patch(events[0]) is None
+    assert fixture.client.instances is not instances
+    fixture.assert_in_sync()
+
+    # a client which is up to date gets nothing until the next change
+    events.clear()
+    fixture.cache.remove_listener(listener)
+    fixture.cache.add_listener(listener, { REGION : fixture.client.version })
+    assert events == []
+    fixture.cache.set_instance(make_instance(7, state='stopped'), REGION)
+    assert len(events) == 1
+    assert fixture.client.apply_patch(events[0]) == [ 3 ]
+    fixture.assert_in_sync()
+
+
+def main():
+    test_modified_instances_are_updated_in_place()
+    test_added_instance_replaces_the_list()
+    test_removed_entries()
+    test_version_gaps_and_stale_patches()
+    test_unchanged_region_isnt_published()
+    test_subscribing_sends_missed_changes()
+    print("all tests passed")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+"""Tests of the filtering of cached entries (awsh_cache.query()) and of
+finding an instance by one of its addresses (awsh_cache.lookup()).
+
+Run directly or with pytest."""
+
+import sys
+from os import path
+
+# dirty hack allowing the test to be triggerred as stand alone application and
+# still be able to access all modules in repo
+file_dir = path.dirname(path.realpath(__file__))
+main_dir = path.dirname(file_dir)
+sys.path.append(main_dir)
+
+from awsh_cache import awsh_cache
+
+
+def make_instance(i, name, state, az, enis = ()):
+    return {
+        'id'            : f'i-{i}',
+        'name'          : name,
+        'state'         : { 'Code' : 16 if state == 'running' else 80, 'Name' : state },
+        'az'            : az,
+        'public_dns'    : f'ec2-{i}.compute.amazonaws.com' if state == 'running' else '',
+        'public_ip'     : f'3.0.0.{i}' if state == 'running' else None,
+        'interfaces'    : [ { 'id' : eni_id, 'private_ip' : f'10.0.{i}.{ix}' }
+                            for ix, eni_id in enumerate(enis) ],
+    }
+
+
+def make_interface(eni_id, subnet, az, delete_on_termination = False):
+    return {
+        'id'                    : eni_id,
+        'subnet'                : subnet,
+        'az'                    : az,
+        'delete_on_termination' : delete_on_termination,
+    }
+
+
+def make_cache():
+    cache = awsh_cache()
+    cache.create_cache()
+
+    cache.set_instances({
+        'us-east-1' : [
+            make_instance(1, 'web-1', 'running', 'us-east-1a', enis=[ 'eni-1', 'eni-2' ]),
+            make_instance(2, 'web-2', 'stopped', 'us-east-1b', enis=[ 'eni-3' ]),
+            make_instance(3, 'db-1', 'running', 'us-east-1b', enis=[ 'eni-4' ]),
+        ],
+        'eu-west-1' : [
+            make_instance(4, 'web-3', 'running', 'eu-west-1a', enis=[ 'eni-5' ]),
+        ],
+    })
+    cache.set_interfaces({
+        'us-east-1' : {
+            'eni-1' : make_interface('eni-1', 'subnet-a', 'us-east-1a', delete_on_termination=True),
+            'eni-2' : make_interface('eni-2', 'subnet-a', 'us-east-1a'),
+            'eni-3' : make_interface('eni-3', 'subnet-b', 'us-east-1b', delete_on_termination=True),
+            'eni-4' : make_interface('eni-4', 'subnet-b', 'us-east-1b', delete_on_termination=True),
+            'eni-6' : make_interface('eni-6', 'subnet-b', 'us-east-1b'),
+        },
+        'eu-west-1' : {
+            'eni-5' : make_interface('eni-5', 'subnet-c', 'eu-west-1a', delete_on_termination=True),
+        },
+    })
+    cache.set_subnets({
+        'us-east-1' : {
+            'subnet-a' : { 'id' : 'subnet-a', 'az' : 'us-east-1a' },
+            'subnet-b' : { 'id' : 'subnet-b', 'az' : 'us-east-1b' },
+        },
+        'eu-west-1' : dict(),
+    })
+
+    return cache
+
+
+def ids(results):
+    return { region : [ entry['id'] for entry in entries ] for region, entries in results.items() }
+
+
+def test_filter_instances():
+    cache = make_cache()
+
+    # instances are matched by the name of their state
+    assert ids(cache.query('instances', { 'state' : [ 'running' ] })) == {
+        'us-east-1' : [ 'i-1', 'i-3' ],
+        'eu-west-1' : [ 'i-4' ],
+    }
+    # each field matches any of its patterns, all fields have to match
+    assert ids(cache.query('instances', { 'name' : [ 'web-*', 'db-?' ], 'state' : [ 'stopped' ] })) == {
+        'us-east-1' : [ 'i-2' ],
+    }
+    assert cache.query('instances', { 'name' : [ 'cache-*' ] }) == dict()
+
+
+def test_indexed_and_scanned_filters_agree():
+    cache = make_cache()
+
+    # an exact availability zone is looked up in the index, a pattern is
+    # matched against every instance
+    exact = cache.query('instances', { 'az' : [ 'us-east-1b' ] })
+    pattern = cache.query('instances', { 'az' : [ 'us-east-1[b]' ] })
+    assert ids(exact) == ids(pattern) == { 'us-east-1' : [ 'i-2', 'i-3' ] }
+
+    exact = cache.query('interfaces', { 'subnet' : [ 'subnet-a', 'subnet-c' ] })
+    pattern = cache.query('interfaces', { 'subnet' : [ 'subnet-[ac]' ] })
+    assert ids(exact) == ids(pattern) == { 'us-east-1' : [ 'eni-1', 'eni-2' ], 'eu-west-1' : [ 'eni-5' ] }
+
+    # the index follows updates of the region
+    cache.set_instance(make_instance(2, 'web-2', 'stopped', 'us-east-1a'), 'us-east-1')
+    assert ids(cache.query('instances', { 'az' : [ 'us-east-1b' ] })) == { 'us-east-1' : [ 'i-3' ] }
+
+
+def test_free_interfaces():
+    cache = make_cache()
+
+    # free interfaces aren't attached and aren't deleted with an instance
+    assert ids(cache.query('interfaces', { 'free' : [ 'true' ] })) == { 'us-east-1' : [ 'eni-6' ] }
+    assert ids(cache.query('interfaces', { 'free' : [ 'false' ], 'az' : [ 'us-east-1a' ] })) == {
+        'us-east-1' : [ 'eni-1', 'eni-2' ],
+    }
+    # booleans are matched as 'true' and 'false'
+    assert ids(cache.query('interfaces', { 'delete_on_termination' : [ 'false' ] })) == {
+        'us-east-1' : [ 'eni-2', 'eni-6' ],
+    }
+
+
+def test_get_free_interfaces():
+    cache = make_cache()
+
+    assert [ eni['id'] for eni in cache.get_free_interfaces('us-east-1') ] == [ 'eni-6' ]
+    assert [ eni['id'] for eni in cache.get_free_interfaces('us-east-1', az='us-east-1b') ] == [ 'eni-6' ]
+    assert cache.get_free_interfaces('us-east-1', az='us-east-1a') == []
+
+    # the interface is no longer free once an instance has it attached
+    cache.set_instance(make_instance(2, 'web-2', 'stopped', 'us-east-1b', enis=[ 'eni-3', 'eni-6' ]), 'us-east-1')
+    assert cache.get_free_interfaces('us-east-1') == []
+
+
+def test_fields_and_regions():
+    cache = make_cache()
+
+    assert cache.query('instances', { 'name' : [ 'web-1' ] }, fields=[ 'id', 'public_ip', 'missing' ]) == {
+        'us-east-1' : [ { 'id' : 'i-1', 'public_ip' : '3.0.0.1', 'missing' : None } ],
+    }
+
+    # regions which were asked for are listed even without matches, unless
+    # they aren't cached
+    assert ids(cache.query('instances', { 'name' : [ 'db-*' ] },
+                           regions=[ 'us-east-1', 'eu-west-1', 'ap-south-1' ])) == {
+        'us-east-1' : [ 'i-3' ],
+        'eu-west-1' : [],
+    }
+    assert cache.query('subnets', dict(), regions=[ 'eu-west-1' ]) == { 'eu-west-1' : [] }
+    assert ids(cache.query('subnets', dict())) == { 'us-east-1' : [ 'subnet-a', 'subnet-b' ] }
+
+
+def test_unknown_target():
+    cache = make_cache()
+
+    try:
+        cache.query('volumes', dict())
+    except ValueError:
+        return
+
+    assert False, "querying an unknown target should fail"
+
+
+def test_lookup():
+    cache = make_cache()
+
+    for address in [ 'i-1', 'ec2-1.compute.amazonaws.com', '3.0.0.1', '10.0.1.1', 'eni-2' ]:
+        region, instance = cache.lookup(address)
+        assert (region, instance['id']) == ('us-east-1', 'i-1'), address
+
+    assert cache.lookup('eni-5')[0] == 'eu-west-1'
+    assert cache.find_instance_by_dns('us-east-1', 'ec2-3.compute.amazonaws.com')['id'] == 'i-3'
+    assert cache.find_instance_by_dns('eu-west-1', 'ec2-3.compute.amazonaws.com') is None
+    # a stopped instance has no public address
+    assert cache.lookup('') == (None, None)
+    assert cache.lookup('eni-6') == (None, None)
+    assert cache.lookup('10.9.9.9') == (None, None)
+
+
+def test_lookup_follows_updates():
+    cache = make_cache()
+
+    # the instance was started and got a public address
+    cache.set_instance(make_instance(2, 'web-2', 'running', 'us-east-1b', enis=[ 'eni-3', 'eni-6' ]), 'us-east-1')
+
+    region, instance = cache.lookup('3.0.0.2')
+    assert (region, instance['state']['Name']) == ('us-east-1', 'running')
+    assert cache.lookup('eni-6')[1] is instance
+
+    cache.set_instances([], 'us-east-1')
+    assert cache.lookup('i-1') == (None, None)
+
+
+def main():
+    test_filter_instances()
+    test_indexed_and_scanned_filters_agree()
+    test_free_interfaces()
+    test_get_free_interfaces()
+    test_fields_and_regions()
+    test_unknown_target()
+    test_lookup()
+    test_lookup_follows_updates()
+    print("all tests passed")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+"""Compare the 'client' and 'resource' inventory backends of awsh_ec2.Aws.
+
+EC2 is replaced by botocore Stubber fixtures, so the benchmark measures the
+number of API calls each backend issues and its local overhead (model loading,
+resource objects creation and parsing). Network latency isn't simulated, each
+API call avoided saves a round-trip on top of the numbers printed here.
+
+Usage: ec2_inventory_bench.py [--instances N] [--amis N] [--interfaces N] [--subnets N]
+"""
+
+import argparse
+import os
+import sys
+import time
+from os import path
+
+import boto3
+from botocore.stub import Stubber
+
+# dirty hack allowing the test to be triggerred as stand alone application and
+# still be able to access all modules in repo
+file_dir = path.dirname(path.realpath(__file__))
+main_dir = path.dirname(file_dir)
+sys.path.append(main_dir)
+
+import awsh_ec2
+from awsh_ec2 import Aws, INVENTORY_BACKEND_CLIENT, INVENTORY_BACKEND_RESOURCE
+
+REGION = 'us-east-1'
+
+# the stubbed clients never reach AWS, but botocore still wants credentials
+os.environ.setdefault('AWS_ACCESS_KEY_ID', 'bench')
+os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'bench')
+
+
+def make_instance(i, amis_nr):
+    return {
+        'InstanceId'        : f'i-{i:017x}',
+        'ImageId'           : f'ami-{i % amis_nr:017x}',
+        'State'             : { 'Code' : 16, 'Name' : 'running' },
+        'Architecture'      : 'x86_64',
+        'EnaSupport'        : True,
+        'KeyName'           : 'bench-key',
+        'PublicDnsName'     : f'ec2-{i}.compute-1.amazonaws.com',
+        'PublicIpAddress'   : f'3.{i >> 16 & 0xff}.{i >> 8 & 0xff}.{i & 0xff}',
+        'Placement'         : { 'AvailabilityZone' : 'us-east-1a' },
+        'InstanceType'      : 'c5.large',
+        'Tags'              : [ { 'Key' : 'Name', 'Value' : f'bench-{i}' } ],
+        'NetworkInterfaces' : [ {
+            'NetworkInterfaceId'    : f'eni-{i:017x}',
+            'MacAddress'            : '02:00:00:00:00:00',
+            'PrivateIpAddress'      : '10.0.0.1',
+            'SubnetId'              : 'subnet-0',
+            'VpcId'                 : 'vpc-0',
+            'Groups'                : [ { 'GroupName' : 'default', 'GroupId' : 'sg-0' } ],
+            'Description'           : '',
+            'Attachment'            : { 'DeleteOnTermination' : True, 'DeviceIndex' : 0 },
+        } ],
+    }
+
+
+def make_interface(i):
+    return {
+        'NetworkInterfaceId'    : f'eni-{i:017x}',
+        'AvailabilityZone'      : 'us-east-1a',
+        'MacAddress'            : '02:00:00:00:00:00',
+        'Groups'                : [ { 'GroupName' : 'default', 'GroupId' : 'sg-0' } ],
+        'PrivateIpAddress'      : '10.0.0.1',
+        'Status'                : 'in-use',
+        'SubnetId'              : 'subnet-0',
+        'SourceDestCheck'       : True,
+        'Description'           : '',
+        'TagSet'                : [ { 'Key' : 'Name', 'Value' : f'bench-eni-{i}' } ],
+        'Attachment'            : { 'DeleteOnTermination' : True },
+    }
+
+
+def make_subnet(i):
+    return {
+        'SubnetId'          : f'subnet-{i:017x}',
+        'AvailabilityZone'  : 'us-east-1a',
+        'State'             : 'available',
+        'DefaultForAz'      : False,
+        'Tags'              : [ { 'Key' : 'Name', 'Value' : f'bench-subnet-{i}' } ],
+    }
+
+
+def paged(items, page_size):
+    """Split @items into the pages EC2 would reply with. A resource collection
+    doesn't set MaxResults, in which case EC2 returns everything at once"""
+    if page_size is None:
+        return [ items ]
+
+    return [ items[i:i + page_size] for i in range(0, len(items), page_size) ] or [ [] ]
+
+
+def add_paged_responses(stubber, op, key, items, page_size, wrap = None):
+    pages = paged(items, page_size)
+    for i, page in enumerate(pages):
+        response = { key : wrap(page) if wrap else page }
+        if i < len(pages) - 1:
+            response['NextToken'] = str(i)
+        stubber.add_response(op, response)
+
+
+def stub_sweep(client, sweep, backend, args):
+    """Queue the replies EC2 would send for one sweep (instances, interfaces
+    or subnets) of a region"""
+    page_size = awsh_ec2.INVENTORY_PAGE_SIZE if backend == INVENTORY_BACKEND_CLIENT else None
+    stubber = Stubber(client)
+
+    if sweep == 'instances':
+        instances = [ make_instance(i, args.amis) for i in range(args.instances) ]
+        add_paged_responses(stubber, 'describe_instances', 'Reservations', instances,
+                            page_size, wrap=lambda page: [ { 'Instances' : page } ])
+
+        images = [ { 'ImageId' : f'ami-{i:017x}', 'Name' : 'amzn2-ami-hvm' } for i in range(args.amis) ]
+        stubber.add_response('describe_images', { 'Images' : images })
+    elif sweep == 'interfaces':
+        add_paged_responses(stubber, 'describe_network_interfaces', 'NetworkInterfaces',
+                            [ make_interface(i) for i in range(args.interfaces) ], page_size)
+    else:
+        add_paged_responses(stubber, 'describe_subnets', 'Subnets',
+                            [ make_subnet(i) for i in range(args.subnets) ], page_size)
+
+    stubber.activate()
+    return stubber
+
+
+def run_backend(backend, args):
+    calls = list()
+    def count_call(event_name, **kwargs):
+        calls.append(event_name.split('.')[-1])
+
+    # The backends create their boto3 objects through these two methods, once
+    # per sweep. Create them the same way Aws does, but stub their replies
+    sweeps = iter([ 'instances', 'interfaces', 'subnets' ])
+    def stubbed(client):
+        client.meta.events.register('before-parameter-build.ec2', count_call)
+        stub_sweep(client, next(sweeps), backend, args)
+        return client
+
+    def ec2_resource(region):
+        resource = boto3.resource('ec2', region_name=region)
+        stubbed(resource.meta.client)
+        return resource
+
+    def ec2_client(region):
+        return stubbed(boto3.client('ec2', region_name=region))
+
+    ec2 = Aws(inventory_backend=backend)
+    ec2._ec2_resource = ec2_resource
+    ec2._ec2_client = ec2_client
+
+    start = time.perf_counter()
+    instances, _ = ec2.get_instance_in_region(REGION)
+    interfaces = ec2._get_interface_in_region(REGION)
+    subnets = ec2._get_subnets_in_region(REGION)
+    elapsed = time.perf_counter() - start
+
+    return calls, elapsed, (instances, interfaces, subnets)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='awsh EC2 inventory backends benchmark')
+    parser.add_argument('--instances', type=int, default=2500)
+    parser.add_argument('--amis', type=int, default=20)
+    parser.add_argument('--interfaces', type=int, default=2500)
+    parser.add_argument('--subnets', type=int, default=200)
+    args = parser.parse_args()
+
+    print(f"Region with {args.instances} instances ({args.amis} AMIs), "
+          f"{args.interfaces} interfaces, {args.subnets} subnets")
+
+    results = dict()
+    for backend in [ INVENTORY_BACKEND_RESOURCE, INVENTORY_BACKEND_CLIENT ]:
+        calls, elapsed, results[backend] = run_backend(backend, args)
+        calls_summary = ", ".join(f"{op}: {calls.count(op)}" for op in sorted(set(calls)))
+        print(f"{backend:>10}: {len(calls):4} API calls ({calls_summary}), {elapsed * 1000:8.1f} ms")
+
+    if results[INVENTORY_BACKEND_RESOURCE] != results[INVENTORY_BACKEND_CLIENT]:
+        print("ERROR: backends returned different results")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+"""Tests of Aws.get_instance_changes_in_region() against stubbed EC2 replies.
+
+Run directly or with pytest."""
+
+import os
+import sys
+from os import path
+
+from botocore.stub import Stubber
+
+# dirty hack allowing the test to be triggerred as stand alone application and
+# still be able to access all modules in repo
+file_dir = path.dirname(path.realpath(__file__))
+main_dir = path.dirname(file_dir)
+sys.path.append(main_dir)
+
+import awsh_ec2
+from awsh_ec2 import Aws, RUNNING_STATE_CODE, TERMINATED_STATE_CODE
+
+from ec2_inventory_bench import make_instance
+
+REGION = 'us-east-1'
+PENDING_STATE_CODE = 0
+STOPPED_STATE_CODE = 80
+
+# the stubbed clients never reach AWS, but botocore still wants credentials
+os.environ.setdefault('AWS_ACCESS_KEY_ID', 'test')
+os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'test')
+
+
+def instance_id(i):
+    return make_instance(i, 1)['InstanceId']
+
+
+def status(i, code):
+    return { 'InstanceId' : instance_id(i), 'InstanceState' : { 'Code' : code, 'Name' : '' } }
+
+
+def described(i, code):
+    return dict(make_instance(i, 1), State={ 'Code' : code, 'Name' : '' })
+
+
+def stubbed_aws():
+    ec2 = Aws()
+    stubber = Stubber(ec2._ec2_client(REGION))
+    stubber.activate()
+
+    return ec2, stubber
+
+
+def add_statuses(stubber, pages):
+    for i, page in enumerate(pages):
+        response = { 'InstanceStatuses' : page }
+        if i < len(pages) - 1:
+            response['NextToken'] = str(i)
+
+        expected = { 'IncludeAllInstances' : True, 'MaxResults' : awsh_ec2.INVENTORY_PAGE_SIZE }
+        if i > 0:
+            expected['NextToken'] = str(i - 1)
+        stubber.add_response('describe_instance_status', response, expected)
+
+
+def test_changed_and_removed_instances():
+    ec2, stubber = stubbed_aws()
+
+    known_states = {
+        instance_id(1) : RUNNING_STATE_CODE,    # unchanged
+        instance_id(2) : STOPPED_STATE_CODE,    # started since
+        instance_id(3) : RUNNING_STATE_CODE,    # no longer listed
+        instance_id(4) : RUNNING_STATE_CODE,    # terminated since
+    }
+    # the statuses span two pages
+    add_statuses(stubber, [ [ status(1, RUNNING_STATE_CODE), status(2, RUNNING_STATE_CODE) ],
+                            [ status(4, TERMINATED_STATE_CODE), status(5, PENDING_STATE_CODE) ] ])
+
+    # only the changed instances are described
+    stubber.add_response('describe_instances',
+                         { 'Reservations' : [ { 'Instances' : [ described(2, RUNNING_STATE_CODE),
+                                                                described(5, PENDING_STATE_CODE) ] } ] },
+                         { 'InstanceIds' : [ instance_id(2), instance_id(5) ] })
+    stubber.add_response('describe_images',
+                         { 'Images' : [ { 'ImageId' : make_instance(0, 1)['ImageId'], 'Name' : 'ubuntu-jammy' } ] },
+                         { 'Filters' : [ { 'Name' : 'image-id', 'Values' : [ make_instance(0, 1)['ImageId'] ] } ] })
+
+    changed, removed_ids, has_running = ec2.get_instance_changes_in_region(REGION, known_states)
+
+    assert [ instance['id'] for instance in changed ] == [ instance_id(2), instance_id(5) ]
+    assert [ instance['state']['Code'] for instance in changed ] == [ RUNNING_STATE_CODE, PENDING_STATE_CODE ]
+    assert changed[0]['distro'] == 'ubuntu'
+    assert removed_ids == [ instance_id(3), instance_id(4) ]
+    assert has_running
+    stubber.assert_no_pending_responses()
+
+
+def test_no_changes():
+    ec2, stubber = stubbed_aws()
+
+    known_states = { instance_id(1) : STOPPED_STATE_CODE }
+    add_statuses(stubber, [ [ status(1, STOPPED_STATE_CODE), status(2, TERMINATED_STATE_CODE) ] ])
+
+    # no describe_instances call is expected
+    changed, removed_ids, has_running = ec2.get_instance_changes_in_region(REGION, known_states)
+
+    assert changed == []
+    assert removed_ids == []
+    assert not has_running
+    stubber.assert_no_pending_responses()
+
+
+def test_changed_instances_are_described_in_chunks():
+    ec2, stubber = stubbed_aws()
+
+    add_statuses(stubber, [ [ status(i, RUNNING_STATE_CODE) for i in range(3) ] ])
+    for ids in [ [ 0, 1 ], [ 2 ] ]:
+        stubber.add_response('describe_instances',
+                             { 'Reservations' : [ { 'Instances' : [ described(i, RUNNING_STATE_CODE)
+                                                                    for i in ids ] } ] },
+                             { 'InstanceIds' : [ instance_id(i) for i in ids ] })
+        stubber.add_response('describe_images', { 'Images' : [] })
+
+    chunk = awsh_ec2.INSTANCE_IDS_CHUNK
+    awsh_ec2.INSTANCE_IDS_CHUNK = 2
+    try:
+        changed, _, _ = ec2.get_instance_changes_in_region(REGION, dict())
+    finally:
+        awsh_ec2.INSTANCE_IDS_CHUNK = chunk
+
+    assert [ instance['id'] for instance in changed ] == [ instance_id(i) for i in range(3) ]
+    # AMIs which weren't found have no name
+    assert all(instance['ami_name'] == '' for instance in changed)
+    stubber.assert_no_pending_responses()
+
+
+def main():
+    test_changed_and_removed_instances()
+    test_no_changes()
+    test_changed_instances_are_described_in_chunks()
+    print("all tests passed")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+"""Measure whether compressing GET_CURRENT_COMPLETE_STATE replies pays off.
+
+Complete states of fleets of different sizes are built from the same
+instances, interfaces and subnets descriptions ec2_inventory_bench.py uses,
+parsed the way the server caches them. For each of them a client requests the
+state from a server in this process and decodes it to a dict, once without
+and once with zlib compression. The time of compressing and decompressing is
+also printed on its own.
+
+The server is reached over its unix socket, like local clients do. The last
+two columns add the time sending the state (compressed or not) would take over
+a link of --link-mbps, for clients that reach the server through a slower
+connection.
+The smallest state for which the compressed transfer is faster is a good value
+for awsh_req_resp_server.COMPRESS_MIN_LEN.
+
+Usage: reply_compression_bench.py [--fleets N,N,...] [--regions N] [--repeat N] [--level N] [--link-mbps N]
+"""
+
+import argparse
+import json
+import statistics
+import sys
+import threading
+import time
+import zlib
+from os import path
+
+# dirty hack allowing the test to be triggerred as stand alone application and
+# still be able to access all modules in repo
+file_dir = path.dirname(path.realpath(__file__))
+main_dir = path.dirname(file_dir)
+sys.path.append(main_dir)
+
+import awsh_ec2
+import awsh_req_resp_server
+from awsh_req_resp_server import awsh_req_client, CAP_FRAMED, CAP_ZLIB
+
+from ec2_inventory_bench import make_instance, make_interface, make_subnet
+from req_resp_bench import free_port, temp_unix_socket_path
+
+AMIS_NR = 20
+
+
+def make_state(instances_nr, regions_nr):
+    amis = { f'ami-{i:017x}' : { 'name' : 'amzn2-ami-hvm', 'distro' : 'amazon' } for i in range(AMIS_NR) }
+
+    regions = dict()
+    for r in range(regions_nr):
+        region_ids = range(r, instances_nr, regions_nr)
+        instances = [ awsh_ec2.parse_instance_description(make_instance(i, AMIS_NR), amis) for i in region_ids ]
+        interfaces = [ awsh_ec2.parse_eni_description(make_interface(i)) for i in region_ids ]
+        subnets = [ awsh_ec2.parse_subnet_description(make_subnet(i)) for i in range(max(1, len(region_ids) // 20)) ]
+
+        regions[f'bench-region-{r}'] = {
+            'instances'             : instances,
+            'interfaces'            : { eni['id'] : eni for eni in interfaces },
+            'subnets'               : { subnet['id'] : subnet for subnet in subnets },
+            'has_running_instances' : True,
+            'long_name'             : f'Bench Region {r}',
+            'version'               : r,
+        }
+
+    return bytes(json.dumps(regions), 'ascii')
+
+
+class states_server:
+
+    def __init__(self, states):
+        self.states = states
+
+    def process_request(self, request, connection):
+        connection.complete_request(reply=self.states[int(request[0])])
+
+
+def fetch_state_times(fleet_ix, capabilities, repeat):
+    """Return the times it took to request a state and decode it to a dict"""
+    client = awsh_req_client(fail_if_no_server=True, capabilities=capabilities)
+    response_ready = threading.Event()
+
+    times = list()
+    for _ in range(repeat):
+        response_ready.clear()
+        start = time.perf_counter()
+
+        def handle_reply(connection, status, reply):
+            json.loads(reply)
+            times.append(time.perf_counter() - start)
+            response_ready.set()
+
+        client.send_request(str(fleet_ix), handle_reply)
+        response_ready.wait()
+
+    client.close()
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description='awsh reply compression benchmark')
+    parser.add_argument('--fleets', default='10,50,200,1000,5000,20000',
+                        help='comma separated numbers of instances')
+    parser.add_argument('--regions', type=int, default=8)
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--level', type=int, default=awsh_req_resp_server.COMPRESS_LEVEL)
+    parser.add_argument('--link-mbps', type=float, default=100)
+    args = parser.parse_args()
+
+    fleets = [ int(fleet) for fleet in args.fleets.split(',') ]
+    states = [ make_state(fleet, min(args.regions, fleet)) for fleet in fleets ]
+
+    # compress every reply the client accepts compressed
+    awsh_req_resp_server.COMPRESS_MIN_LEN = 0
+    awsh_req_resp_server.COMPRESS_LEVEL = args.level
+    awsh_req_resp_server.AWHS_PORT = free_port()
+    awsh_req_resp_server.AWSH_UNIX_SOCKET_PATH = temp_unix_socket_path()
+
+    server = awsh_req_resp_server.awsh_req_server(states_server(states))
+    threading.Thread(target=server.start_server, daemon=True).start()
+    time.sleep(0.2)
+
+    print(f"zlib level {args.level}, median of {args.repeat} requests (request + transfer + json decode)")
+    print(f"{'instances':>9} {'state':>10} {'compressed':>10} | {'compress':>9} {'decompress':>10} | "
+          f"{'plain':>9} {'zlib':>9} | {'plain':>9} {'zlib':>9} at {args.link_mbps:g} Mbit/s")
+
+    link_bytes_per_sec = args.link_mbps * 10**6 / 8
+
+    for fleet_ix, (fleet, state) in enumerate(zip(fleets, states)):
+        start = time.perf_counter()
+        compressed = zlib.compress(state, args.level)
+        compress_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        zlib.decompress(compressed)
+        decompress_time = time.perf_counter() - start
+
+        plain = statistics.median(fetch_state_times(fleet_ix, [ CAP_FRAMED ], args.repeat))
+        compressed_time = statistics.median(fetch_state_times(fleet_ix, [ CAP_FRAMED, CAP_ZLIB ], args.repeat))
+
+        print(f"{fleet:>9} {len(state) / 1024:>8.0f}KB {len(compressed) / 1024:>8.0f}KB | "
+              f"{compress_time * 1000:>7.2f}ms {decompress_time * 1000:>8.2f}ms | "
+              f"{plain * 1000:>7.2f}ms {compressed_time * 1000:>7.2f}ms | "
+              f"{(plain + len(state) / link_bytes_per_sec) * 1000:>7.2f}ms "
+              f"{(compressed_time + len(compressed) / link_bytes_per_sec) * 1000:>7.2f}ms")
+
+    server.handle_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+"""Measure the round-trip time of awsh requests for small and large replies.
+
+A server whose replies have a fixed size is started in this process, and a
+client sends it blocking requests followed by a burst of concurrent requests
+over a single connection. The blocking requests either open a connection
+each or share a persistent one (the way awsh_client does). Clients using the
+newline terminated replies and the framed ones are measured separately.
+
+To compare with another implementation of the transport (e.g. the asyncore
+based one) pass its source file:
+
+    git show <rev>:awsh_req_resp_server.py > /tmp/legacy_req_resp.py
+    req_resp_bench.py --legacy /tmp/legacy_req_resp.py
+
+Usage: req_resp_bench.py [--requests N] [--small BYTES] [--large BYTES] [--legacy FILE]
+"""
+
+import argparse
+import importlib.util
+import socket
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from os import path
+
+# dirty hack allowing the test to be triggerred as stand alone application and
+# still be able to access all modules in repo
+file_dir = path.dirname(path.realpath(__file__))
+main_dir = path.dirname(file_dir)
+sys.path.append(main_dir)
+
+import awsh_req_resp_server
+
+
+class fixed_reply_server:
+
+    def __init__(self, reply_sizes):
+        self.replies = { str(size) : 'x' * size for size in reply_sizes }
+
+    def process_request(self, request, connection):
+        connection.complete_request(reply=self.replies[request[0]])
+
+
+def load_module(file_path):
+    spec = importlib.util.spec_from_file_location('legacy_req_resp_server', file_path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(('localhost', 0))
+        return sock.getsockname()[1]
+
+
+def temp_unix_socket_path():
+    """A unix socket path which doesn't replace the socket of a running awsh
+    server"""
+    return path.join(tempfile.mkdtemp(prefix='awsh_bench_'), 'awsh.sock')
+
+
+def start_server(module, port, reply_sizes):
+    # both the server and the client read the addresses from the module
+    module.AWHS_PORT = port
+    module.AWSH_UNIX_SOCKET_PATH = temp_unix_socket_path()
+    # the bursts of requests would be rejected as busy otherwise
+    server_args = dict()
+    if hasattr(module, 'DEFAULT_MAX_QUEUED_REQUESTS'):
+        server_args['max_queued_requests'] = 2**16
+
+    server = module.awsh_req_server(fixed_reply_server(reply_sizes), **server_args)
+
+    server_thread = threading.Thread(target=module.start_requests_server,
+                                     args=(server,), daemon=True)
+    server_thread.start()
+    # let the server start listening
+    time.sleep(0.2)
+
+    return server
+
+
+def blocking_round_trips(module, client_args, persistent, size, requests_nr):
+    if persistent:
+        client = module.awsh_req_client(fail_if_no_server=True, synchronous=True, **client_args)
+
+    latencies = list()
+    for _ in range(requests_nr):
+        start = time.perf_counter()
+        if not persistent:
+            client = module.awsh_req_client(fail_if_no_server=True, synchronous=True, **client_args)
+
+        status, reply = client.send_request_blocking(str(size))
+
+        if not persistent:
+            client.close()
+        latencies.append(time.perf_counter() - start)
+
+        assert status == 0 and len(reply) == size
+
+    if persistent:
+        client.close()
+
+    return latencies
+
+
+def pipelined_throughput(module, client_args, size, requests_nr):
+    """Send @requests_nr requests over one connection without waiting for the
+    replies. Return the time it took to receive all of them"""
+    client = module.awsh_req_client(fail_if_no_server=True, synchronous=True, **client_args)
+    done = threading.Event()
+    received = list()
+
+    def handle_reply(connection, status, reply):
+        received.append(len(reply))
+        if len(received) == requests_nr:
+            done.set()
+            connection.close()
+
+    start = time.perf_counter()
+    for _ in range(requests_nr):
+        client.send_request(str(size), handle_reply)
+
+    if hasattr(module, 'asyncore'):
+        # the asyncore client is driven by the caller
+        module.asyncore.loop(map=client.socket_map)
+    else:
+        done.wait()
+
+    elapsed = time.perf_counter() - start
+    assert received == [ size ] * requests_nr
+
+    return elapsed
+
+
+def run(name, module, port, args, clients = { '' : (dict(), False) }):
+    """@clients: client description -> (extra arguments used to create it,
+    whether blocking requests use a persistent connection)"""
+    sizes = [ args.small, args.large ]
+    server = start_server(module, port, sizes)
+
+    for client_desc, (client_args, persistent) in clients.items():
+        print(f"{name}{client_desc}:")
+        measure_sizes(module, client_args, persistent, sizes, args)
+
+    server.handle_close()
+
+
+def measure_sizes(module, client_args, persistent, sizes, args):
+    for size in sizes:
+        requests_nr = args.requests if size == args.small else max(1, args.requests // 10)
+
+        latencies = blocking_round_trips(module, client_args, persistent, size, requests_nr)
+        latencies_ms = sorted(l * 1000 for l in latencies)
+        p90 = latencies_ms[int(len(latencies_ms) * 0.9) - 1] if len(latencies_ms) >= 10 else latencies_ms[-1]
+
+        elapsed = pipelined_throughput(module, client_args, size, requests_nr)
+
+        print(f"  {size:>9} bytes reply: round-trip median {statistics.median(latencies_ms):8.2f} ms, "
+              f"p90 {p90:8.2f} ms | {requests_nr / elapsed:8.1f} req/s, "
+              f"{requests_nr * size / elapsed / 2**20:8.1f} MiB/s over one connection")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='awsh request/response transport benchmark')
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--small', type=int, default=32)
+    parser.add_argument('--large', type=int, default=4 * 2**20)
+    parser.add_argument('--legacy', help='source file of another awsh_req_resp_server implementation')
+    args = parser.parse_args()
+
+    # over TCP like the legacy implementation, tests/transport_bench.py
+    # compares it with the unix socket
+    framed = [ awsh_req_resp_server.CAP_FRAMED ]
+    run('current', awsh_req_resp_server, free_port(), args,
+        { ' (newline replies)'                          : ({ 'capabilities' : [], 'unix_socket' : False }, False),
+          ' (framed replies)'                           : ({ 'capabilities' : framed, 'unix_socket' : False }, False),
+          ' (framed replies, persistent connection)'    : ({ 'capabilities' : framed, 'unix_socket' : False }, True) })
+
+    if args.legacy:
+        run('legacy', load_module(args.legacy), free_port(), args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+"""Tests of the refresh ordering and backoff of awsh_refresh_scheduler.
+
+The scheduler's clock is replaced by one the tests advance by hand. Run
+directly or with pytest."""
+
+import sys
+from os import path
+
+import pytest
+
+# dirty hack allowing the test to be triggerred as stand alone application and
+# still be able to access all modules in repo
+file_dir = path.dirname(path.realpath(__file__))
+main_dir = path.dirname(file_dir)
+sys.path.append(main_dir)
+
+import awsh_scheduler
+from awsh_scheduler import awsh_refresh_scheduler, RETRY_PERIOD, TOUCH_HOT_PERIOD
+
+PERIODS = {
+    'fast'  : { 'hot' : 10,     'idle' : 70 },
+    'slow'  : { 'hot' : 1000,   'idle' : 1000 },
+}
+
+
+class fake_clock:
+    """Stands in for the time module in awsh_scheduler"""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+def make_scheduler(monkeypatch):
+    clock = fake_clock()
+    monkeypatch.setattr(awsh_scheduler, 'time', clock)
+
+    return awsh_refresh_scheduler(PERIODS), clock
+
+
+def test_due_entries_in_order(monkeypatch):
+    scheduler, clock = make_scheduler(monkeypatch)
+
+    scheduler.add('slow', 'us-east-1', last_refresh=clock.now - 995)   # due in 5s
+    scheduler.add('fast', 'us-east-1', last_refresh=clock.now - 8)     # due in 2s
+    scheduler.add('fast', 'eu-west-1')                                 # due now
+    scheduler.add('slow', None, last_refresh=clock.now)                # due in 1000s
+
+    assert scheduler.pop_due() == [ ('fast', 'eu-west-1') ]
+    assert scheduler.time_until_next() == 2
+
+    clock.advance(10)
+    assert scheduler.pop_due() == [ ('fast', 'us-east-1'), ('slow', 'us-east-1') ]
+    assert scheduler.pop_due() == []
+    assert scheduler.time_until_next() == 990
+
+
+def test_idle_backoff(monkeypatch):
+    scheduler, clock = make_scheduler(monkeypatch)
+    scheduler.add('fast', 'us-east-1')
+
+    # the period doubles on each refresh which found nothing, up to 'idle'
+    due_after = list()
+    for _ in range(4):
+        assert scheduler.pop_due() == [ ('fast', 'us-east-1') ]
+        scheduler.complete('fast', 'us-east-1', is_hot=False, changed=False)
+
+        due_after.append(scheduler.time_until_next())
+        clock.advance(due_after[-1])
+
+    assert due_after == [ 20, 40, 70, 70 ]
+
+    # a change brings the period back to 'hot'
+    assert scheduler.pop_due() == [ ('fast', 'us-east-1') ]
+    scheduler.complete('fast', 'us-east-1', is_hot=False, changed=True)
+    assert scheduler.time_until_next() == 10
+
+    # as does a hot region
+    clock.advance(10)
+    scheduler.pop_due()
+    scheduler.complete('fast', 'us-east-1', is_hot=False, changed=False)
+    assert scheduler.time_until_next() == 20
+    clock.advance(20)
+    scheduler.pop_due()
+    scheduler.complete('fast', 'us-east-1', is_hot=True, changed=False)
+    assert scheduler.time_until_next() == 10
+
+
+def test_failed_refresh_is_retried(monkeypatch):
+    scheduler, clock = make_scheduler(monkeypatch)
+    scheduler.add('fast', 'us-east-1')
+    scheduler.add('slow', 'us-east-1')
+
+    assert len(scheduler.pop_due()) == 2
+    scheduler.failed('fast', 'us-east-1')
+    scheduler.failed('slow', 'us-east-1')
+
+    # never later than the hot period
+    assert scheduler.time_until_next() == min(RETRY_PERIOD, PERIODS['fast']['hot'])
+    clock.advance(RETRY_PERIOD)
+    assert scheduler.pop_due() == [ ('fast', 'us-east-1'), ('slow', 'us-east-1') ]
+
+
+def test_touch_makes_region_hot(monkeypatch):
+    scheduler, clock = make_scheduler(monkeypatch)
+    scheduler.add('fast', 'us-east-1')
+    scheduler.add('fast', 'eu-west-1')
+
+    assert len(scheduler.pop_due()) == 2
+    for region in [ 'us-east-1', 'eu-west-1' ]:
+        for _ in range(3):
+            scheduler.complete('fast', region, is_hot=False, changed=False)
+    # both are backed off to the idle period
+    assert scheduler.time_until_next() == 70
+
+    scheduler.touch('us-east-1')
+    assert scheduler.wakeup.is_set()
+    assert scheduler.is_region_hot('us-east-1', has_running_instances=False)
+    assert not scheduler.is_region_hot('eu-west-1', has_running_instances=False)
+
+    # the rescheduled entry is due after the hot period, its old heap item is
+    # ignored
+    clock.advance(10)
+    assert scheduler.pop_due() == [ ('fast', 'us-east-1') ]
+    clock.advance(60)
+    assert scheduler.pop_due() == [ ('fast', 'eu-west-1') ]
+
+    # regions which aren't refreshed aren't kept
+    scheduler.touch('ap-south-1')
+    assert list(scheduler.touched_regions) == [ 'us-east-1' ]
+
+    # nor are regions which are no longer hot
+    clock.advance(TOUCH_HOT_PERIOD)
+    assert not scheduler.is_region_hot('us-east-1', has_running_instances=False)
+    assert scheduler.touched_regions == dict()
+
+
+def main():
+    for test in [ test_due_entries_in_order, test_idle_backoff, test_failed_refresh_is_retried,
+                  test_touch_makes_region_hot ]:
+        with pytest.MonkeyPatch.context() as monkeypatch:
+            test(monkeypatch)
+    print("all tests passed")
+
+
+if __name__ == '__main__':
+    main()
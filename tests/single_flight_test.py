@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+"""Tests of the coalescing of identical EC2 queries (Aws._single_flight()).
+
+EC2 is replaced by botocore Stubber, and the stubbed calls are held until the
+test releases them, so that other queries arrive while they're in flight.
+Run directly or with pytest."""
+
+import os
+import sys
+import threading
+import time
+from os import path
+
+import botocore.exceptions
+from botocore.stub import Stubber
+
+# dirty hack allowing the test to be triggerred as stand alone application and
+# still be able to access all modules in repo
+file_dir = path.dirname(path.realpath(__file__))
+main_dir = path.dirname(file_dir)
+sys.path.append(main_dir)
+
+from awsh_ec2 import Aws
+
+from ec2_inventory_bench import make_interface
+
+REGION = 'us-east-1'
+TIMEOUT = 5
+
+# the stubbed clients never reach AWS, but botocore still wants credentials
+os.environ.setdefault('AWS_ACCESS_KEY_ID', 'test')
+os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'test')
+
+
+class held_calls:
+    """Hold every describe_network_interfaces call of @client until release()"""
+
+    def __init__(self, client):
+        self.started = threading.Event()
+        self.released = threading.Event()
+        self.calls = 0
+        client.meta.events.register('before-parameter-build.ec2.DescribeNetworkInterfaces', self.__hold)
+
+    def __hold(self, **kwargs):
+        self.calls += 1
+        self.started.set()
+        self.released.wait(TIMEOUT)
+
+    def release(self):
+        self.released.set()
+
+
+class caller(threading.Thread):
+    """Run @func in a thread and keep its result or exception"""
+
+    def __init__(self, func):
+        super().__init__()
+        self.func = func
+        self.result = None
+        self.error = None
+        self.start()
+
+    def run(self):
+        try:
+            self.result = self.func()
+        except Exception as e:
+            self.error = e
+
+
+def stubbed_aws():
+    ec2 = Aws()
+    client = ec2._ec2_client(REGION)
+    stubber = Stubber(client)
+    stubber.activate()
+
+    return ec2, stubber, held_calls(client)
+
+
+def wait_for_coalesced(ec2, count):
+    deadline = time.monotonic() + TIMEOUT
+    while ec2.get_stats()['coalesced_region_queries'] < count:
+        assert time.monotonic() < deadline, "query wasn't coalesced"
+        time.sleep(0.01)
+
+
+def test_concurrent_queries_are_coalesced():
+    ec2, stubber, held = stubbed_aws()
+    # a single reply for both queries
+    stubber.add_response('describe_network_interfaces', { 'NetworkInterfaces' : [ make_interface(0) ] })
+
+    first = caller(lambda: ec2.query_interfaces_in_regions([ REGION ]))
+    assert held.started.wait(TIMEOUT)
+    second = caller(lambda: ec2.query_interfaces_in_regions([ REGION ]))
+    wait_for_coalesced(ec2, 1)
+
+    held.release()
+    first.join()
+    second.join()
+
+    assert held.calls == 1
+    assert list(first.result[REGION].keys()) == [ make_interface(0)['NetworkInterfaceId'] ]
+    # the result is shared
+    assert second.result[REGION] is first.result[REGION]
+    assert ec2.get_stats() == { 'region_queries' : 2, 'coalesced_region_queries' : 1,
+                                'inflight_queries' : 0 }
+    stubber.assert_no_pending_responses()
+
+
+def test_error_reaches_all_callers():
+    ec2, stubber, held = stubbed_aws()
+    stubber.add_client_error('describe_network_interfaces', 'RequestLimitExceeded')
+
+    query = lambda: ec2._single_flight(('interfaces', REGION),
+                                       lambda: ec2._get_interface_in_region(REGION))
+    first = caller(query)
+    assert held.started.wait(TIMEOUT)
+    second = caller(query)
+    wait_for_coalesced(ec2, 1)
+
+    held.release()
+    first.join()
+    second.join()
+
+    assert isinstance(first.error, botocore.exceptions.ClientError)
+    assert second.error is first.error
+    stubber.assert_no_pending_responses()
+
+    # a failed query isn't reused
+    stubber.add_response('describe_network_interfaces', { 'NetworkInterfaces' : [] })
+    assert query() == dict()
+    assert held.calls == 2
+
+
+def test_fresh_query_isnt_coalesced():
+    ec2, stubber, held = stubbed_aws()
+    for i in range(2):
+        stubber.add_response('describe_network_interfaces', { 'NetworkInterfaces' : [ make_interface(i) ] })
+
+    first = caller(lambda: ec2.query_interfaces_in_regions([ REGION ]))
+    assert held.started.wait(TIMEOUT)
+
+    # the running query might miss a change made after it started, so the
+    # fresh one runs its own query while the first is still held
+    fresh = caller(lambda: ec2.query_interfaces_in_regions([ REGION ], fresh=True))
+    deadline = time.monotonic() + TIMEOUT
+    while held.calls < 2:
+        assert time.monotonic() < deadline, "fresh query didn't start"
+        time.sleep(0.01)
+
+    held.release()
+    first.join()
+    fresh.join()
+
+    assert ec2.get_stats()['coalesced_region_queries'] == 0
+    assert { *first.result[REGION], *fresh.result[REGION] } == { make_interface(i)['NetworkInterfaceId']
+                                                                 for i in range(2) }
+    stubber.assert_no_pending_responses()
+
+
+def main():
+    test_concurrent_queries_are_coalesced()
+    test_error_reaches_all_callers()
+    test_fresh_query_isnt_coalesced()
+    print("all tests passed")
+
+
+if __name__ == '__main__':
+    main()
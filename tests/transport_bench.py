@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+"""Compare the server's unix socket with its TCP port for local clients.
+
+A server in this process listens on both. For each transport the time of
+opening a connection (including the capabilities hello) is measured, then
+small commands and full state replies are sent over a persistent connection,
+first one at a time and then as a burst of concurrent requests.
+
+The state reply has the size of the complete state of a fleet of --instances
+instances, built the way reply_compression_bench.py builds it.
+
+Usage: transport_bench.py [--requests N] [--instances N] [--regions N]
+"""
+
+import argparse
+import statistics
+import sys
+import time
+from os import path
+
+# dirty hack allowing the test to be triggerred as stand alone application and
+# still be able to access all modules in repo
+file_dir = path.dirname(path.realpath(__file__))
+main_dir = path.dirname(file_dir)
+sys.path.append(main_dir)
+
+import awsh_req_resp_server
+from awsh_req_resp_server import awsh_req_client
+
+from req_resp_bench import free_port, start_server, blocking_round_trips, pipelined_throughput
+from reply_compression_bench import make_state
+
+SMALL_REPLY_LEN = 32
+
+
+def connect_times(client_args, requests_nr):
+    times = list()
+    for _ in range(requests_nr):
+        start = time.perf_counter()
+        client = awsh_req_client(fail_if_no_server=True, synchronous=True, **client_args)
+        times.append(time.perf_counter() - start)
+        client.close()
+
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description='awsh unix socket vs TCP benchmark')
+    parser.add_argument('--requests', type=int, default=500)
+    parser.add_argument('--instances', type=int, default=5000)
+    parser.add_argument('--regions', type=int, default=8)
+    args = parser.parse_args()
+
+    state_len = len(make_state(args.instances, args.regions))
+    sizes = { 'small command' : SMALL_REPLY_LEN, 'full state' : state_len }
+
+    server = start_server(awsh_req_resp_server, free_port(), sizes.values())
+
+    print(f"full state of {args.instances} instances is {state_len / 1024:.0f}KB")
+
+    for transport, unix_socket in [ ('tcp', False), ('unix', True) ]:
+        client_args = { 'unix_socket' : unix_socket }
+
+        connect_ms = sorted(t * 1000 for t in connect_times(client_args, args.requests))
+        print(f"{transport}: connect median {statistics.median(connect_ms):.3f} ms, "
+              f"p90 {connect_ms[int(len(connect_ms) * 0.9) - 1]:.3f} ms")
+
+        for desc, size in sizes.items():
+            requests_nr = args.requests if size == SMALL_REPLY_LEN else max(1, args.requests // 20)
+
+            latencies = blocking_round_trips(awsh_req_resp_server, client_args, True, size, requests_nr)
+            elapsed = pipelined_throughput(awsh_req_resp_server, client_args, size, requests_nr)
+
+            print(f"  {desc:>13}: round-trip median {statistics.median(latencies) * 1000:8.3f} ms | "
+                  f"{requests_nr / elapsed:8.1f} req/s, {requests_nr * size / elapsed / 2**20:8.1f} MiB/s "
+                  f"concurrently")
+
+    server.handle_close()
+
+
+if __name__ == '__main__':
+    main()